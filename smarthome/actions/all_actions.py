@@ -4,33 +4,62 @@ Action handling system for the smart home application.
 This module defines the action system that processes WebSocket messages from nodes and users.
 It contains base classes and specific implementations for various actions like lamp control,
 sensor data processing, and node management. The action resolver routes incoming messages
-to the appropriate action handlers.
+to the appropriate action handlers through the middleware pipeline (see ``middlewares``).
 """
 
 import datetime
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, ClassVar
 
 from fastapi import Depends
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from smarthome import models
-from smarthome.depends import get_db
+from smarthome.cruds.nodes import set_desired_lamps
+from smarthome.caches import access_index, device_addresses
+from smarthome.actions.commands import ack_window, command_tracker, publish_command_ack
+from smarthome.actions.derived import derived_sensors
+from smarthome.actions.rules import rule_engine
+from smarthome.actions.middlewares import (
+    ConcurrencyLimitMiddleware, ErrorIsolationMiddleware, TimingMiddleware, build_pipeline,
+)
+from smarthome.depends import get_async_db
 from smarthome.connectors.bus import Bus, get_bus
+from smarthome.connectors.history_buffer import history_buffer
 from smarthome.logger import logger
-from smarthome.schemas.ws import WSMessage
+from smarthome.schemas.ws import WSActions, WSMessage, new_request_id
+
+
+# Action classes by the action they handle, filled by BaseAction subclasses at import
+ACTIONS: dict[WSActions, type["BaseAction"]] = {}
 
 
 class BaseAction(ABC):
     """
     Base class for all actions.
     
-    If classes inherit from this class, all actions can be automatically collected.
+    Subclasses with ``action`` set are registered in ``ACTIONS`` when they are defined.
+    ``max_concurrency`` limits parallel runs of the action in a worker,
+    None means ``settings.actions_max_concurrency``.
     """
+    action: ClassVar[WSActions | None] = None
+    max_concurrency: ClassVar[int | None] = None
+
     node: models.Node | None
     user: models.User | None
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        super().__init_subclass__(**kwargs)
+        if cls.action is None:
+            return
+        if cls.action in ACTIONS:
+            raise ValueError(f"Action {cls.action.value} is already handled by {ACTIONS[cls.action].__name__}")
+        ACTIONS[cls.action] = cls
     
-    def __init__(self, client: models.Node | models.User, bus: Bus, db: Session) -> None:
+    def __init__(
+        self, client: models.Node | models.User, bus: Bus, db: AsyncSession, request_id: str | None = None,
+    ) -> None:
         """
         Initialize the action with a client, bus, and database session.
         
@@ -38,6 +67,7 @@ class BaseAction(ABC):
             client: Either a Node or User model instance
             bus: Bus instance for message publishing
             db: Database session
+            request_id: request_id of the message that started the action
         """
         self.node = None
         self.user = None
@@ -49,6 +79,7 @@ class BaseAction(ABC):
         
         self.bus = bus
         self.db = db
+        self.request_id = request_id
 
     @abstractmethod
     async def process(self, data: dict[str, Any]) -> None:
@@ -68,6 +99,7 @@ class ActionLampChangedFromNode(BaseAction):
     
     This action is bound to a node and handles lamp state changes.
     """
+    action = WSActions.lamp_changed
 
     async def process(self, data: dict[str, Any]) -> None:
         """
@@ -82,30 +114,44 @@ class ActionLampChangedFromNode(BaseAction):
 
         node_lamp_id = data.get("id")
         value = data.get("value")
-        db_lamp = self.db.query(models.NodeLamp).filter(
-            models.NodeLamp.node_lamp_id == node_lamp_id,
-            models.NodeLamp.node == self.node,
-        ).first()
-        logger.debug("Lamp from db: %s", db_lamp)
-        if not db_lamp:
+        lamp_id = (await device_addresses.get(self.db, self.node.id)).lamps.get(node_lamp_id)
+        logger.debug("Lamp id from cache: %s", lamp_id)
+        if not lamp_id:
             logger.warning("Lamp %s not found in db", node_lamp_id)
             return
 
-        db_lamp.value = value
-        db_lamp.updated = datetime.datetime.now(datetime.timezone.utc)
-        self.db.commit()
+        updated = datetime.datetime.now(datetime.timezone.utc)
+        await self.db.execute(
+            update(models.NodeLamp).where(models.NodeLamp.id == lamp_id).values(value=value, updated=updated)
+        )
+        await self.db.commit()
+
+        ws_message = WSMessage(
+            request_id=new_request_id(),
+            action="updated_lamp",
+            data={"id": lamp_id, "value": value, "updated": updated},
+        )
+        logger.info("Action updated_lamp from Node %s Message: %s", self.node.id, ws_message)
+        await self.bus.publish(self.node.events_bus_id, ws_message)
+        # The change may be the answer to a command
+        if ack_window.is_open(self.node.id):
+            await publish_command_ack(self.bus, self.node.id, self.request_id, [{"id": node_lamp_id, "value": value}])
+
 
-        users = self.node.users
+async def publish_derived_sensors(bus: Bus, derived: list[tuple[int, dict[str, Any]]]) -> None:
+    """
+    Send virtual sensor values to the users of their nodes, one ``updated_values`` frame per node.
 
-        # Replace the action and generally improve the action system
-        for user in users:
-            ws_message = WSMessage(
-                request_id="1",
-                action="updated_lamp",
-                data={"id": db_lamp.id, "value": db_lamp.value, "updated": db_lamp.updated},
-            )
-            logger.info("Action updated_lamp from Node %s to user %s Message: %s", self.node.id, user.id, ws_message)
-            await self.bus.publish(user.bus_id, ws_message)
+    Args:
+        bus: Bus instance for message publishing
+        derived: Node ids and sensor values, see ``DerivedSensorEngine.process``
+    """
+    by_node: dict[int, list[dict[str, Any]]] = {}
+    for node_id, sensor in derived:
+        by_node.setdefault(node_id, []).append(sensor)
+    for node_id, sensors in by_node.items():
+        ws_message = WSMessage(request_id=new_request_id(), action=WSActions.current_values, data={"sensors": sensors})
+        await bus.publish(models.node_events_bus_id(node_id), ws_message)
 
 
 class ActionSensorChangedFromNode(BaseAction):
@@ -113,7 +159,10 @@ class ActionSensorChangedFromNode(BaseAction):
     Process sensor data received from a node.
     
     This action is bound to a node and handles sensor value changes.
+    Accepted readings update the virtual sensors that use them (see ``derived``),
+    all new values are checked by the automation rules, see ``rules``.
     """
+    action = WSActions.sensor_changed
 
     async def process(self, data: dict[str, Any]) -> None:
         """
@@ -128,31 +177,145 @@ class ActionSensorChangedFromNode(BaseAction):
 
         node_sensor_id = data.get("id")
         value = data.get("value")
-        db_sensor = self.db.query(models.NodeSensor).filter(
-            models.NodeSensor.node_sensor_id == node_sensor_id,
-            models.NodeSensor.node == self.node,
-        ).first()
-        logger.debug("Sensor from db: %s", db_sensor)
-        if not db_sensor:
+        addresses = await device_addresses.get(self.db, self.node.id)
+        sensor_id = addresses.sensors.get(node_sensor_id)
+        logger.debug("Sensor id from cache: %s", sensor_id)
+        if not sensor_id:
             logger.warning("Sensor %s not found in db", node_sensor_id)
             return
+        if not addresses.sensor_filters[sensor_id].accept(value):
+            logger.debug("Sensor %s reading %s is filtered out", sensor_id, value)
+            return
 
-        db_sensor.value = value
-        db_sensor.updated = datetime.datetime.now(datetime.timezone.utc)
-        logger.debug("Sensor %s updated db: %s (%s)", db_sensor.id, db_sensor.value, db_sensor.updated)
-        self.db.commit()
+        updated = datetime.datetime.now(datetime.timezone.utc)
+        derived = await derived_sensors.process(self.db, [(sensor_id, value)], updated)
+        await self.db.execute(
+            update(models.NodeSensor).where(models.NodeSensor.id == sensor_id).values(value=value, updated=updated)
+        )
+        if derived:
+            await self.db.execute(update(models.NodeSensor), [sensor for _, sensor in derived])
+        logger.debug("Sensor %s updated db: %s (%s), virtual sensors: %s", sensor_id, value, updated, len(derived))
+        await self.db.commit()
+        await history_buffer.add(sensor_id, updated, value)
+        await history_buffer.add_many(
+            {"sensor_id": sensor["id"], "changed": sensor["updated"], "value": sensor["value"]} for _, sensor in derived
+        )
+        await rule_engine.process(
+            self.db, self.bus, [(sensor_id, value)] + [(sensor["id"], sensor["value"]) for _, sensor in derived]
+        )
+
+        ws_message = WSMessage(
+            request_id=new_request_id(),
+            action="updated_sensor",
+            data={"id": sensor_id, "value": value, "updated": updated},
+        )
+        logger.info("Action updated_sensor from Node %s Message: %s", self.node.id, ws_message)
+        await self.bus.publish(self.node.events_bus_id, ws_message)
+        await publish_derived_sensors(self.bus, derived)
 
-        users = self.node.users
 
-        # Replace the action and generally improve the action system
-        for user in users:
-            ws_message = WSMessage(
-                request_id="1",
-                action="updated_sensor",
-                data={"id": db_sensor.id, "value": db_sensor.value, "updated": db_sensor.updated},
+class ActionSensorsChangedFromNode(BaseAction):
+    """
+    Process a batch of sensor readings (and optionally lamp states) received from a node.
+    
+    This action is bound to a node. Rows are found by the device address cache,
+    the whole frame costs one bulk UPDATE and one commit, history goes to the write-behind buffer,
+    users get a single ``updated_values`` notification, and the automation rules
+    of the updated sensors are evaluated. Virtual sensors computed from the readings
+    (see ``derived``) go the same way, those of other nodes in a frame per node.
+    """
+    action = WSActions.sensors_changed
+
+    async def process(self, data: dict[str, Any]) -> None:
+        """
+        Process sensor readings and lamp states from a node.
+        
+        Input data format:
+        {"sensors": [{"id": 116, "value": 21.5}], "lamps": [{"id": 16, "value": 1}]}
+        where 'id' is the internal identifier within the node, both lists are optional.
+        
+        Args:
+            data: Dictionary containing lists of sensor readings and lamp states
+        """
+        logger.debug("ActionSensorsChangedFromNode. DATA from ESP32 #%s: %s", self.node.id, data)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        # The last value wins if the frame has several readings of the same sensor
+        sensor_values = {item["id"]: item["value"] for item in data.get("sensors") or []}
+        lamp_values = {item["id"]: item["value"] for item in data.get("lamps") or []}
+
+        addresses = await device_addresses.get(self.db, self.node.id)
+        if set(sensor_values) - set(addresses.sensors):
+            logger.warning("Sensors %s not found in db", set(sensor_values) - set(addresses.sensors))
+        updated_sensors = []
+        for node_sensor_id, value in sensor_values.items():
+            sensor_id = addresses.sensors.get(node_sensor_id)
+            if sensor_id and addresses.sensor_filters[sensor_id].accept(value):
+                updated_sensors.append({"id": sensor_id, "value": value, "updated": now})
+        updated_lamps = [
+            {"id": addresses.lamps[node_lamp_id], "value": value, "updated": now}
+            for node_lamp_id, value in lamp_values.items() if node_lamp_id in addresses.lamps
+        ]
+        if len(updated_lamps) < len(lamp_values):
+            logger.warning("Lamps %s not found in db", set(lamp_values) - set(addresses.lamps))
+
+        if not updated_sensors and not updated_lamps:
+            return
+
+        derived = []
+        if updated_sensors:
+            derived = await derived_sensors.process(
+                self.db, [(sensor["id"], sensor["value"]) for sensor in updated_sensors], now,
+            )
+            # Virtual sensors of this node go in its frame, the others are published separately
+            updated_sensors += [sensor for node_id, sensor in derived if node_id == self.node.id]
+            derived = [(node_id, sensor) for node_id, sensor in derived if node_id != self.node.id]
+            await self.db.execute(update(models.NodeSensor), updated_sensors + [sensor for _, sensor in derived])
+        if updated_lamps:
+            await self.db.execute(update(models.NodeLamp), updated_lamps)
+        await self.db.commit()
+        all_sensors = updated_sensors + [sensor for _, sensor in derived]
+        await history_buffer.add_many(
+            {"sensor_id": sensor["id"], "changed": sensor["updated"], "value": sensor["value"]}
+            for sensor in all_sensors
+        )
+        await rule_engine.process(self.db, self.bus, [(sensor["id"], sensor["value"]) for sensor in all_sensors])
+
+        frame_data = {}
+        if updated_sensors:
+            frame_data["sensors"] = updated_sensors
+        if updated_lamps:
+            frame_data["lamps"] = updated_lamps
+        ws_message = WSMessage(request_id=new_request_id(), action=WSActions.current_values, data=frame_data)
+        logger.info("Action updated_values from Node %s: %s sensors, %s lamps",
+                    self.node.id, len(updated_sensors), len(updated_lamps))
+        await self.bus.publish(self.node.events_bus_id, ws_message)
+        await publish_derived_sensors(self.bus, derived)
+        if lamp_values and ack_window.is_open(self.node.id):
+            await publish_command_ack(
+                self.bus, self.node.id, self.request_id,
+                [{"id": node_lamp_id, "value": value} for node_lamp_id, value in lamp_values.items()],
             )
-            logger.info("Action updated_sensor from Node %s to user %s Message: %s", self.node.id, user.id, ws_message)
-            await self.bus.publish(user.bus_id, ws_message)
+
+
+class ActionCommandAckFromNode(BaseAction):
+    """
+    Confirmation of a command received from a node.
+    
+    This action is bound to a node, for commands without a visible result.
+    """
+    action = WSActions.command_ack
+
+    async def process(self, data: dict[str, Any] | None) -> None:
+        """
+        Pass the ack to the worker that sent the command.
+        
+        The message has the request_id of the command and no data.
+        
+        Args:
+            data: Not used
+        """
+        logger.debug("ActionCommandAckFromNode. Ack from ESP32 #%s: %s", self.node.id, self.request_id)
+        await publish_command_ack(self.bus, self.node.id, self.request_id)
 
 
 class ActionSendLampsStateToNodes(BaseAction):
@@ -160,7 +323,13 @@ class ActionSendLampsStateToNodes(BaseAction):
     Control lamps on nodes by a user.
     
     This action is bound to a user and sends lamp state changes to nodes.
+    Lamps are resolved with one query, access is checked by the access index,
+    and each node gets one ``set_lamps_state`` command with all its lamps.
+    Only changes are sent: a lamp already in the requested state, both desired
+    and reported by the node, is skipped. The values become the desired state
+    of the lamps, see ``nodes_push_desired_state``.
     """
+    action = WSActions.send_lamps_state_to_nodes
 
     async def process(self, data: dict[str, Any]) -> None:
         """
@@ -170,41 +339,69 @@ class ActionSendLampsStateToNodes(BaseAction):
         {"lamps": [{"id": 1, "value": 0}]}
         where 'id' is the lamp identifier in the database.
         
-        Output to node for each lamp:
-        {"id": 1, "value": 0}
+        Output to each node:
+        {"lamps": [{"id": 1, "value": 0}]}
         where 'id' is the internal lamp identifier within the node.
+        Commands to an offline node are delivered when it reconnects.
+        The user gets ``command_ack`` for each command when the node confirms it
+        or gives up, see ``smarthome.actions.commands``, and ``command_ack`` with
+        the ``unchanged`` status for a node without changes.
         
         Args:
             data: Dictionary containing lamp state changes
         """
         logger.debug("ActionSendLampsStateToNodes. DATA from User #%s: %s", self.user.id, data)
-        for lamp in data["lamps"]:
-            db_lamp = self.db.query(models.NodeLamp).filter(models.NodeLamp.id == lamp["id"]).first()
-            logger.debug("Lamp from db: %s", db_lamp)
-            if not db_lamp:
-                logger.warning("Lamp %s not found in db", lamp["id"])
+        # The last value wins if the same lamp is sent twice
+        values = {lamp["id"]: lamp["value"] for lamp in data["lamps"]}
+        db_lamps = await self.db.execute(
+            select(
+                models.NodeLamp.id,
+                models.NodeLamp.node_id,
+                models.NodeLamp.node_lamp_id,
+                models.NodeLamp.value,
+                models.NodeLamp.desired_value,
+            ).where(models.NodeLamp.id.in_(values))
+        )
+        user_node_ids = await access_index.user_node_ids(self.db, self.user.id)
+
+        node_lamps: dict[int, dict[int, Any]] = {}
+        found = set()
+        for lamp_id, node_id, node_lamp_id, value, desired_value in db_lamps:
+            found.add(lamp_id)
+            if node_id not in user_node_ids:
+                logger.error("Lamp %s is not connected to user %s", lamp_id, self.user)
                 continue
-
-            db_node = db_lamp.node
-            logger.debug("Node for lamp %s: %s", db_lamp, db_node)
-            if self.user not in db_node.users:
-                logger.error("Lamp %s is not connected to user %s", db_lamp, self.user)
+            lamps = node_lamps.setdefault(node_id, {})
+            if value == desired_value == values[lamp_id]:
                 continue
-
+            lamps[node_lamp_id] = values[lamp_id]
+        if len(found) < len(values):
+            logger.warning("Lamps %s not found in db", set(values) - found)
+
+        for node_id, lamps in node_lamps.items():
+            if not lamps:
+                await self.bus.publish(self.user.bus_id, WSMessage(
+                    request_id=self.request_id or new_request_id(),
+                    action=WSActions.command_ack,
+                    data={"node_id": node_id, "status": "unchanged"},
+                ))
+                continue
+            await set_desired_lamps(self.db, node_id, lamps)
             ws_message = WSMessage(
-                request_id="1",
-                action="set_lamp_state",
-                data={"id": db_lamp.node_lamp_id, "value": lamp["value"]},
+                request_id=new_request_id(),
+                action=WSActions.set_lamps_state,
+                data={"lamps": [{"id": node_lamp_id, "value": value} for node_lamp_id, value in lamps.items()]},
+            )
+            logger.info("Action set_lamps_state from User %s to Node %s Message: %s",
+                        self.user.id, node_id, ws_message)
+            await command_tracker.send(
+                self.bus,
+                node_id,
+                ws_message,
+                lamps=lamps,
+                reply_to=self.user.bus_id,
+                reply_request_id=self.request_id,
             )
-            logger.info("Action set_lamp_state from User %s to Node %s Message: %s",
-                        self.user.id, db_node.id, ws_message)
-            await self.bus.publish(db_node.bus_id, ws_message)
-
-        # Get each lamp from the database
-        # Verify that the lamp's node belongs to the user
-        # If it doesn't belong, just skip it
-        # Send a message to the node
-        # The node should respond, and we record that response in the database and send it to users
 
 
 class ActionRestartNode(BaseAction):
@@ -213,6 +410,7 @@ class ActionRestartNode(BaseAction):
     
     This action is bound to a user and sends restart commands to nodes.
     """
+    action = WSActions.restart_node
 
     async def process(self, data: dict[str, Any]) -> None:
         """
@@ -228,22 +426,27 @@ class ActionRestartNode(BaseAction):
             data: Dictionary containing the node ID to restart
         """
         logger.debug("ActionRestartNode. DATA from User #%s: %s", self.user.id, data)
-        db_node = self.db.query(models.Node).filter(models.Node.id == data["id"]).first()
-        logger.debug("Node from db: %s", db_node)
-        if not db_node:
-            logger.warning("Node %s not found in db", data["id"])
-            return
-
-        if self.user not in db_node.users:
-            logger.error("Node %s is not connected to user %s", db_node, self.user)
+        node_id = data["id"]
+        # Access rows reference existing nodes, so the node is not loaded
+        if not await access_index.has_access(self.db, self.user.id, node_id):
+            logger.error("Node %s is not found or not connected to user %s", node_id, self.user)
             return
 
+        # Not tracked: a restarting node does not answer, and a retry would restart it again
         ws_message = WSMessage(
-            request_id="1",
+            request_id=new_request_id(),
             action="restart",
         )
-        logger.info("Action restart from User %s to Node %s Message: %s", self.user.id, db_node.id, ws_message)
-        await self.bus.publish(db_node.bus_id, ws_message)
+        logger.info("Action restart from User %s to Node %s Message: %s", self.user.id, node_id, ws_message)
+        await self.bus.send_command(models.node_bus_id(node_id), ws_message)
+
+
+# Shared by all connections of the worker: semaphores and metrics live here
+action_pipeline = build_pipeline([
+    ErrorIsolationMiddleware(),
+    ConcurrencyLimitMiddleware(),
+    TimingMiddleware(),
+])
 
 
 class ActionResolver:
@@ -252,7 +455,7 @@ class ActionResolver:
     
     This class is implemented as a singleton through FastAPI's Depends.
     """
-    def __init__(self, db: Session, bus: Bus) -> None:
+    def __init__(self, db: AsyncSession, bus: Bus) -> None:
         """
         Initialize the action resolver.
         
@@ -271,24 +474,17 @@ class ActionResolver:
             client: User or node that initiated the action
             ws_message: WebSocket message containing the action and data
         """
-        # Action mapper. Selects the action class based on the action from the message
-        action_map = {
-            "lamp_changed": ActionLampChangedFromNode,
-            "sensor_changed": ActionSensorChangedFromNode,
-            "send_lamps_state_to_nodes": ActionSendLampsStateToNodes,
-            "restart_node": ActionRestartNode,
-        }
-
-        action_class = action_map[ws_message.action]
+        action_class = ACTIONS.get(ws_message.action)
+        if action_class is None:
+            logger.warning("Unknown action %s from client %s. Message: %s", ws_message.action, client, ws_message)
+            return
         logger.info("ActionResolver %s from client %s. Message: %s", action_class, client, ws_message)
 
-        try:
-            await action_class(client=client, bus=self.bus, db=self.db).process(data=ws_message.data)
-        except AttributeError as ex:
-            logger.exception("Failed process in action %s: %s", action_class, ex)
+        action = action_class(client=client, bus=self.bus, db=self.db, request_id=ws_message.request_id)
+        await action_pipeline(action, ws_message.data)
 
 
-async def get_action_resolver(db: Session = Depends(get_db), bus: Bus = Depends(get_bus)) -> ActionResolver:
+async def get_action_resolver(db: AsyncSession = Depends(get_async_db), bus: Bus = Depends(get_bus)) -> ActionResolver:
     """
     Get an instance of ActionResolver.
     
@@ -0,0 +1,321 @@
+"""
+Acknowledgement of lamp commands.
+
+Every command created by the server has a unique ``request_id``. The worker that
+sent a lamp command keeps it in ``CommandTracker`` until the node confirms it:
+the node answers with the ``request_id`` of the command (in its ``lamp_changed`` or
+in a bare ``command_ack``), or, for firmware without request ids, reports the
+commanded lamp state. The worker the node is connected to publishes the answer to the
+shared ``commands-acks`` channel (see ``publish_command_ack``), the tracker of the
+sending worker matches it, records the round trip of the node and sends ``command_ack``
+to the user with the ``request_id`` of the user's message. State reports of a node are
+published there only while a command delivered to it may wait for an ack (see
+``AckWindow``), so periodic telemetry does not reach the channel.
+
+A command without an ack is sent again live every ``commands_ack_timeout_ms``, after
+``commands_max_retries`` retries the user gets ``command_ack`` with the ``timeout`` status.
+A command to an offline node is not tracked: it waits in the node's command stream, the
+user gets the ``queued`` status at once.
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterable
+
+from smarthome import models
+from smarthome.connectors.bus import Bus
+from smarthome.logger import logger
+from smarthome.metrics import Histogram
+from smarthome.schemas.ws import WSActions, WSMessage, new_request_id
+from smarthome.settings import settings
+
+# Acks of all nodes, every worker that sends commands listens to it
+COMMAND_ACKS_BUS_ID = "commands-acks"
+
+
+@dataclass
+class PendingCommand:
+    """
+    A command waiting for the ack of the node.
+
+    ``lamps`` maps node lamp ids to the commanded values, a state report of the node
+    with all of them acks the command too.
+    """
+    message: WSMessage
+    node_id: int
+    reply_to: str | None = None
+    reply_request_id: str | None = None
+    lamps: dict[int, Any] = field(default_factory=dict)
+    sent_at: float = field(default_factory=time.perf_counter)
+    attempts: int = 1
+    timer: asyncio.TimerHandle | None = None
+
+
+class CommandMetrics:
+    """ Per-node command round trip histograms, retry and timeout counters of this worker """
+
+    def __init__(self) -> None:
+        self.latency: dict[int, Histogram] = {}
+        self.retries: dict[int, int] = {}
+        self.timeouts: dict[int, int] = {}
+        self.queued: dict[int, int] = {}
+
+    def observe(self, node_id: int, seconds: float) -> None:
+        """ Record an acked command """
+        if node_id not in self.latency:
+            self.latency[node_id] = Histogram()
+        self.latency[node_id].observe(seconds)
+
+    def retried(self, node_id: int) -> None:
+        """ Count a command sent again """
+        self.retries[node_id] = self.retries.get(node_id, 0) + 1
+
+    def timed_out(self, node_id: int) -> None:
+        """ Count a command given up """
+        self.timeouts[node_id] = self.timeouts.get(node_id, 0) + 1
+
+    def queued_offline(self, node_id: int) -> None:
+        """ Count a command left for an offline node """
+        self.queued[node_id] = self.queued.get(node_id, 0) + 1
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        """ Metrics for the ``/metrics`` endpoint, by node id """
+        return {
+            str(node_id): {
+                "latency": self.latency.get(node_id, Histogram()).snapshot(),
+                "retries": self.retries.get(node_id, 0),
+                "timeouts": self.timeouts.get(node_id, 0),
+                "queued": self.queued.get(node_id, 0),
+            }
+            for node_id in sorted(set(self.latency) | set(self.retries) | set(self.timeouts) | set(self.queued))
+        }
+
+
+command_metrics = CommandMetrics()
+
+
+class CommandTracker:
+    """
+    Commands of this worker waiting for acks, with timeouts and retries.
+
+    Args:
+        timeout_ms: Time to wait for an ack before sending the command again
+        max_retries: How many times a command is sent again before it is given up
+        metrics: Where to record round trips
+    """
+
+    def __init__(
+        self,
+        timeout_ms: int = settings.commands_ack_timeout_ms,
+        max_retries: int = settings.commands_max_retries,
+        metrics: CommandMetrics = command_metrics,
+    ) -> None:
+        self.timeout: float = timeout_ms / 1000
+        self.max_retries: int = max_retries
+        self.metrics: CommandMetrics = metrics
+        self.pending: dict[str, PendingCommand] = {}
+        # Request ids of pending commands by node, to match state reports
+        self.node_commands: dict[int, set[str]] = {}
+        self.bus: Bus | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def send(
+        self,
+        bus: Bus,
+        node_id: int,
+        message: WSMessage,
+        lamps: dict[int, Any] | None = None,
+        reply_to: str | None = None,
+        reply_request_id: str | None = None,
+    ) -> None:
+        """
+        Send a command to the node and track its ack.
+
+        A command to an offline node is stored for it and answered with ``queued``.
+
+        Args:
+            bus: Bus instance for message publishing
+            node_id: Node ID
+            message: The command, its request_id must be unique
+            lamps: Commanded lamp values by node lamp id
+            reply_to: Bus ID to send ``command_ack`` to, None for no reply
+            reply_request_id: request_id of the ``command_ack``
+        """
+        if self.bus is not bus:
+            self.bus = bus
+            await bus.add_handler(COMMAND_ACKS_BUS_ID, self.on_ack)
+        command = PendingCommand(
+            message=message,
+            node_id=node_id,
+            reply_to=reply_to,
+            reply_request_id=reply_request_id,
+            lamps=dict(lamps or {}),
+        )
+        if not await bus.send_command(models.node_bus_id(node_id), message):
+            self.metrics.queued_offline(node_id)
+            logger.info("Command %s to offline node %s is queued", message.request_id, node_id)
+            await self._reply(command, "queued")
+            return
+        self.pending[message.request_id] = command
+        self.node_commands.setdefault(node_id, set()).add(message.request_id)
+        self._schedule(command)
+
+    def _schedule(self, command: PendingCommand) -> None:
+        command.timer = asyncio.get_running_loop().call_later(self.timeout, self._timed_out, command.message.request_id)
+
+    def _timed_out(self, request_id: str) -> None:
+        self._spawn(self._expired(request_id))
+
+    def _spawn(self, coroutine) -> None:
+        """ Run a coroutine from a callback, keeping a reference to the task """
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _forget(self, request_id: str) -> PendingCommand | None:
+        command = self.pending.pop(request_id, None)
+        if command is None:
+            return None
+        if command.timer is not None:
+            command.timer.cancel()
+        self.node_commands.get(command.node_id, set()).discard(request_id)
+        return command
+
+    async def _expired(self, request_id: str) -> None:
+        """
+        Send the command again or give it up.
+
+        Retries are published live only, the command is already in the node's stream.
+        """
+        command = self.pending.get(request_id)
+        if command is None:
+            return
+        if command.attempts > self.max_retries:
+            self._forget(request_id)
+            self.metrics.timed_out(command.node_id)
+            logger.warning("Command %s to node %s is not acked after %s attempts",
+                           request_id, command.node_id, command.attempts)
+            await self._reply(command, "timeout")
+            return
+        if not await self.bus.publish(models.node_bus_id(command.node_id), command.message):
+            # The node went offline, it gets the stored command when it connects
+            self._forget(request_id)
+            self.metrics.queued_offline(command.node_id)
+            logger.info("Command %s to node %s is queued, the node is offline", request_id, command.node_id)
+            await self._reply(command, "queued")
+            return
+        command.attempts += 1
+        self.metrics.retried(command.node_id)
+        logger.info("Command %s to node %s is sent again, attempt %s", request_id, command.node_id, command.attempts)
+        self._schedule(command)
+
+    def on_ack(self, message: dict[str, Any]) -> None:
+        """
+        Match an ack from the ``commands-acks`` channel with pending commands.
+
+        Args:
+            message: ``command_ack`` with ``node_id``, the ``request_id`` of the node message
+                and the lamp states reported by the node
+        """
+        data = message.get("data") or {}
+        node_id = data.get("node_id")
+        command = self.pending.get(data.get("request_id"))
+        if command is not None and command.node_id == node_id:
+            self._acked(command.message.request_id)
+            return
+        lamps = data.get("lamps") or ()
+        if not lamps:
+            return
+        for request_id in tuple(self.node_commands.get(node_id, ())):
+            command = self.pending[request_id]
+            if not command.lamps:
+                continue
+            for lamp in lamps:
+                if lamp.get("id") in command.lamps and command.lamps[lamp["id"]] == lamp.get("value"):
+                    del command.lamps[lamp["id"]]
+            if not command.lamps:
+                self._acked(request_id)
+
+    def _acked(self, request_id: str) -> None:
+        command = self._forget(request_id)
+        latency = time.perf_counter() - command.sent_at
+        self.metrics.observe(command.node_id, latency)
+        logger.debug("Command %s acked by node %s in %.3f s", request_id, command.node_id, latency)
+        self._spawn(self._reply(command, "ok", latency))
+
+    async def _reply(self, command: PendingCommand, status: str, latency: float | None = None) -> None:
+        """ Tell the user how the command ended """
+        if command.reply_to is None:
+            return
+        data = {
+            "command_id": command.message.request_id,
+            "node_id": command.node_id,
+            "status": status,
+            "attempts": command.attempts,
+        }
+        if latency is not None:
+            data["latency_ms"] = round(latency * 1000, 1)
+        await self.bus.publish(
+            command.reply_to,
+            WSMessage(request_id=command.reply_request_id or new_request_id(), action=WSActions.command_ack, data=data),
+        )
+
+
+command_tracker = CommandTracker()
+
+
+class AckWindow:
+    """
+    Nodes of this worker that got a command recently and may answer it.
+
+    A node's worker calls ``opened`` for every command queued to the node socket; state
+    reports of the node are passed to ``commands-acks`` only within the window, which
+    covers all retries of the command.
+
+    Args:
+        seconds: Length of the window after the last command
+    """
+
+    def __init__(
+        self, seconds: float = settings.commands_ack_timeout_ms / 1000 * (settings.commands_max_retries + 2),
+    ) -> None:
+        self.seconds: float = seconds
+        # Node id -> monotonic end of the window
+        self.nodes: dict[int, float] = {}
+
+    def opened(self, node_id: int) -> None:
+        """ A command was queued to the node """
+        self.nodes[node_id] = time.monotonic() + self.seconds
+
+    def is_open(self, node_id: int) -> bool:
+        """ Whether answers of the node may ack a command """
+        until = self.nodes.get(node_id)
+        if until is None:
+            return False
+        if until < time.monotonic():
+            del self.nodes[node_id]
+            return False
+        return True
+
+
+ack_window = AckWindow()
+
+
+async def publish_command_ack(
+    bus: Bus, node_id: int, request_id: str, lamps: Iterable[dict[str, Any]] = (),
+) -> None:
+    """
+    Pass an answer of a node to the worker that sent the command.
+
+    Args:
+        bus: Bus instance for message publishing
+        node_id: Node ID
+        request_id: request_id of the node message
+        lamps: Lamp states reported by the node, ``{"id": <node lamp id>, "value": ...}``
+    """
+    ws_message = WSMessage(
+        request_id=new_request_id(),
+        action=WSActions.command_ack,
+        data={"request_id": request_id, "node_id": node_id, "lamps": list(lamps)},
+    )
+    await bus.publish(COMMAND_ACKS_BUS_ID, ws_message)
@@ -0,0 +1,354 @@
+"""
+Virtual sensors computed from other sensors at ingest time.
+
+A ``NodeSensor`` with a ``formula`` is virtual: its value is an arithmetic expression
+over other sensors, referenced by primary key as ``s<id>``, e.g. ``dew_point(s12, s13)``
+or ``avg(s12, 10) - s14``. Formulas are compiled once and indexed by their input sensors,
+so a reading recomputes only the virtual sensors that use it, from the last values kept in
+memory. ``avg(s<id>, n)`` is the moving average of the last ``n`` accepted readings of the
+sensor, kept as a running sum. A virtual sensor can use another virtual sensor.
+
+Computed values pass the ingest filter of the virtual sensor and are then stored, added to
+the history, checked by the rules and sent to users like readings of physical sensors.
+
+Formulas are reloaded every ``derived_sensors_ttl`` seconds, changes made through the ORM
+of this worker are picked up at once. Moving averages survive reloads of unchanged formulas.
+
+Every worker computes the formulas from the readings of its own nodes: a formula over
+sensors of several nodes is computed by the worker of the node whose reading came, with
+the values of sensors reported to other workers as stored in the database at the last
+reload (up to ``derived_sensors_ttl`` seconds old). Moving averages are kept per worker
+and cover the readings of that worker.
+"""
+import ast
+import datetime
+import math
+import re
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from smarthome import models
+from smarthome.caches import SensorFilter
+from smarthome.logger import logger
+from smarthome.settings import settings
+
+SENSOR_NAME = re.compile(r"^s(\d+)$")
+
+
+def dew_point(temperature: float, humidity: float) -> float:
+    """
+    Dew point by the Magnus formula.
+
+    >>> round(dew_point(20, 50), 1)
+    9.3
+
+    Args:
+        temperature: Degrees Celsius
+        humidity: Relative humidity, %
+
+    Returns:
+        Degrees Celsius
+    """
+    gamma = math.log(humidity / 100) + 17.62 * temperature / (243.12 + temperature)
+    return 243.12 * gamma / (17.62 - gamma)
+
+
+FUNCTIONS: dict[str, Callable[..., float]] = {
+    "abs": abs,
+    "min": min,
+    "max": max,
+    "round": round,
+    "sqrt": math.sqrt,
+    "exp": math.exp,
+    "log": math.log,
+    "dew_point": dew_point,
+}
+OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.USub, ast.UAdd)
+
+
+class FormulaError(ValueError):
+    """ A formula that can't be compiled """
+
+
+class MovingAverage:
+    """
+    Average of the last readings of a sensor.
+
+    >>> window = MovingAverage(size=2)
+    >>> [window.add(value) for value in (1, 3, 5)]
+    [1.0, 2.0, 4.0]
+    """
+
+    def __init__(self, size: int) -> None:
+        self.values: deque[float] = deque(maxlen=size)
+        self.total: float = 0.0
+
+    def add(self, value: float) -> float:
+        """ Add a reading and return the average """
+        if len(self.values) == self.values.maxlen:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
+        return self.value
+
+    @property
+    def value(self) -> float | None:
+        """ The average, None before the first reading """
+        return self.total / len(self.values) if self.values else None
+
+
+@dataclass
+class DerivedSensor:
+    """
+    A compiled formula of a virtual sensor.
+
+    ``sensors`` are the ids of sensors read by the formula directly, ``windows`` are
+    the moving averages by the names they have in the compiled formula.
+    """
+    id: int
+    node_id: int
+    formula: str
+    code: Any
+    sensors: set[int]
+    windows: dict[str, tuple[int, MovingAverage]]
+    filter: SensorFilter = field(default_factory=SensorFilter)
+
+    @classmethod
+    def compile(cls, sensor_id: int, node_id: int, formula: str) -> "DerivedSensor":
+        """
+        Check and compile a formula.
+
+        >>> sensor = DerivedSensor.compile(3, 1, "avg(s1, 2) + s2 * 2")
+        >>> sorted(sensor.inputs)
+        [1, 2]
+
+        Args:
+            sensor_id: Virtual sensor id
+            node_id: Node of the virtual sensor
+            formula: The formula
+
+        Returns:
+            The virtual sensor
+
+        Raises:
+            FormulaError: The formula is broken or uses something except numbers,
+                arithmetic, sensors and ``FUNCTIONS``
+        """
+        try:
+            tree = ast.parse(formula, mode="eval")
+        except SyntaxError as ex:
+            raise FormulaError(f"Formula {formula!r} of sensor {sensor_id}: {ex.msg}") from ex
+        sensors: set[int] = set()
+        windows: dict[str, tuple[int, MovingAverage]] = {}
+
+        def check(node: ast.AST) -> ast.AST:
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "avg":
+                if (len(node.args) != 2 or node.keywords or not isinstance(node.args[0], ast.Name)
+                        or not SENSOR_NAME.match(node.args[0].id) or not isinstance(node.args[1], ast.Constant)
+                        or not isinstance(node.args[1].value, int) or node.args[1].value < 1):
+                    raise FormulaError(f"Formula {formula!r} of sensor {sensor_id}: use avg(s<id>, <readings>)")
+                name = f"_avg{len(windows)}"
+                windows[name] = (int(SENSOR_NAME.match(node.args[0].id).group(1)), MovingAverage(node.args[1].value))
+                return ast.Name(id=name, ctx=ast.Load())
+            if isinstance(node, ast.Name):
+                match = SENSOR_NAME.match(node.id)
+                if match:
+                    sensors.add(int(match.group(1)))
+                    return node
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS \
+                    and not node.keywords:
+                node.args = [check(arg) for arg in node.args]
+                return node
+            if isinstance(node, ast.BinOp) and isinstance(node.op, OPERATORS):
+                node.left, node.right = check(node.left), check(node.right)
+                return node
+            if isinstance(node, ast.UnaryOp) and isinstance(node.op, OPERATORS):
+                node.operand = check(node.operand)
+                return node
+            if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+                return node
+            raise FormulaError(f"Formula {formula!r} of sensor {sensor_id}: {ast.unparse(node)!r} is not allowed")
+
+        tree.body = check(tree.body)
+        code = compile(ast.fix_missing_locations(tree), f"<sensor {sensor_id}>", "eval")
+        return cls(sensor_id, node_id, formula, code, sensors, windows)
+
+    @property
+    def inputs(self) -> set[int]:
+        """ Ids of all sensors the formula depends on """
+        return self.sensors | {sensor_id for sensor_id, _ in self.windows.values()}
+
+    def observe(self, sensor_id: int, value: float) -> None:
+        """ Add a reading of an input to the moving averages """
+        for window_sensor_id, window in self.windows.values():
+            if window_sensor_id == sensor_id:
+                window.add(value)
+
+    def evaluate(self, values: dict[int, Any]) -> float | None:
+        """
+        Compute the value.
+
+        >>> sensor = DerivedSensor.compile(3, 1, "avg(s1, 2) + s2 * 2")
+        >>> sensor.observe(1, 10)
+        >>> sensor.evaluate({1: 10, 2: 0.5})
+        11.0
+
+        Args:
+            values: Last values of the sensors by id
+
+        Returns:
+            The value, None while an input has no numeric value or the result is not a number
+        """
+        namespace: dict[str, Any] = {}
+        for sensor_id in self.sensors:
+            value = values.get(sensor_id)
+            if not isinstance(value, (int, float)):
+                return None
+            namespace[f"s{sensor_id}"] = value
+        for name, (_, window) in self.windows.items():
+            if window.value is None:
+                return None
+            namespace[name] = window.value
+        try:
+            value = eval(self.code, {"__builtins__": {}, **FUNCTIONS}, namespace)  # pylint: disable=eval-used
+        except (ArithmeticError, ValueError, TypeError) as ex:
+            logger.debug("Sensor %s formula %r failed: %s", self.id, self.formula, ex)
+            return None
+        if not isinstance(value, (int, float)) or not math.isfinite(value):
+            return None
+        return float(value)
+
+
+class DerivedSensorEngine:
+    """
+    Virtual sensors indexed by their input sensors, with the last values of the inputs.
+
+    Args:
+        ttl: Reload the formulas after this many seconds
+    """
+
+    def __init__(self, ttl: int = settings.derived_sensors_ttl) -> None:
+        self.ttl: int = ttl
+        self.by_input: dict[int, list[DerivedSensor]] = {}
+        self.values: dict[int, Any] = {}
+        # Inputs with a value from this worker since the last load
+        self.seen: set[int] = set()
+        self.loaded_at: float | None = None
+
+    async def load(self, db: AsyncSession) -> None:
+        """
+        Load the formulas and the current values of their inputs from the database.
+
+        Args:
+            db: Database session
+        """
+        old_sensors = {sensor.id: sensor for sensors in self.by_input.values() for sensor in sensors}
+        db_sensors = await db.execute(
+            select(
+                models.NodeSensor.id,
+                models.NodeSensor.node_id,
+                models.NodeSensor.formula,
+                models.NodeSensor.deadband_abs,
+                models.NodeSensor.deadband_rel,
+                models.NodeSensor.min_interval,
+                models.NodeSensor.heartbeat_interval,
+            ).where(models.NodeSensor.formula.is_not(None))
+        )
+        by_input: dict[int, list[DerivedSensor]] = {}
+        for sensor_id, node_id, formula, deadband_abs, deadband_rel, min_interval, heartbeat_interval in db_sensors:
+            sensor = old_sensors.get(sensor_id)
+            if sensor is None or sensor.formula != formula:
+                try:
+                    sensor = DerivedSensor.compile(sensor_id, node_id, formula)
+                except FormulaError as ex:
+                    logger.error("%s", ex)
+                    continue
+            sensor.node_id = node_id
+            sensor.filter.deadband_abs, sensor.filter.deadband_rel = deadband_abs, deadband_rel
+            sensor.filter.min_interval, sensor.filter.heartbeat_interval = min_interval, heartbeat_interval
+            for input_id in sensor.inputs:
+                by_input.setdefault(input_id, []).append(sensor)
+        if by_input:
+            db_values = await db.execute(
+                select(models.NodeSensor.id, models.NodeSensor.value).where(models.NodeSensor.id.in_(by_input))
+            )
+            values = dict(db_values.tuples().all())
+            # Values of this worker may be not stored yet, the others are refreshed
+            values.update((sensor_id, self.values[sensor_id]) for sensor_id in self.seen if sensor_id in self.values)
+            self.values = values
+        self.seen = set()
+        self.by_input = by_input
+        self.loaded_at = time.monotonic()
+        logger.debug("Virtual sensors loaded for %s inputs", len(by_input))
+
+    async def _ensure_loaded(self, db: AsyncSession) -> None:
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+            await self.load(db)
+
+    async def process(
+        self, db: AsyncSession, readings: Iterable[tuple[int, Any]], updated: datetime.datetime,
+    ) -> list[tuple[int, dict[str, Any]]]:
+        """
+        Remember accepted readings and compute the virtual sensors that use them.
+
+        Args:
+            db: Database session, used only to (re)load the formulas
+            readings: Sensor ids (primary keys) and values
+            updated: Time of the readings
+
+        Returns:
+            Node ids and ``{"id", "value", "updated"}`` of the accepted virtual sensor values,
+            in the form of the sensor updates of the ingest path
+        """
+        await self._ensure_loaded(db)
+        if not self.by_input:
+            return []
+        readings = [(sensor_id, value) for sensor_id, value in readings if sensor_id in self.by_input]
+        for sensor_id, value in readings:
+            self.values[sensor_id] = value
+            self.seen.add(sensor_id)
+        now = time.monotonic()
+        computed: list[tuple[int, dict[str, Any]]] = []
+        done: set[int] = set()
+        # Virtual sensors of the next round use the values computed in this one
+        while readings:
+            dirty: dict[int, DerivedSensor] = {}
+            for sensor_id, value in readings:
+                for sensor in self.by_input.get(sensor_id, ()):
+                    if isinstance(value, (int, float)):
+                        sensor.observe(sensor_id, value)
+                    if sensor.id not in done:
+                        dirty[sensor.id] = sensor
+            readings = []
+            for sensor in dirty.values():
+                done.add(sensor.id)
+                value = sensor.evaluate(self.values)
+                if value is None or not sensor.filter.accept(value, now):
+                    continue
+                if sensor.id in self.by_input:
+                    self.values[sensor.id] = value
+                    self.seen.add(sensor.id)
+                    readings.append((sensor.id, value))
+                computed.append((sensor.node_id, {"id": sensor.id, "value": value, "updated": updated}))
+        return computed
+
+    def clear(self) -> None:
+        """ Reload the formulas with the next reading """
+        self.loaded_at = None
+
+
+derived_sensors = DerivedSensorEngine()
+
+
+@event.listens_for(models.NodeSensor, "after_insert")
+@event.listens_for(models.NodeSensor, "after_update")
+@event.listens_for(models.NodeSensor, "after_delete")
+def reload_formulas(mapper, connection, target):
+    """ Pick up virtual sensors changed by this worker with the next reading """
+    # pylint: disable=unused-argument
+    derived_sensors.clear()
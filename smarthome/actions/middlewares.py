@@ -0,0 +1,151 @@
+"""
+Action middlewares.
+
+Every action received from a websocket goes through a chain of middlewares
+before its ``process``. The chain is built once per worker, so its state
+(semaphores, metrics) is shared by all connections:
+
+    ErrorIsolationMiddleware -> ConcurrencyLimitMiddleware -> TimingMiddleware -> action.process
+"""
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from functools import partial
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Sequence
+
+from smarthome.logger import logger
+from smarthome.metrics import Histogram
+from smarthome.settings import settings
+
+if TYPE_CHECKING:
+    from smarthome.actions.all_actions import BaseAction
+
+Handler = Callable[["BaseAction", dict[str, Any] | None], Awaitable[None]]
+
+
+class ActionMetrics:
+    """ Per-action latency histograms and error counters of this worker """
+
+    def __init__(self) -> None:
+        self.latency: dict[str, Histogram] = {}
+        self.errors: dict[str, int] = {}
+
+    def observe(self, action: str, seconds: float) -> None:
+        """ Record a processed action """
+        if action not in self.latency:
+            self.latency[action] = Histogram()
+        self.latency[action].observe(seconds)
+
+    def failed(self, action: str) -> None:
+        """ Count a failed action """
+        self.errors[action] = self.errors.get(action, 0) + 1
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        """ Metrics for the ``/metrics`` endpoint """
+        return {
+            action: {"latency": self.latency.get(action, Histogram()).snapshot(), "errors": self.errors.get(action, 0)}
+            for action in sorted(set(self.latency) | set(self.errors))
+        }
+
+
+action_metrics = ActionMetrics()
+
+
+class ActionMiddleware(ABC):
+    """ A step of the action pipeline """
+
+    @abstractmethod
+    async def __call__(self, action: "BaseAction", data: dict[str, Any] | None, call_next: Handler) -> None:
+        """
+        Process the action and pass it further.
+
+        Args:
+            action: The action to process
+            data: Data from the websocket message
+            call_next: The next step of the pipeline
+        """
+
+
+class ErrorIsolationMiddleware(ActionMiddleware):
+    """
+    Logs and counts errors of an action, so a broken message does not close the websocket.
+
+    Args:
+        metrics: Where to count errors
+    """
+
+    def __init__(self, metrics: ActionMetrics = action_metrics) -> None:
+        self.metrics = metrics
+
+    async def __call__(self, action: "BaseAction", data: dict[str, Any] | None, call_next: Handler) -> None:
+        try:
+            await call_next(action, data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            self.metrics.failed(action.action.value)
+            logger.exception("Failed process in action %s with data %s: %s", action.action.value, data, ex)
+            # The session may be left in a failed transaction
+            await action.db.rollback()
+
+
+class ConcurrencyLimitMiddleware(ActionMiddleware):
+    """
+    Limits how many actions of one type run at the same time in this worker.
+
+    A flood of one action waits here instead of taking all database connections.
+
+    Args:
+        default_limit: Limit for actions without their own ``max_concurrency``
+    """
+
+    def __init__(self, default_limit: int = settings.actions_max_concurrency) -> None:
+        self.default_limit = default_limit
+        self.semaphores: dict[str, asyncio.Semaphore] = {}
+
+    async def __call__(self, action: "BaseAction", data: dict[str, Any] | None, call_next: Handler) -> None:
+        name = action.action.value
+        if name not in self.semaphores:
+            self.semaphores[name] = asyncio.Semaphore(action.max_concurrency or self.default_limit)
+        async with self.semaphores[name]:
+            await call_next(action, data)
+
+
+class TimingMiddleware(ActionMiddleware):
+    """
+    Records the processing time of every action.
+
+    Args:
+        metrics: Where to record timings
+    """
+
+    def __init__(self, metrics: ActionMetrics = action_metrics) -> None:
+        self.metrics = metrics
+
+    async def __call__(self, action: "BaseAction", data: dict[str, Any] | None, call_next: Handler) -> None:
+        started = time.perf_counter()
+        try:
+            await call_next(action, data)
+        finally:
+            self.metrics.observe(action.action.value, time.perf_counter() - started)
+
+
+async def process_action(action: "BaseAction", data: dict[str, Any] | None) -> None:
+    """ The last step of the pipeline """
+    await action.process(data)
+
+
+def build_pipeline(middlewares: Sequence[ActionMiddleware], handler: Handler = process_action) -> Handler:
+    """
+    Wrap the handler into middlewares, the first one is the outermost.
+
+    Args:
+        middlewares: Middlewares in the order of calling
+        handler: The last step
+
+    Returns:
+        The pipeline entry point
+    """
+    for middleware in reversed(middlewares):
+        handler = partial(middleware, call_next=handler)
+    return handler
@@ -0,0 +1,188 @@
+"""
+Automation rules evaluated at ingest time.
+
+Rules (``models.Rule``) are loaded into memory and indexed by sensor id, so
+a sensor reading evaluates only the rules of that sensor. A rule is edge
+triggered: it sends a command only when its state changes, the first reading after
+a start or a reload of a new rule only sets the state. Hysteresis keeps a
+value jittering around the threshold from toggling the lamp, and a cooldown
+limits how often one rule sends commands. Commands of one reading batch are
+grouped by node and go out as ``set_lamps_state`` through the command tracker.
+
+Rules are reloaded every ``rules_ttl`` seconds, changes made through the ORM
+of this worker are picked up at once. Rule states survive reloads.
+"""
+import time
+from dataclasses import dataclass
+from typing import Any, Iterable
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from smarthome import models
+from smarthome.actions.commands import command_tracker
+from smarthome.connectors.bus import Bus
+from smarthome.cruds.nodes import set_desired_lamps
+from smarthome.logger import logger
+from smarthome.schemas.ws import WSActions, WSMessage, new_request_id
+from smarthome.settings import settings
+
+
+@dataclass
+class RuleState:
+    """
+    A loaded rule with its lamp address and current state.
+
+    ``active`` is None until the first reading that decides the state, that reading
+    sets it without a command: the lamp may have been set by hand meanwhile.
+    """
+    id: int
+    sensor_id: int
+    operator: str
+    threshold: float
+    hysteresis: float
+    node_id: int
+    node_lamp_id: int
+    value_on: int
+    value_off: int | None
+    cooldown: int
+    active: bool | None = None
+    last_fired: float | None = None
+
+    def evaluate(self, value: Any, now: float) -> int | None:
+        """
+        Update the state with a reading.
+
+        >>> rule = RuleState(1, 1, ">", 1000, 100, 1, 16, value_on=1, value_off=0, cooldown=0)
+        >>> [rule.evaluate(value, now=0) for value in (1200, 950, 850, 950, 1100)]
+        [None, None, 0, None, 1]
+
+        Args:
+            value: Sensor value
+            now: Monotonic time of the reading
+
+        Returns:
+            Lamp value to send, None if nothing should be sent
+        """
+        if not isinstance(value, (int, float)):
+            return None
+        if self.operator == "<":
+            turn_on, turn_off = value < self.threshold, value > self.threshold + self.hysteresis
+        else:
+            turn_on, turn_off = value > self.threshold, value < self.threshold - self.hysteresis
+        if not turn_on and not turn_off or turn_on == self.active:
+            return None
+        if self.active is None:
+            self.active = turn_on
+            return None
+        # Within the cooldown the state is kept, so the change fires after it
+        if self.last_fired is not None and now - self.last_fired < self.cooldown:
+            return None
+        self.active = turn_on
+        lamp_value = self.value_on if turn_on else self.value_off
+        if lamp_value is not None:
+            self.last_fired = now
+        return lamp_value
+
+
+class RuleEngine:
+    """
+    Active rules of all sensors indexed by sensor id.
+
+    Args:
+        ttl: Reload the rules after this many seconds
+    """
+
+    def __init__(self, ttl: int = settings.rules_ttl) -> None:
+        self.ttl: int = ttl
+        self.by_sensor: dict[int, list[RuleState]] = {}
+        self.loaded_at: float | None = None
+
+    async def load(self, db: AsyncSession) -> None:
+        """
+        Load active rules from the database, keeping the states of known rules.
+
+        Args:
+            db: Database session
+        """
+        old_rules = {rule.id: rule for rules in self.by_sensor.values() for rule in rules}
+        db_rules = await db.execute(
+            select(
+                models.Rule.id,
+                models.Rule.sensor_id,
+                models.Rule.operator,
+                models.Rule.threshold,
+                models.Rule.hysteresis,
+                models.NodeLamp.node_id,
+                models.NodeLamp.node_lamp_id,
+                models.Rule.value_on,
+                models.Rule.value_off,
+                models.Rule.cooldown,
+            )
+            .join(models.NodeLamp, models.NodeLamp.id == models.Rule.lamp_id)
+            .where(models.Rule.is_active.is_(True))
+        )
+        by_sensor: dict[int, list[RuleState]] = {}
+        for row in db_rules:
+            rule = RuleState(*row)
+            rule.hysteresis = rule.hysteresis or 0
+            rule.cooldown = rule.cooldown or 0
+            old_rule = old_rules.get(rule.id)
+            if old_rule is not None:
+                rule.active, rule.last_fired = old_rule.active, old_rule.last_fired
+            by_sensor.setdefault(rule.sensor_id, []).append(rule)
+        self.by_sensor = by_sensor
+        self.loaded_at = time.monotonic()
+        logger.debug("Rules loaded for %s sensors", len(by_sensor))
+
+    async def _ensure_loaded(self, db: AsyncSession) -> None:
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+            await self.load(db)
+
+    async def process(self, db: AsyncSession, bus: Bus, readings: Iterable[tuple[int, Any]]) -> None:
+        """
+        Evaluate the rules of the sensors and send commands of the fired ones.
+
+        Args:
+            db: Database session to (re)load the rules and store the desired lamp states
+            bus: Bus instance for message publishing
+            readings: Sensor ids (primary keys) and values
+        """
+        await self._ensure_loaded(db)
+        if not self.by_sensor:
+            return
+        now = time.monotonic()
+        node_lamps: dict[int, dict[int, int]] = {}
+        for sensor_id, value in readings:
+            for rule in self.by_sensor.get(sensor_id, ()):
+                lamp_value = rule.evaluate(value, now)
+                if lamp_value is None:
+                    continue
+                logger.info("Rule %s fired by sensor %s value %s: lamp %s of node %s -> %s",
+                            rule.id, sensor_id, value, rule.node_lamp_id, rule.node_id, lamp_value)
+                node_lamps.setdefault(rule.node_id, {})[rule.node_lamp_id] = lamp_value
+
+        for node_id, lamps in node_lamps.items():
+            await set_desired_lamps(db, node_id, lamps)
+            ws_message = WSMessage(
+                request_id=new_request_id(),
+                action=WSActions.set_lamps_state,
+                data={"lamps": [{"id": node_lamp_id, "value": value} for node_lamp_id, value in lamps.items()]},
+            )
+            await command_tracker.send(bus, node_id, ws_message, lamps=lamps)
+
+    def clear(self) -> None:
+        """ Reload the rules on the next reading """
+        self.loaded_at = None
+
+
+rule_engine = RuleEngine()
+
+
+@event.listens_for(models.Rule, "after_insert")
+@event.listens_for(models.Rule, "after_update")
+@event.listens_for(models.Rule, "after_delete")
+def reload_rules(mapper, connection, target):
+    """ Pick up rules changed by this worker with the next reading """
+    # pylint: disable=unused-argument
+    rule_engine.clear()
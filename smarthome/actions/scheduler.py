@@ -0,0 +1,310 @@
+"""
+Lamp schedules.
+
+Every worker keeps the active schedules (``models.Schedule``) in a heap ordered by
+the next fire time, so a fire costs O(log n) and the scheduler sleeps until the
+nearest one instead of scanning all schedules every tick. A fire is taken by one
+worker only: the worker that gets the broker lease named after the schedule and the
+fire time sends it. Leases of all schedules due together are taken in one broker round
+trip (see ``Bus.acquire_leases``). Lamps due at the same time are grouped by node and go
+out as ``set_lamps_state`` through the command tracker.
+
+Schedules are reloaded every ``scheduler_reload_interval`` seconds, changes made through
+the ORM of this worker are picked up at once. Other workers keep the old time until their
+reload, and the lease of the old time is a different one: a schedule moved within
+``scheduler_reload_interval`` of either time can fire at both. Fires missed while no
+worker was running are skipped.
+"""
+import asyncio
+import datetime
+import heapq
+import math
+import time
+from dataclasses import dataclass
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from smarthome import models
+from smarthome.actions.commands import command_tracker
+from smarthome.connectors.bus import Bus
+from smarthome.connectors.database import AsyncSessionLocal
+from smarthome.cruds.nodes import set_desired_lamps
+from smarthome.logger import logger
+from smarthome.schemas.ws import WSActions, WSMessage, new_request_id
+from smarthome.settings import settings
+
+SUN_EVENTS = ("sunrise", "sunset")
+
+
+def sun_time(day: datetime.date, latitude: float, longitude: float, sun_event: str) -> datetime.datetime | None:
+    """
+    Time of sunrise or sunset by the sunrise equation, accurate to a minute or two.
+
+    >>> sun_time(datetime.date(2024, 6, 21), 55.75, 37.62, "sunset").strftime("%H:%M")
+    '18:18'
+    >>> sun_time(datetime.date(2024, 6, 21), 80.0, 0.0, "sunset") is None
+    True
+
+    Args:
+        day: The date
+        latitude: Degrees, north is positive
+        longitude: Degrees, east is positive
+        sun_event: "sunrise" or "sunset"
+
+    Returns:
+        UTC time, None if the sun does not rise or set that day (polar day or night)
+    """
+    mean_solar_time = day.toordinal() - datetime.date(2000, 1, 1).toordinal() - longitude / 360
+    anomaly = math.radians((357.5291 + 0.98560028 * mean_solar_time) % 360)
+    center = 1.9148 * math.sin(anomaly) + 0.02 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic_longitude = math.radians((math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = 2451545.0 + mean_solar_time + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic_longitude)
+    declination = math.asin(math.sin(ecliptic_longitude) * math.sin(math.radians(23.4397)))
+    latitude = math.radians(latitude)
+    cos_hour_angle = (
+        (math.sin(math.radians(-0.833)) - math.sin(latitude) * math.sin(declination))
+        / (math.cos(latitude) * math.cos(declination))
+    )
+    if abs(cos_hour_angle) > 1:
+        return None
+    hour_angle = math.degrees(math.acos(cos_hour_angle))
+    julian_day = transit + (hour_angle if sun_event == "sunset" else -hour_angle) / 360
+    return datetime.datetime.fromtimestamp((julian_day - 2440587.5) * 86400, datetime.timezone.utc)
+
+
+@dataclass
+class ScheduleEntry:
+    """ A loaded schedule with its lamp address """
+    id: int
+    node_id: int
+    node_lamp_id: int
+    value: int
+    time_of_day: datetime.time | None = None
+    sun_event: str | None = None
+    offset_minutes: int = 0
+
+    def next_fire(
+        self, after: datetime.datetime, timezone: ZoneInfo, latitude: float, longitude: float,
+    ) -> datetime.datetime | None:
+        """
+        The first fire time later than the given one.
+
+        Args:
+            after: Aware datetime
+            timezone: Time zone of ``time_of_day`` and of the days
+            latitude: Degrees of the place for sunrise/sunset
+            longitude: Degrees of the place for sunrise/sunset
+
+        Returns:
+            Aware datetime, None if there is no fire within a week (polar day or night)
+        """
+        offset = datetime.timedelta(minutes=self.offset_minutes or 0)
+        today = after.astimezone(timezone).date()
+        # From yesterday: a negative offset can move a fire of the next day to this one
+        for days in range(-1, 8):
+            day = today + datetime.timedelta(days=days)
+            if self.time_of_day is not None:
+                fire_at = datetime.datetime.combine(day, self.time_of_day, tzinfo=timezone)
+            else:
+                fire_at = sun_time(day, latitude, longitude, self.sun_event)
+                if fire_at is None:
+                    continue
+            if fire_at + offset > after:
+                return fire_at + offset
+        return None
+
+
+class Scheduler:
+    """
+    Heap of the next fires of all active schedules with a background task.
+
+    Args:
+        reload_interval: Reload the schedules after this many seconds
+        lease_ttl: Seconds a fire stays leased to the worker that took it
+        timezone: Time zone of schedule times
+        latitude: Degrees of the place for sunrise/sunset
+        longitude: Degrees of the place for sunrise/sunset
+    """
+
+    def __init__(
+        self,
+        reload_interval: int = settings.scheduler_reload_interval,
+        lease_ttl: int = settings.scheduler_lease_ttl,
+        timezone: str = settings.scheduler_timezone,
+        latitude: float = settings.scheduler_latitude,
+        longitude: float = settings.scheduler_longitude,
+    ) -> None:
+        self.reload_interval: int = reload_interval
+        self.lease_ttl: int = lease_ttl
+        self.timezone: ZoneInfo = ZoneInfo(timezone)
+        self.latitude: float = latitude
+        self.longitude: float = longitude
+        self.entries: dict[int, ScheduleEntry] = {}
+        # Next fire (unix time) and schedule id
+        self.heap: list[tuple[float, int]] = []
+        self.loaded_at: float | None = None
+        # Fires up to this unix time are done, the next load starts after it
+        self.checked_until: float | None = None
+        self.fired: int = 0
+        self.bus: Bus | None = None
+        self.task: asyncio.Task | None = None
+        self._wakeup: asyncio.Event = asyncio.Event()
+
+    def next_fire(self, entry: ScheduleEntry, after: float) -> float | None:
+        """ The first fire time of the entry later than the unix time """
+        fire_at = entry.next_fire(
+            datetime.datetime.fromtimestamp(after, datetime.timezone.utc), self.timezone, self.latitude, self.longitude,
+        )
+        return fire_at.timestamp() if fire_at else None
+
+    async def load(self, db: AsyncSession) -> None:
+        """
+        Load active schedules from the database and build the heap.
+
+        Args:
+            db: Database session
+        """
+        db_schedules = await db.execute(
+            select(
+                models.Schedule.id,
+                models.NodeLamp.node_id,
+                models.NodeLamp.node_lamp_id,
+                models.Schedule.value,
+                models.Schedule.time_of_day,
+                models.Schedule.sun_event,
+                models.Schedule.offset_minutes,
+            )
+            .join(models.NodeLamp, models.NodeLamp.id == models.Schedule.lamp_id)
+            .where(models.Schedule.is_active.is_(True))
+        )
+        after = self.checked_until or time.time()
+        entries: dict[int, ScheduleEntry] = {}
+        heap: list[tuple[float, int]] = []
+        for schedule_id, node_id, node_lamp_id, value, time_of_day, sun_event, offset_minutes in db_schedules:
+            try:
+                entry = ScheduleEntry(
+                    schedule_id, node_id, node_lamp_id, value,
+                    time_of_day=datetime.time.fromisoformat(time_of_day) if time_of_day else None,
+                    sun_event=sun_event,
+                    offset_minutes=offset_minutes or 0,
+                )
+            except ValueError:
+                logger.error("Schedule %s has a wrong time: %s", schedule_id, time_of_day)
+                continue
+            if entry.time_of_day is None and entry.sun_event not in SUN_EVENTS:
+                logger.error("Schedule %s has neither a time nor a sun event", schedule_id)
+                continue
+            entries[schedule_id] = entry
+            fire_at = self.next_fire(entry, after)
+            if fire_at is not None:
+                heap.append((fire_at, schedule_id))
+        heapq.heapify(heap)
+        self.entries, self.heap = entries, heap
+        self.loaded_at = time.monotonic()
+        logger.debug("Schedules loaded: %s, next fire at %s", len(entries), heap[0][0] if heap else None)
+
+    async def fire_due(self, now: float) -> None:
+        """
+        Send the commands of all schedules due by the unix time.
+
+        Args:
+            now: Unix time
+        """
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            fire_at, schedule_id = heapq.heappop(self.heap)
+            entry = self.entries[schedule_id]
+            due.append((fire_at, entry))
+            next_fire_at = self.next_fire(entry, fire_at)
+            if next_fire_at is not None:
+                heapq.heappush(self.heap, (next_fire_at, schedule_id))
+        self.checked_until = now
+
+        node_lamps: dict[int, dict[int, int]] = {}
+        leases = await self.bus.acquire_leases(
+            [f"schedule-{entry.id}-{int(fire_at)}" for fire_at, entry in due], self.lease_ttl,
+        )
+        for (fire_at, entry), taken in zip(due, leases):
+            if not taken:
+                logger.debug("Schedule %s at %s is fired by another worker", entry.id, fire_at)
+                continue
+            logger.info("Schedule %s fired: lamp %s of node %s -> %s",
+                        entry.id, entry.node_lamp_id, entry.node_id, entry.value)
+            node_lamps.setdefault(entry.node_id, {})[entry.node_lamp_id] = entry.value
+            self.fired += 1
+
+        if node_lamps:
+            async with AsyncSessionLocal() as db:
+                for node_id, lamps in node_lamps.items():
+                    await set_desired_lamps(db, node_id, lamps)
+        for node_id, lamps in node_lamps.items():
+            ws_message = WSMessage(
+                request_id=new_request_id(),
+                action=WSActions.set_lamps_state,
+                data={"lamps": [{"id": node_lamp_id, "value": value} for node_lamp_id, value in lamps.items()]},
+            )
+            await command_tracker.send(self.bus, node_id, ws_message, lamps=lamps)
+
+    async def run(self) -> None:
+        """ Sleep until the nearest fire or reload """
+        while True:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.reload_interval:
+                try:
+                    async with AsyncSessionLocal() as db:
+                        await self.load(db)
+                except Exception as ex:  # pylint: disable=broad-exception-caught
+                    logger.exception("Failed to load schedules: %s", ex)
+                    self.loaded_at = time.monotonic()
+            timeout = self.reload_interval - (time.monotonic() - self.loaded_at)
+            if self.heap:
+                timeout = min(timeout, self.heap[0][0] - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.fire_due(time.time())
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                logger.exception("Failed to fire schedules: %s", ex)
+
+    async def start(self, bus: Bus) -> None:
+        """
+        Start the scheduler task.
+
+        Args:
+            bus: Bus instance for commands and leases
+        """
+        self.bus = bus
+        self.checked_until = time.time()
+        self.task = asyncio.create_task(self.run())
+        logger.info("Scheduler started")
+
+    async def stop(self) -> None:
+        """ Stop the scheduler task """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def reload(self) -> None:
+        """ Reload the schedules now """
+        self.loaded_at = None
+        self._wakeup.set()
+
+
+scheduler = Scheduler()
+
+
+@event.listens_for(models.Schedule, "after_insert")
+@event.listens_for(models.Schedule, "after_update")
+@event.listens_for(models.Schedule, "after_delete")
+def reload_schedules(mapper, connection, target):
+    """ Pick up schedules changed by this worker """
+    # pylint: disable=unused-argument
+    scheduler.reload()
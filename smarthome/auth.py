@@ -1,9 +1,9 @@
 from typing import Annotated, Union
 from fastapi import Cookie, Depends, HTTPException, Query, Response, status, WebSocketException
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from smarthome import cruds, models
-from smarthome.depends import get_db
+from smarthome.depends import get_async_db
 from smarthome.logger import logger
 
 
@@ -14,7 +14,7 @@ class AuthError(Exception):
 async def _get_current_user(
     session: Annotated[Union[str, None], Cookie()] = None,
     token: Annotated[Union[str, None], Query()] = None,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ) -> models.User:
     """ Get current user from token dependency """
     # TODO сделать универсальным, а не только для вебсокета
@@ -39,7 +39,7 @@ async def get_current_user(
     response: Response,
     session: Annotated[Union[str, None], Cookie()] = None,
     token: Annotated[Union[str, None], Query()] = None,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ) -> models.User:
     try:
         result = await _get_current_user(session, token, db)
@@ -55,7 +55,7 @@ async def get_current_user(
 async def get_current_user_for_ws(
     session: Annotated[Union[str, None], Cookie()] = None,
     token: Annotated[Union[str, None], Query()] = None,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ) -> models.User:
     """ Для вебсокета """
     try:
@@ -67,7 +67,7 @@ async def get_current_user_for_ws(
 
 async def get_current_node_for_ws(
     token: Annotated[Union[str, None], Query()] = None,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ) -> models.User:
     """ Get current node from token dependency """
     # TODO сделать универсальным, а не только для вебсокета
@@ -0,0 +1,287 @@
+"""
+In-process caches of rarely changing data used on the hot paths.
+
+Each worker keeps its own copy. Entries are dropped by SQLAlchemy mapper
+events when rows are created, changed or deleted through the ORM of this
+worker; a node connection always reloads the entry of the node, so changes
+made by other workers are picked up on the next reconnect.
+"""
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from smarthome import models
+from smarthome.connectors.bus import Bus
+from smarthome.logger import logger
+from smarthome.schemas.ws import WSActions
+from smarthome.settings import settings
+
+
+@dataclass
+class SensorFilter:
+    """
+    Decides which readings of a noisy sensor are worth storing and sending.
+
+    A reading is dropped when it comes sooner than ``min_interval`` seconds after
+    the last accepted one, or when it differs from it by no more than the deadband
+    (``deadband_abs`` or ``deadband_rel`` of the last value, the larger one).
+    A reading is always accepted after ``heartbeat_interval`` seconds, so a stable
+    value still shows that the sensor is alive.
+    """
+    deadband_abs: float | None = None
+    deadband_rel: float | None = None
+    min_interval: int | None = None
+    heartbeat_interval: int | None = None
+    last_value: float | None = None
+    last_accepted: float | None = None
+
+    def accept(self, value: Any, now: float | None = None) -> bool:
+        """
+        Check a reading and remember it if it is accepted.
+
+        >>> sensor_filter = SensorFilter(deadband_abs=0.5)
+        >>> [sensor_filter.accept(value, now=0) for value in (20.0, 20.3, 20.6)]
+        [True, False, True]
+
+        Args:
+            value: Sensor value
+            now: Monotonic time of the reading
+
+        Returns:
+            True if the reading should be stored and sent
+        """
+        now = time.monotonic() if now is None else now
+        if self.last_accepted is not None and self.last_value is not None and isinstance(value, (int, float)):
+            elapsed = now - self.last_accepted
+            if not self.heartbeat_interval or elapsed < self.heartbeat_interval:
+                if self.min_interval and elapsed < self.min_interval:
+                    return False
+                deadband = max(self.deadband_abs or 0, (self.deadband_rel or 0) * abs(self.last_value))
+                if deadband and abs(value - self.last_value) <= deadband:
+                    return False
+        self.last_value = value if isinstance(value, (int, float)) else None
+        self.last_accepted = now
+        return True
+
+
+@dataclass
+class NodeAddresses:
+    """
+    Node-local ids of lamps and sensors mapped to their primary keys,
+    and ingest filters of the sensors by primary key
+    """
+    lamps: dict[int, int] = field(default_factory=dict)
+    sensors: dict[int, int] = field(default_factory=dict)
+    sensor_filters: dict[int, SensorFilter] = field(default_factory=dict)
+
+
+class DeviceAddressCache:
+    """
+    Maps (node, node_lamp_id) and (node, node_sensor_id) to NodeLamp/NodeSensor ids.
+
+    Lets the node ingest path update rows by primary key without a lookup query
+    and filter sensor noise before any database work. Filters start from scratch
+    on reload, so the first reading after it is always accepted.
+    """
+
+    def __init__(self) -> None:
+        self.nodes: dict[int, NodeAddresses] = {}
+
+    async def load(self, db: AsyncSession, node_id: int) -> NodeAddresses:
+        """
+        Load (or reload) the addresses of a node.
+
+        Args:
+            db: Database session
+            node_id: Node ID
+
+        Returns:
+            Addresses of the node
+        """
+        db_lamps = await db.execute(
+            select(models.NodeLamp.node_lamp_id, models.NodeLamp.id).where(models.NodeLamp.node_id == node_id)
+        )
+        addresses = NodeAddresses(lamps=dict(db_lamps.tuples().all()))
+        db_sensors = await db.execute(
+            select(
+                models.NodeSensor.node_sensor_id,
+                models.NodeSensor.id,
+                models.NodeSensor.deadband_abs,
+                models.NodeSensor.deadband_rel,
+                models.NodeSensor.min_interval,
+                models.NodeSensor.heartbeat_interval,
+            ).where(models.NodeSensor.node_id == node_id, models.NodeSensor.formula.is_(None))
+        )
+        for node_sensor_id, sensor_id, deadband_abs, deadband_rel, min_interval, heartbeat_interval in db_sensors:
+            addresses.sensors[node_sensor_id] = sensor_id
+            addresses.sensor_filters[sensor_id] = SensorFilter(
+                deadband_abs=deadband_abs,
+                deadband_rel=deadband_rel,
+                min_interval=min_interval,
+                heartbeat_interval=heartbeat_interval,
+            )
+        self.nodes[node_id] = addresses
+        logger.debug("Device addresses of node %s loaded: %s", node_id, addresses)
+        return addresses
+
+    async def get(self, db: AsyncSession, node_id: int) -> NodeAddresses:
+        """
+        Addresses of a node, loaded on the first access.
+
+        Args:
+            db: Database session
+            node_id: Node ID
+
+        Returns:
+            Addresses of the node
+        """
+        addresses = self.nodes.get(node_id)
+        if addresses is None:
+            addresses = await self.load(db, node_id)
+        return addresses
+
+    def invalidate(self, node_id: int | None) -> None:
+        """
+        Forget the addresses of a node.
+
+        Args:
+            node_id: Node ID
+        """
+        self.nodes.pop(node_id, None)
+
+
+device_addresses = DeviceAddressCache()
+
+
+@event.listens_for(models.NodeLamp, "after_insert")
+@event.listens_for(models.NodeLamp, "after_update")
+@event.listens_for(models.NodeLamp, "after_delete")
+@event.listens_for(models.NodeSensor, "after_insert")
+@event.listens_for(models.NodeSensor, "after_update")
+@event.listens_for(models.NodeSensor, "after_delete")
+def invalidate_device_addresses(mapper, connection, target):
+    """
+    Drop cached addresses of the node when its lamps or sensors change.
+
+    Value updates go through bulk UPDATE statements and do not get here.
+    """
+    # pylint: disable=unused-argument
+    # A device moved to another node is dropped from both
+    for node_id in {target.node_id, *inspect(target).attrs.node_id.history.deleted}:
+        device_addresses.invalidate(node_id)
+
+
+# Worker-wide channel of access changes, every worker's AccessIndex listens to it
+ACCESS_CHANGES_BUS_ID = "access-changes"
+
+
+class AccessIndex:
+    """
+    Which users have access to which nodes, in both directions.
+
+    The whole ``user_nodes`` table is loaded with one query and reloaded every
+    ``access_index_ttl`` seconds. Changes made by ``cruds.add_user_node``/``delete_user_node``
+    are applied at once and published to the ``access-changes`` channel, the indexes
+    of all workers listen to it (see ``start``). The reload catches up on messages
+    lost by the broker.
+    """
+
+    def __init__(self, ttl: int = settings.access_index_ttl) -> None:
+        self.ttl: int = ttl
+        self.user_nodes: dict[int, set[int]] = {}
+        self.node_users: dict[int, set[int]] = {}
+        self.loaded_at: float | None = None
+
+    async def load(self, db: AsyncSession) -> None:
+        """
+        Load the index from the database.
+
+        Args:
+            db: Database session
+        """
+        user_nodes: dict[int, set[int]] = {}
+        node_users: dict[int, set[int]] = {}
+        for user_id, node_id in await db.execute(select(models.UserNode.user_id, models.UserNode.node_id)):
+            user_nodes.setdefault(user_id, set()).add(node_id)
+            node_users.setdefault(node_id, set()).add(user_id)
+        self.user_nodes, self.node_users = user_nodes, node_users
+        self.loaded_at = time.monotonic()
+        logger.debug("Access index loaded: %s users, %s nodes", len(user_nodes), len(node_users))
+
+    async def _ensure_loaded(self, db: AsyncSession) -> None:
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+            await self.load(db)
+
+    async def has_access(self, db: AsyncSession, user_id: int, node_id: int) -> bool:
+        """
+        Check that the user has access to the node.
+
+        Args:
+            db: Database session, used only to (re)load the index
+            user_id: User ID
+            node_id: Node ID
+        """
+        await self._ensure_loaded(db)
+        return node_id in self.user_nodes.get(user_id, ())
+
+    async def user_node_ids(self, db: AsyncSession, user_id: int) -> set[int]:
+        """
+        IDs of the nodes of the user.
+
+        Args:
+            db: Database session, used only to (re)load the index
+            user_id: User ID
+        """
+        await self._ensure_loaded(db)
+        return set(self.user_nodes.get(user_id, ()))
+
+    async def node_user_ids(self, db: AsyncSession, node_id: int) -> set[int]:
+        """
+        IDs of the users of the node.
+
+        Args:
+            db: Database session, used only to (re)load the index
+            node_id: Node ID
+        """
+        await self._ensure_loaded(db)
+        return set(self.node_users.get(node_id, ()))
+
+    def grant(self, user_id: int, node_id: int) -> None:
+        """ Apply a granted access """
+        self.user_nodes.setdefault(user_id, set()).add(node_id)
+        self.node_users.setdefault(node_id, set()).add(user_id)
+
+    def revoke(self, user_id: int, node_id: int) -> None:
+        """ Apply a revoked access """
+        self.user_nodes.get(user_id, set()).discard(node_id)
+        self.node_users.get(node_id, set()).discard(user_id)
+
+    def on_message(self, message: dict[str, Any]) -> None:
+        """ Apply an ``updated_access`` message from the ``access-changes`` channel """
+        data = message.get("data")
+        if message.get("action") != WSActions.updated_access or not isinstance(data, dict):
+            return
+        if data.get("granted"):
+            self.grant(data["user_id"], data["node_id"])
+        else:
+            self.revoke(data["user_id"], data["node_id"])
+
+    async def start(self, bus: Bus) -> None:
+        """
+        Listen to access changes made by all workers.
+
+        Args:
+            bus: Bus instance of the worker
+        """
+        await bus.add_handler(ACCESS_CHANGES_BUS_ID, self.on_message)
+
+    def clear(self) -> None:
+        """ Forget everything, the next check loads the index """
+        self.user_nodes, self.node_users = {}, {}
+        self.loaded_at = None
+
+
+access_index = AccessIndex()
@@ -1,21 +1,167 @@
 """
-Redis Broker Module for Smart Home System.
+Broker Module for Smart Home System.
 
-This module provides Redis-based publish/subscribe functionality for the smart home system,
+This module provides publish/subscribe backends for the smart home system,
 enabling asynchronous communication between different components through message channels.
 It handles connection management, message publishing, and channel subscriptions.
+
+Backends:
+    - ``redis``: Redis pub/sub, works across worker processes and hosts.
+    - ``redis-cluster``: Redis Cluster sharded pub/sub, channels are spread over the shards.
+    - ``memory``: asyncio queue inside the process, for single-worker setups and tests.
 """
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Iterable
 
 import redis.asyncio as aioredis
+from redis.asyncio.cluster import RedisCluster
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
 from smarthome.logger import logger
 from smarthome.settings import settings
 
 
-class RedisPubSubManager:
+class BaseBroker(ABC):
+    """
+    Publish/Subscribe backend interface used by the Bus.
+
+    One broker instance serves one worker: all channels share it
+    and all messages are read by a single ``listen`` loop.
+    """
+
+    @abstractmethod
+    async def connect(self) -> None:
+        """ Connects to the backend """
+
+    @abstractmethod
+    async def publish(self, channel: str, message: str) -> int:
+        """
+        Publishes a message to a channel.
+
+        Args:
+            channel (str): Channel to publish to.
+            message (str): Message to be published.
+
+        Returns:
+            int: Number of subscribers that received the message.
+        """
+
+    @abstractmethod
+    async def publish_many(self, channels: Iterable[str], message: str) -> None:
+        """
+        Publishes one message to several channels at once.
+
+        Args:
+            channels (Iterable[str]): Channels to publish to.
+            message (str): Message to be published.
+        """
+
+    @abstractmethod
+    async def subscribe(self, channel: str) -> None:
+        """
+        Subscribes to a channel.
+
+        Args:
+            channel (str): Channel to subscribe to.
+        """
+
+    @abstractmethod
+    async def unsubscribe(self, bus_id: str) -> None:
+        """
+        Unsubscribes from a channel.
+
+        Args:
+            bus_id (str): Channel to unsubscribe from.
+        """
+
+    @abstractmethod
+    def listen(self) -> AsyncIterator[tuple[str, bytes]]:
+        """
+        Yields messages from all subscribed channels.
+
+        Yields:
+            tuple[str, bytes]: Channel name and raw message data.
+        """
+
+    @abstractmethod
+    async def stream_add(self, stream: str, message: str, maxlen: int) -> str:
+        """
+        Appends a message to a durable stream.
+
+        Args:
+            stream (str): Stream name.
+            message (str): Message to be stored.
+            maxlen (int): Approximate stream length limit, older entries are trimmed.
+
+        Returns:
+            str: Entry ID in Redis Streams format (``<ms>-<seq>``).
+        """
+
+    @abstractmethod
+    async def stream_range(self, stream: str, after_id: str | None) -> list[tuple[str, str]]:
+        """
+        Reads stream entries newer than the given ID.
+
+        Args:
+            stream (str): Stream name.
+            after_id (str | None): Last consumed entry ID, None to read from the start.
+
+        Returns:
+            list[tuple[str, str]]: Entry IDs and messages in stream order.
+        """
+
+    @abstractmethod
+    async def get_stream_offset(self, stream: str) -> str | None:
+        """
+        Returns the last consumed entry ID of a stream.
+
+        Args:
+            stream (str): Stream name.
+        """
+
+    @abstractmethod
+    async def set_stream_offset(self, stream: str, entry_id: str) -> None:
+        """
+        Stores the last consumed entry ID of a stream.
+
+        Args:
+            stream (str): Stream name.
+            entry_id (str): Consumed entry ID.
+        """
+
+    @abstractmethod
+    async def acquire_leases(self, keys: list[str], ttl: int) -> list[bool]:
+        """
+        Takes leases shared by all workers in one round trip, the first caller of each wins.
+
+        Args:
+            keys (list[str]): Lease names.
+            ttl (int): Seconds until the leases expire.
+
+        Returns:
+            list[bool]: For each key, True if the lease is taken by this call.
+        """
+
+    @abstractmethod
+    def stats(self) -> dict[str, int | str | None]:
+        """
+        Returns backend usage counters for monitoring.
+
+        Returns:
+            dict: Counters, see ``schemas.BrokerStatus``.
+        """
+
+
+class RedisPubSubManager(BaseBroker):
     """
     Redis Publish/Subscribe Manager for handling message communication.
     
     This class manages Redis pub/sub connections for asynchronous messaging.
+    Commands and the pubsub connection use a bounded connection pool with
+    health checks and redis-py retries with exponential backoff, the pubsub
+    subscribes to all active channels again when it reconnects.
 
     Args:
         host (str): Redis server host.
@@ -28,19 +174,46 @@ class RedisPubSubManager:
         self.redis_port: int = port
         self.pubsub: aioredis.client.PubSub | None = None
         self.redis_connection: aioredis.Redis | None = None
+        self.connection_pool: aioredis.ConnectionPool | None = None
+        self.channels: set[str] = set()
+        self.reconnects: int = 0
+
+    @staticmethod
+    def _connection_kwargs() -> dict:
+        """
+        Connection options shared by all Redis connections of the broker.
+
+        Returns:
+            dict: Keyword arguments for a connection pool or a cluster client.
+        """
+        return {
+            # "password": "my-password",
+            "max_connections": settings.redis_max_connections,
+            "socket_timeout": settings.redis_socket_timeout,
+            "socket_connect_timeout": settings.redis_socket_connect_timeout,
+            "socket_keepalive": True,
+            "health_check_interval": settings.redis_health_check_interval,
+            "retry": Retry(
+                ExponentialBackoff(cap=settings.redis_reconnect_max_delay, base=settings.redis_reconnect_min_delay),
+                retries=settings.redis_retries,
+            ),
+            "retry_on_error": [aioredis.ConnectionError, aioredis.TimeoutError],
+        }
 
     async def _get_redis_connection(self) -> aioredis.Redis:
         """
-        Establishes a connection to Redis.
+        Creates the connection pool and a Redis client on top of it.
 
         Returns:
             aioredis.Redis: Redis connection object.
         """
         logger.debug("Getting Redis connection")
-        return aioredis.Redis(host=self.redis_host,
-                              port=self.redis_port,
-                              # password="my-password",
-                              auto_close_connection_pool=False)
+        self.connection_pool = aioredis.ConnectionPool(
+            host=self.redis_host,
+            port=self.redis_port,
+            **self._connection_kwargs(),
+        )
+        return aioredis.Redis(connection_pool=self.connection_pool)
 
     async def connect(self) -> None:
         """
@@ -52,34 +225,53 @@ class RedisPubSubManager:
         logger.debug("Start connecting to Redis server")
         self.redis_connection = await self._get_redis_connection()
         self.pubsub = self.redis_connection.pubsub()
-        # TODO сделать 1 коннект, а не каждый раз
         logger.debug("self.redis_connection: %s", self.redis_connection)
         logger.info("Redis server connected")
 
-    async def publish(self, channel: str, message: str) -> None:
+    async def publish(self, channel: str, message: str) -> int:
         """
         Publishes a message to a specific Redis channel.
 
         Args:
             channel (str): Channel to publish to.
             message (str): Message to be published.
-            
+
+        Returns:
+            int: Number of subscribers that received the message.
+
         Raises:
             aioredis.RedisError: If publishing fails.
         """
         logger.debug("Publishing to Redis channel %s message: %s", channel, message)
-        await self.redis_connection.publish(channel, message)
+        return await self.redis_connection.publish(channel, message)
+
+    async def publish_many(self, channels: Iterable[str], message: str) -> None:
+        """
+        Publishes one message to several Redis channels in a single pipeline round trip.
+
+        Args:
+            channels (Iterable[str]): Channels to publish to.
+            message (str): Message to be published.
+
+        Raises:
+            aioredis.RedisError: If publishing fails.
+        """
+        async with self.redis_connection.pipeline(transaction=False) as pipe:
+            for channel in channels:
+                logger.debug("Publishing to Redis channel %s message: %s", channel, message)
+                pipe.publish(channel, message)
+            await pipe.execute()
 
-    async def subscribe(self, channel: str) -> aioredis.client.PubSub:
+    async def subscribe(self, channel: str) -> None:
         """
         Subscribes to a Redis channel.
 
+        All channels share the single pubsub connection of this manager,
+        messages from them are read by ``listen``.
+
         Args:
             channel (str): Channel to subscribe to.
 
-        Returns:
-            aioredis.client.PubSub: PubSub object for the subscribed channel.
-            
         Raises:
             aioredis.RedisError: If subscription fails.
         """
@@ -89,8 +281,8 @@ class RedisPubSubManager:
         except aioredis.RedisError as e:
             logger.exception("Failed to subscribe to Redis channel: %s", channel)
             raise e
+        self.channels.add(channel)
         logger.info("Subscribing to Redis channel: %s done", channel)
-        return self.pubsub
 
     async def unsubscribe(self, bus_id: str) -> None:
         """
@@ -103,5 +295,654 @@ class RedisPubSubManager:
             aioredis.RedisError: If unsubscribing fails.
         """
         logger.debug("Unsubscribing from Redis channel: %s start", bus_id)
-        await self.pubsub.unsubscribe(bus_id)
+        self.channels.discard(bus_id)
+        try:
+            await self.pubsub.unsubscribe(bus_id)
+        except aioredis.ConnectionError:
+            # The channel is already forgotten and will not be restored on reconnect
+            logger.warning("Redis is not available, channel %s is dropped without UNSUBSCRIBE", bus_id)
+            return
         logger.info("Unsubscribing from Redis channel: %s done", bus_id)
+
+    async def listen(self) -> AsyncIterator[tuple[str, bytes]]:
+        """
+        Yields messages from all subscribed channels.
+
+        The read blocks on the pubsub socket until Redis pushes a message,
+        so there is no polling. It wakes up every ``redis_health_check_interval``
+        seconds to let the connection send a health check PING.
+        A lost connection is restored by redis-py: the read is retried with
+        exponential backoff and the pubsub subscribes to all active channels
+        again in ``on_connect``. When the retries are exhausted the error is
+        logged and the next read starts a new round of retries.
+        Must be started after the first ``subscribe``.
+
+        Yields:
+            tuple[str, bytes]: Channel name and raw message data.
+        """
+        failed = False
+        while True:
+            try:
+                message = await self.pubsub.get_message(
+                    ignore_subscribe_messages=True,
+                    timeout=settings.redis_health_check_interval,
+                )
+            except (aioredis.ConnectionError, aioredis.TimeoutError, OSError) as ex:
+                failed = True
+                logger.error("Redis pubsub connection lost: %s. Retry in %s s", ex, settings.redis_reconnect_max_delay)
+                await asyncio.sleep(settings.redis_reconnect_max_delay)
+                continue
+
+            if failed:
+                failed = False
+                self.reconnects += 1
+                logger.info("Redis pubsub restored with %s channels", len(self.channels))
+            if message is None:
+                continue
+            yield message["channel"].decode("utf-8"), message["data"]
+
+    async def stream_add(self, stream: str, message: str, maxlen: int) -> str:
+        """
+        Appends a message to a Redis stream (XADD with approximate MAXLEN).
+
+        Args:
+            stream (str): Stream name.
+            message (str): Message to be stored.
+            maxlen (int): Approximate stream length limit.
+
+        Returns:
+            str: Entry ID.
+        """
+        entry_id = await self.redis_connection.xadd(stream, {"message": message}, maxlen=maxlen, approximate=True)
+        return entry_id.decode("utf-8")
+
+    async def stream_range(self, stream: str, after_id: str | None) -> list[tuple[str, str]]:
+        """
+        Reads Redis stream entries newer than the given ID (exclusive XRANGE).
+
+        Args:
+            stream (str): Stream name.
+            after_id (str | None): Last consumed entry ID, None to read from the start.
+
+        Returns:
+            list[tuple[str, str]]: Entry IDs and messages in stream order.
+        """
+        entries = await self.redis_connection.xrange(stream, min=f"({after_id}" if after_id else "-", max="+")
+        return [(entry_id.decode("utf-8"), fields[b"message"].decode("utf-8")) for entry_id, fields in entries]
+
+    async def get_stream_offset(self, stream: str) -> str | None:
+        """
+        Returns the last consumed entry ID of a stream.
+
+        Args:
+            stream (str): Stream name.
+        """
+        entry_id = await self.redis_connection.get(f"{stream}:offset")
+        return entry_id.decode("utf-8") if entry_id else None
+
+    async def set_stream_offset(self, stream: str, entry_id: str) -> None:
+        """
+        Stores the last consumed entry ID of a stream.
+
+        Args:
+            stream (str): Stream name.
+            entry_id (str): Consumed entry ID.
+        """
+        await self.redis_connection.set(f"{stream}:offset", entry_id)
+
+    async def acquire_leases(self, keys: list[str], ttl: int) -> list[bool]:
+        """
+        Takes leases with pipelined SET NX EX, one round trip (per cluster node).
+
+        Args:
+            keys (list[str]): Lease names.
+            ttl (int): Seconds until the leases expire.
+
+        Returns:
+            list[bool]: For each key, True if the lease is taken by this call.
+        """
+        if not keys:
+            return []
+        async with self.redis_connection.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.set(f"lease:{key}", "1", nx=True, ex=ttl)
+            return [bool(taken) for taken in await pipe.execute()]
+
+    def stats(self) -> dict[str, int | str | None]:
+        """
+        Returns connection pool usage and reconnect counters.
+
+        Returns:
+            dict: Counters, see ``schemas.BrokerStatus``.
+        """
+        pool = self.connection_pool
+        # Not a public API of redis-py, the counters are omitted if the pool has no such attributes
+        in_use = getattr(pool, "_in_use_connections", None)
+        available = getattr(pool, "_available_connections", None)
+        return {
+            "backend": "redis",
+            "channels": len(self.channels),
+            "reconnects": self.reconnects,
+            "pool_max_connections": pool.max_connections if pool else None,
+            "pool_created_connections": (
+                len(in_use) + len(available) if in_use is not None and available is not None else None
+            ),
+            "pool_in_use_connections": len(in_use) if in_use is not None else None,
+            "pool_available_connections": len(available) if available is not None else None,
+        }
+
+
+class ShardedPubSub(aioredis.client.PubSub):
+    """
+    PubSub connection to one cluster node with sharded channels (SSUBSCRIBE).
+
+    The asyncio client of redis-py has no sharded pubsub, but the base class
+    parses ``smessage``/``sunsubscribe`` replies like the classic ones once
+    their types are registered. Sharded channels of one connection must live
+    on the same node, so the manager keeps a connection per node.
+    """
+    PUBLISH_MESSAGE_TYPES = ("message", "pmessage", "smessage")
+    UNSUBSCRIBE_MESSAGE_TYPES = ("unsubscribe", "punsubscribe", "sunsubscribe")
+
+    async def on_connect(self, connection) -> None:
+        """ Re-subscribe to the sharded channels after a reconnect """
+        self.pending_unsubscribe_channels.clear()
+        for channel in list(self.channels):
+            # One command per channel: channels of a command must share the slot
+            await self.ssubscribe(self.encoder.decode(channel, force=True))
+
+    async def ssubscribe(self, channel: str) -> None:
+        """
+        Subscribes to a sharded channel.
+
+        Args:
+            channel (str): Channel to subscribe to.
+        """
+        await self.execute_command("SSUBSCRIBE", channel)
+        new_channels = self._normalize_keys({channel: None})
+        self.channels.update(new_channels)
+        self.pending_unsubscribe_channels.difference_update(new_channels)
+
+    async def sunsubscribe(self, channel: str) -> None:
+        """
+        Unsubscribes from a sharded channel.
+
+        Args:
+            channel (str): Channel to unsubscribe from.
+        """
+        self.pending_unsubscribe_channels.update(self._normalize_keys({channel: None}))
+        await self.execute_command("SUNSUBSCRIBE", channel)
+
+
+class RedisClusterPubSubManager(RedisPubSubManager):
+    """
+    Redis Cluster sharded Publish/Subscribe Manager.
+
+    Channels are published with SPUBLISH and routed to shards by the key slot
+    of the channel name, so ``node-*`` and ``user-*`` traffic is spread over
+    the cluster instead of being carried by one Redis core. Every node with
+    subscribed channels gets its own pubsub connection and reader task, the
+    readers feed one queue consumed by ``listen``.
+
+    When a connection is lost or a slot moves to another node (the node sends
+    ``sunsubscribe`` by itself), the cluster topology is reloaded and all
+    channels are subscribed again on their current nodes. Replies to our own
+    SUNSUBSCRIBE are counted per channel and ignored, so a channel subscribed
+    again before the reply comes is not taken for a moved one.
+
+    Args:
+        host (str): Host of any cluster node.
+        port (int): Port of any cluster node.
+    """
+
+    def __init__(self, host: str = settings.redis_host, port: int = settings.redis_port) -> None:
+        super().__init__(host, port)
+        self.cluster: RedisCluster | None = None
+        # Node name -> pubsub connection and its reader
+        self.shards: dict[str, ShardedPubSub] = {}
+        self.shard_readers: dict[str, asyncio.Task] = {}
+        # Channel -> node name
+        self.channel_shards: dict[str, str] = {}
+        # Channel -> number of our SUNSUBSCRIBE replies still to come
+        self.pending_sunsubscribes: dict[str, int] = {}
+        self.messages: asyncio.Queue[tuple[str, bytes]] = asyncio.Queue()
+        self._reroute_lock: asyncio.Lock = asyncio.Lock()
+
+    async def connect(self) -> None:
+        """
+        Connects to the cluster and loads its slots map.
+
+        Raises:
+            aioredis.RedisError: If connection to the cluster fails.
+        """
+        logger.debug("Start connecting to Redis cluster")
+        self.cluster = RedisCluster(host=self.redis_host, port=self.redis_port, **self._connection_kwargs())
+        await self.cluster.initialize()
+        # Streams and offsets are plain keys, the cluster client routes them
+        self.redis_connection = self.cluster
+        logger.info("Redis cluster connected: %s nodes", len(self.cluster.get_nodes()))
+
+    async def publish(self, channel: str, message: str) -> int:
+        """
+        Publishes a message to the shard of the channel (SPUBLISH).
+
+        Args:
+            channel (str): Channel to publish to.
+            message (str): Message to be published.
+
+        Returns:
+            int: Number of subscribers that received the message.
+        """
+        logger.debug("Publishing to Redis shard channel %s message: %s", channel, message)
+        # redis-py has no cluster spublish, the raw command is routed by the slot of the channel
+        return await self.cluster.execute_command("SPUBLISH", channel, message)
+
+    async def publish_many(self, channels: Iterable[str], message: str) -> None:
+        """
+        Publishes one message to several channels, one pipeline round trip per shard.
+
+        The cluster pipeline groups the commands by the node that owns the slot of the channel.
+
+        Args:
+            channels (Iterable[str]): Channels to publish to.
+            message (str): Message to be published.
+        """
+        async with self.cluster.pipeline() as pipe:
+            for channel in channels:
+                logger.debug("Publishing to Redis shard channel %s message: %s", channel, message)
+                pipe.execute_command("SPUBLISH", channel, message)
+            await pipe.execute()
+
+    async def subscribe(self, channel: str) -> None:
+        """
+        Subscribes to a channel on the node that owns its slot.
+
+        Args:
+            channel (str): Channel to subscribe to.
+
+        Raises:
+            aioredis.RedisError: If subscription fails.
+        """
+        logger.debug("Subscribing to Redis shard channel: %s start", channel)
+        try:
+            await self._ssubscribe(channel)
+        except aioredis.RedisError as e:
+            logger.exception("Failed to subscribe to Redis shard channel: %s", channel)
+            raise e
+        self.channels.add(channel)
+        logger.info("Subscribing to Redis shard channel: %s done", channel)
+
+    async def unsubscribe(self, bus_id: str) -> None:
+        """
+        Unsubscribes from a channel.
+
+        Args:
+            bus_id (str): Channel to unsubscribe from.
+        """
+        logger.debug("Unsubscribing from Redis shard channel: %s start", bus_id)
+        self.channels.discard(bus_id)
+        pubsub = self.shards.get(self.channel_shards.pop(bus_id, ""))
+        if pubsub is None:
+            return
+        self.pending_sunsubscribes[bus_id] = self.pending_sunsubscribes.get(bus_id, 0) + 1
+        try:
+            await pubsub.sunsubscribe(bus_id)
+        except aioredis.ConnectionError:
+            self._forget_sunsubscribe(bus_id)
+            logger.warning("Redis shard is not available, channel %s is dropped without SUNSUBSCRIBE", bus_id)
+            return
+        logger.info("Unsubscribing from Redis shard channel: %s done", bus_id)
+
+    async def listen(self) -> AsyncIterator[tuple[str, bytes]]:
+        """
+        Yields messages from all subscribed channels of all shards.
+
+        Yields:
+            tuple[str, bytes]: Channel name and raw message data.
+        """
+        while True:
+            yield await self.messages.get()
+
+    async def _ssubscribe(self, channel: str) -> None:
+        """
+        Subscribes to a channel on its current node, opening the node connection if needed.
+
+        Args:
+            channel (str): Channel to subscribe to.
+        """
+        node = self.cluster.get_node_from_key(channel)
+        pubsub = self.shards.get(node.name)
+        if pubsub is None:
+            pubsub = ShardedPubSub(
+                connection_pool=aioredis.ConnectionPool(host=node.host, port=node.port, **self._connection_kwargs()),
+            )
+            self.shards[node.name] = pubsub
+        await pubsub.ssubscribe(channel)
+        self.channel_shards[channel] = node.name
+        reader = self.shard_readers.get(node.name)
+        if reader is None or reader.done():
+            self.shard_readers[node.name] = asyncio.create_task(self._read_shard(node.name, pubsub))
+
+    async def _read_shard(self, name: str, pubsub: ShardedPubSub) -> None:
+        """
+        Reads messages of one node into the common queue.
+
+        Stops when the connection is replaced by ``_resubscribe``.
+
+        Args:
+            name (str): Node name.
+            pubsub (ShardedPubSub): Pubsub connection of the node.
+        """
+        attempt = 0
+        while self.shards.get(name) is pubsub:
+            try:
+                message = await pubsub.get_message(timeout=settings.redis_health_check_interval)
+            except (aioredis.ConnectionError, aioredis.TimeoutError, OSError) as ex:
+                if self.shards.get(name) is not pubsub:
+                    return
+                delay = min(settings.redis_reconnect_min_delay * 2 ** attempt, settings.redis_reconnect_max_delay)
+                attempt += 1
+                logger.error("Redis shard %s connection lost: %s. Reconnect #%s in %s s", name, ex, attempt, delay)
+                await asyncio.sleep(delay)
+                await self._resubscribe(pubsub)
+                continue
+
+            attempt = 0
+            if message is None:
+                continue
+            channel = message["channel"].decode("utf-8")
+            if message["type"] == "smessage":
+                self.messages.put_nowait((channel, message["data"]))
+            elif message["type"] == "sunsubscribe":
+                if self._forget_sunsubscribe(channel):
+                    # The reply to our SUNSUBSCRIBE, the channel may be subscribed again already
+                    continue
+                if self.channel_shards.get(channel) == name:
+                    # Not requested by us: the slot has moved to another node
+                    logger.warning("Redis shard channel %s moved from %s", channel, name)
+                    await self._resubscribe(pubsub)
+
+    def _forget_sunsubscribe(self, channel: str) -> bool:
+        """
+        Counts off one requested SUNSUBSCRIBE of the channel.
+
+        Returns:
+            bool: True if there was one.
+        """
+        pending = self.pending_sunsubscribes.get(channel, 0)
+        if pending <= 1:
+            self.pending_sunsubscribes.pop(channel, None)
+        else:
+            self.pending_sunsubscribes[channel] = pending - 1
+        return pending > 0
+
+    async def _resubscribe(self, failed: ShardedPubSub | None = None) -> None:
+        """
+        Reloads the cluster topology and subscribes all channels on their current nodes.
+
+        Retries with exponential backoff until the cluster is available.
+
+        Args:
+            failed (ShardedPubSub | None): The connection that has failed, nothing is done
+                if it was already replaced by a concurrent call.
+        """
+        async with self._reroute_lock:
+            if failed is not None and failed not in self.shards.values():
+                return
+            old_shards = self.shards
+            self.shards = {}
+            self.channel_shards = {}
+            # Replies of the closed connections never come
+            self.pending_sunsubscribes = {}
+            for pubsub in old_shards.values():
+                try:
+                    await pubsub.aclose()
+                    await pubsub.connection_pool.disconnect()
+                except (aioredis.RedisError, OSError):
+                    logger.debug("Failed to close old shard pubsub connection")
+            attempt = 0
+            while True:
+                try:
+                    await self.cluster.nodes_manager.initialize()
+                    for channel in list(self.channels):
+                        await self._ssubscribe(channel)
+                    break
+                except (aioredis.RedisError, OSError) as ex:
+                    # No reader is left to retry, so keep trying here
+                    delay = min(settings.redis_reconnect_min_delay * 2 ** attempt, settings.redis_reconnect_max_delay)
+                    attempt += 1
+                    logger.error("Failed to restore Redis shard pubsub: %s. Retry #%s in %s s", ex, attempt, delay)
+                    await asyncio.sleep(delay)
+            self.reconnects += 1
+            logger.info(
+                "Redis shard pubsub restored with %s channels on %s nodes", len(self.channels), len(self.shards),
+            )
+
+    def stats(self) -> dict[str, int | str | None]:
+        """
+        Returns shard and reconnect counters.
+
+        Returns:
+            dict: Counters, see ``schemas.BrokerStatus``.
+        """
+        return {
+            "backend": "redis-cluster",
+            "channels": len(self.channels),
+            "reconnects": self.reconnects,
+            "shards": len(self.shards),
+        }
+
+
+class InMemoryPubSubManager(BaseBroker):
+    """
+    In-process Publish/Subscribe Manager based on an asyncio queue.
+
+    Messages never leave the process, so it fits a single-worker deployment
+    (sender and receiver share the process) and tests without Redis.
+    """
+
+    def __init__(self) -> None:
+        logger.info("Initializing InMemoryPubSubManager")
+        self.channels: set[str] = set()
+        self.queue: asyncio.Queue[tuple[str, bytes]] = asyncio.Queue()
+        self.streams: dict[str, list[tuple[str, str]]] = {}
+        self.stream_offsets: dict[str, str] = {}
+        self.leases: dict[str, float] = {}
+        self._leases_limit: int = 1024
+        self._last_entry_id: tuple[int, int] = (0, 0)
+
+    async def connect(self) -> None:
+        """ Nothing to connect to """
+        logger.info("In-memory broker connected")
+
+    async def publish(self, channel: str, message: str) -> int:
+        """
+        Puts a message to the queue if somebody listens to the channel.
+
+        Args:
+            channel (str): Channel to publish to.
+            message (str): Message to be published.
+
+        Returns:
+            int: 1 if the channel is subscribed, otherwise 0.
+        """
+        logger.debug("Publishing to memory channel %s message: %s", channel, message)
+        if channel not in self.channels:
+            return 0
+        self.queue.put_nowait((channel, message.encode("utf-8")))
+        return 1
+
+    async def publish_many(self, channels: Iterable[str], message: str) -> None:
+        """
+        Puts one message to the queue for every subscribed channel.
+
+        Args:
+            channels (Iterable[str]): Channels to publish to.
+            message (str): Message to be published.
+        """
+        data = message.encode("utf-8")
+        for channel in channels:
+            if channel in self.channels:
+                self.queue.put_nowait((channel, data))
+
+    async def subscribe(self, channel: str) -> None:
+        """
+        Subscribes to a channel.
+
+        Args:
+            channel (str): Channel to subscribe to.
+        """
+        self.channels.add(channel)
+        logger.info("Subscribing to memory channel: %s done", channel)
+
+    async def unsubscribe(self, bus_id: str) -> None:
+        """
+        Unsubscribes from a channel.
+
+        Args:
+            bus_id (str): Channel to unsubscribe from.
+        """
+        self.channels.discard(bus_id)
+        logger.info("Unsubscribing from memory channel: %s done", bus_id)
+
+    async def listen(self) -> AsyncIterator[tuple[str, bytes]]:
+        """
+        Yields messages from all subscribed channels.
+
+        Yields:
+            tuple[str, bytes]: Channel name and raw message data.
+        """
+        while True:
+            channel, data = await self.queue.get()
+            # The channel could be unsubscribed while the message was waiting
+            if channel in self.channels:
+                yield channel, data
+
+    async def stream_add(self, stream: str, message: str, maxlen: int) -> str:
+        """
+        Appends a message to an in-memory stream.
+
+        Args:
+            stream (str): Stream name.
+            message (str): Message to be stored.
+            maxlen (int): Stream length limit.
+
+        Returns:
+            str: Entry ID in Redis Streams format.
+        """
+        milliseconds = int(time.time() * 1000)
+        last_milliseconds, last_sequence = self._last_entry_id
+        if milliseconds <= last_milliseconds:
+            self._last_entry_id = (last_milliseconds, last_sequence + 1)
+        else:
+            self._last_entry_id = (milliseconds, 0)
+        entry_id = "%d-%d" % self._last_entry_id
+        entries = self.streams.setdefault(stream, [])
+        entries.append((entry_id, message))
+        del entries[:-maxlen]
+        return entry_id
+
+    async def stream_range(self, stream: str, after_id: str | None) -> list[tuple[str, str]]:
+        """
+        Reads in-memory stream entries newer than the given ID.
+
+        Args:
+            stream (str): Stream name.
+            after_id (str | None): Last consumed entry ID, None to read from the start.
+
+        Returns:
+            list[tuple[str, str]]: Entry IDs and messages in stream order.
+        """
+        entries = self.streams.get(stream, [])
+        if after_id is None:
+            return list(entries)
+        after = stream_entry_key(after_id)
+        return [(entry_id, message) for entry_id, message in entries if stream_entry_key(entry_id) > after]
+
+    async def get_stream_offset(self, stream: str) -> str | None:
+        """
+        Returns the last consumed entry ID of a stream.
+
+        Args:
+            stream (str): Stream name.
+        """
+        return self.stream_offsets.get(stream)
+
+    async def set_stream_offset(self, stream: str, entry_id: str) -> None:
+        """
+        Stores the last consumed entry ID of a stream.
+
+        Args:
+            stream (str): Stream name.
+            entry_id (str): Consumed entry ID.
+        """
+        self.stream_offsets[stream] = entry_id
+
+    async def acquire_leases(self, keys: list[str], ttl: int) -> list[bool]:
+        """
+        Takes in-process leases.
+
+        Args:
+            keys (list[str]): Lease names.
+            ttl (int): Seconds until the leases expire.
+
+        Returns:
+            list[bool]: For each key, True if the lease is taken by this call.
+        """
+        now = time.monotonic()
+        taken = []
+        for key in keys:
+            if self.leases.get(key, 0) > now:
+                taken.append(False)
+                continue
+            self.leases[key] = now + ttl
+            taken.append(True)
+        # Forget expired leases when the dict doubles, amortized O(1) per lease
+        if len(self.leases) > self._leases_limit:
+            self.leases = {name: expires_at for name, expires_at in self.leases.items() if expires_at > now}
+            self._leases_limit = max(1024, 2 * len(self.leases))
+        return taken
+
+    def stats(self) -> dict[str, int | str | None]:
+        """
+        Returns channel counters.
+
+        Returns:
+            dict: Counters, see ``schemas.BrokerStatus``.
+        """
+        return {
+            "backend": "memory",
+            "channels": len(self.channels),
+            "reconnects": 0,
+        }
+
+
+def stream_entry_key(entry_id: str) -> tuple[int, int]:
+    """
+    Converts a stream entry ID to a comparable tuple.
+
+    >>> stream_entry_key("1700000000000-2") < stream_entry_key("1700000000000-10")
+    True
+
+    Args:
+        entry_id (str): Entry ID in ``<ms>-<seq>`` format.
+
+    Returns:
+        tuple[int, int]: Milliseconds and sequence number.
+    """
+    milliseconds, _, sequence = entry_id.partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+def get_broker() -> BaseBroker:
+    """
+    Creates the broker selected by ``settings.bus_backend``.
+
+    Returns:
+        BaseBroker: Broker instance.
+    """
+    if settings.bus_backend == "memory":
+        return InMemoryPubSubManager()
+    if settings.bus_backend == "redis-cluster":
+        return RedisClusterPubSubManager()
+    return RedisPubSubManager()
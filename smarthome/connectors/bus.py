@@ -1,159 +1,819 @@
 """
 Bus Module for Smart Home System.
 
-This module provides a message bus implementation using Redis pub/sub for communication
+This module provides a message bus implementation on top of a pub/sub broker
+(Redis or in-memory, see ``smarthome.connectors.broker``) for communication
 between different components of the smart home system. It handles WebSocket connections,
 message broadcasting, and subscription management.
+
+Every worker process holds one Bus with one pubsub reader. The reader routes each
+message by its channel (``bus_id``) to the local subscribers of that channel only.
+A subscriber can listen to several channels (topics), e.g. a user listens to its own
+channel and to the event topics of its nodes. Components of the worker without a socket
+(e.g. the command tracker) listen to a channel with a handler, see ``Bus.add_handler``.
+Each subscriber has a bounded outbound queue and its own writer task, so a slow
+socket never blocks the reader or other subscribers. Browser subscribers can
+conflate lamp and sensor updates: within a window only the latest value per
+object is kept and the window is sent as one ``updated_values`` frame.
+
+Messages travel through the broker with the publish time as the last key of the
+JSON object (``"published_at"``), so any JSON consumer can read them. It is cut off
+before the JSON goes to the socket and is used to measure the publish-to-send lag,
+see ``BusMetrics``.
 """
 
 import asyncio
 import json
+import re
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Any, Callable, Iterable
+
+from fastapi import status
+from pydantic import ValidationError
 from starlette.websockets import WebSocket, WebSocketState
 
 from smarthome.logger import logger
-from smarthome.connectors.broker import RedisPubSubManager
-from smarthome.schemas.ws import WSMessage
+from smarthome.metrics import Histogram, RateMeter
+from smarthome.connectors.codecs import JSONCodec
+from smarthome.connectors.broker import BaseBroker, get_broker, stream_entry_key
+from smarthome.schemas.ws import WSActions, WSMessage, new_request_id
+from smarthome.settings import settings
+
+
+# Updates that can be conflated and the key of their list in the ``updated_values`` frame
+CONFLATED_ACTIONS: dict[str, str] = {
+    WSActions.updated_lamp.value: "lamps",
+    WSActions.updated_sensor.value: "sensors",
+}
+
+
+PUBLISHED_AT = b',"published_at":'
+
+
+def pack_message(payload: str) -> str:
+    """
+    Adds the publish time to a serialized message as the last key of the JSON object.
+
+    >>> pack_message('{"action":"restart"}').startswith('{"action":"restart","published_at":')
+    True
+
+    Args:
+        payload: Serialized WSMessage
+
+    Returns:
+        Message for the broker
+    """
+    return f'{payload[:-1]},"published_at":{time.time():.6f}}}'
+
+
+def unpack_message(data: bytes) -> tuple[float | None, bytes]:
+    """
+    Splits a broker message into the publish time and the serialized WSMessage.
+
+    Messages without a publish time are returned as is.
+
+    >>> unpack_message(b'{"action":"restart","published_at":1700000000.5}')
+    (1700000000.5, b'{"action":"restart"}')
+
+    Args:
+        data: Raw message data from the broker
+
+    Returns:
+        Publish time (None if unknown) and the serialized WSMessage
+    """
+    payload, found, published_at = data.rpartition(PUBLISHED_AT)
+    try:
+        return (float(published_at[:-1]), payload + b"}") if found else (None, data)
+    except ValueError:
+        return None, data
+
+
+@lru_cache(maxsize=256)
+def channel_pattern(bus_id: str) -> str:
+    """
+    Groups channels for throughput metrics by replacing ids with ``*``.
+
+    >>> channel_pattern("node-12-events")
+    'node-*-events'
+    """
+    return re.sub(r"\d+", "*", bus_id)
+
+
+class BusMetrics:
+    """
+    Bus hot path counters of this worker.
+
+    - publish latency: time of the broker call in ``publish``/``publish_many``/``send_command``;
+    - delivery lag: from publishing to sending to the socket, including queueing and conflation;
+    - published/received messages per channel pattern (``user-*``, ``node-*``, ``node-*-events``).
+
+    Subscriber counts and dropped messages are kept by the Bus itself, see ``Bus.stats``.
+    """
+
+    def __init__(self) -> None:
+        self.publish_latency: Histogram = Histogram()
+        self.delivery_lag: Histogram = Histogram()
+        self.published: dict[str, RateMeter] = {}
+        self.received: dict[str, RateMeter] = {}
+
+    def mark_published(self, bus_id: str, count: int = 1) -> None:
+        """ Count published messages of the channel """
+        pattern = channel_pattern(bus_id)
+        if pattern not in self.published:
+            self.published[pattern] = RateMeter()
+        self.published[pattern].mark(count)
+
+    def mark_received(self, bus_id: str) -> None:
+        """ Count a message received from the broker """
+        pattern = channel_pattern(bus_id)
+        if pattern not in self.received:
+            self.received[pattern] = RateMeter()
+        self.received[pattern].mark()
+
+    def snapshot(self) -> dict[str, Any]:
+        """ Metrics for the ``/metrics`` endpoint """
+        patterns = sorted(set(self.published) | set(self.received))
+        empty = RateMeter()
+        return {
+            "publish_latency": self.publish_latency.snapshot(),
+            "delivery_lag": self.delivery_lag.snapshot(),
+            "channels": {
+                pattern: {
+                    "published_total": self.published.get(pattern, empty).total,
+                    "published_per_second": self.published.get(pattern, empty).rate(),
+                    "received_total": self.received.get(pattern, empty).total,
+                    "received_per_second": self.received.get(pattern, empty).rate(),
+                }
+                for pattern in patterns
+            },
+        }
+
+
+@lru_cache(maxsize=4096)
+def decode_message(data: bytes) -> dict[str, Any] | None:
+    """
+    Parses raw message data once for all subscribers of the channel.
+
+    The result is shared between callers and must not be changed.
+
+    Args:
+        data: Raw message data
+
+    Returns:
+        The message as a dict, None if it is not a JSON object
+    """
+    try:
+        message = json.loads(data)
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+def coalesce_key(data: bytes) -> tuple[Any, Any] | None:
+    """
+    Returns the key of messages that replace each other: action and object id.
+
+    Args:
+        data: Raw message data
+
+    Returns:
+        Action and ``data.id`` of the message, None if the message has no id
+    """
+    message = decode_message(data)
+    try:
+        return message["action"], message["data"]["id"]
+    except (KeyError, TypeError):
+        return None
 
 
 class BusSubscriber:
     """
     Manages subscriber data and lifecycle.
-    
-    This class collects and manages all data related to a single subscriber,
-    including the WebSocket connection, bus ID, and Redis pubsub subscription.
-    
+
+    This class collects and manages all data related to a single subscriber:
+    the WebSocket connection, its own bus ID and the other topics it listens to,
+    the outbound queue and the writer task that drains it.
+
+    When the queue is full the overflow policy is applied:
+        - ``drop_oldest``: the oldest queued message is dropped;
+        - ``coalesce``: a queued message about the same object (action and id) is replaced,
+          if there is none the oldest message is dropped;
+        - ``disconnect``: the socket is closed, the client has to reconnect.
+
+    With a conflation window lamp and sensor updates are held for the window,
+    only the latest update per object is kept, and the window is queued as one
+    ``updated_values`` frame. Other messages flush the window first to keep the order.
+
     Args:
+        bus: The bus this subscriber is registered in
         websocket: The WebSocket connection for this subscriber
-        bus_id: Unique identifier for the subscription channel
-        pubsub_subscriber: Redis pubsub subscription object
-        task: Optional asyncio task that handles message reading
+        bus_id: Unique identifier for the subscriber's own channel
+        queue_size: Outbound queue limit
+        overflow_policy: What to do when the queue is full
+        conflation_ms: Conflation window in milliseconds, 0 sends every update at once
+        control_handler: Called with every message of the own channel before it is sent,
+            lets the endpoint react to control messages (e.g. access changes)
+        codec: Wire encoding of the socket, JSON messages from the bus are transcoded for binary ones
     """
     def __init__(
-        self, 
-        websocket: WebSocket, 
-        bus_id: str, 
-        pubsub_subscriber: any,  # Redis pubsub type
-        task: asyncio.Task | None = None
+        self,
+        bus: "Bus",
+        websocket: WebSocket,
+        bus_id: str,
+        queue_size: int = settings.bus_subscriber_queue_size,
+        overflow_policy: str = settings.bus_subscriber_overflow_policy,
+        conflation_ms: int = 0,
+        control_handler: Callable[["BusSubscriber", dict[str, Any]], None] | None = None,
+        codec: JSONCodec | None = None,
     ) -> None:
+        self.bus: Bus = bus
         self.websocket: WebSocket = websocket
         self.bus_id: str = bus_id
-        self.pubsub_subscriber: any = pubsub_subscriber
-        self.task: asyncio.Task | None = task
+        self.topics: set[str] = set()
+        self.control_handler: Callable[[BusSubscriber, dict[str, Any]], None] | None = control_handler
+        self.codec: JSONCodec | None = codec
+        # Publish time and serialized message
+        self.queue: deque[tuple[float | None, bytes]] = deque()
+        self.queue_size: int = queue_size
+        self.overflow_policy: str = overflow_policy
+        self.dropped: int = 0
+        self.task: asyncio.Task | None = None
+        self._has_messages: asyncio.Event = asyncio.Event()
+        self.conflation_ms: int = conflation_ms
+        self.conflated: dict[tuple[str, Any], dict[str, Any]] = {}
+        self.conflated_since: float | None = None
+        self._flush_handle: asyncio.TimerHandle | None = None
+
+    def start(self) -> None:
+        """ Start the writer task """
+        self.task = asyncio.create_task(self.writer())
+
+    def put(self, bus_id: str, data: bytes, published_at: float | None = None) -> None:
+        """
+        Queues a message for the WebSocket without waiting for the socket.
+
+        Args:
+            bus_id: The channel the message came from
+            data: Serialized WSMessage
+            published_at: Publish time of the message
+        """
+        if self.control_handler and bus_id == self.bus_id:
+            message = decode_message(data)
+            if message:
+                self.control_handler(self, message)
+        if self.conflation_ms:
+            message = decode_message(data)
+            action = message.get("action") if message else None
+            if action in CONFLATED_ACTIONS and isinstance(message.get("data"), dict):
+                self._conflate(action, message["data"], published_at)
+                return
+            self.flush_conflated()
+        self._enqueue(data, published_at)
+
+    def _conflate(self, action: str, data: dict[str, Any], published_at: float | None) -> None:
+        """ Keep the latest update of the object until the window is flushed """
+        if not self.conflated:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.conflation_ms / 1000, self.flush_conflated)
+            # The lag of the frame is the lag of its oldest update
+            self.conflated_since = published_at
+        self.conflated[(action, data.get("id"))] = data
+
+    def flush_conflated(self) -> None:
+        """ Queue the conflated updates as one ``updated_values`` frame """
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self.conflated:
+            return
+
+        frame_data: dict[str, list[dict[str, Any]]] = {}
+        for (action, _), data in self.conflated.items():
+            frame_data.setdefault(CONFLATED_ACTIONS[action], []).append(data)
+        self.conflated = {}
+        frame = {"request_id": new_request_id(), "action": WSActions.current_values.value, "data": frame_data}
+        self._enqueue(json.dumps(frame).encode("utf-8"), self.conflated_since)
+
+    def _enqueue(self, data: bytes, published_at: float | None) -> None:
+        """ Put data to the outbound queue applying the overflow policy """
+        if len(self.queue) >= self.queue_size:
+            logger.warning("Queue of subscriber %s is full, policy: %s", self.bus_id, self.overflow_policy)
+            if self.overflow_policy == "disconnect":
+                self._disconnect_slow_client()
+                return
+            if self.overflow_policy == "coalesce" and self._coalesce(data, published_at):
+                return
+            self.queue.popleft()
+            self._drop(1)
+
+        self.queue.append((published_at, data))
+        self._has_messages.set()
+
+    def _coalesce(self, data: bytes, published_at: float | None) -> bool:
+        """
+        Replaces a queued message about the same object with the new one.
+
+        Returns:
+            True if a message was replaced
+        """
+        key = coalesce_key(data)
+        if key is None:
+            return False
+        for index, (queued_at, queued_data) in enumerate(self.queue):
+            if coalesce_key(queued_data) == key:
+                # Keep the older publish time: the object has been waiting since then
+                self.queue[index] = (queued_at or published_at, data)
+                self._drop(1)
+                return True
+        return False
+
+    def _drop(self, count: int) -> None:
+        """ Count dropped messages """
+        self.dropped += count
+        self.bus.dropped_messages += count
+
+    def _disconnect_slow_client(self) -> None:
+        """ Drop the queue and close the socket of a client that does not keep up """
+        self._drop(len(self.queue))
+        self.queue.clear()
+        self.bus.slow_disconnects += 1
+        if self.task:
+            self.task.cancel()
+        asyncio.create_task(self._close())
+
+    async def _close(self) -> None:
+        """ Close the socket and leave the bus """
+        try:
+            await self.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        except Exception as ex:
+            logger.warning("Failed to close slow websocket %s: %s", self.bus_id, ex)
+        await self.unsubscribe()
+
+    async def writer(self) -> None:
+        """
+        Sends queued messages to the WebSocket one by one.
+
+        Stops when the socket is closed.
+        """
+        while True:
+            await self._has_messages.wait()
+            while self.queue:
+                published_at, data = self.queue.popleft()
+                if not await self.send(data, published_at):
+                    return
+            self._has_messages.clear()
+
+    async def send(self, data: bytes, published_at: float | None = None) -> bool:
+        """
+        Sends a message received from the bus to the WebSocket.
+
+        Args:
+            data: Serialized WSMessage
+            published_at: Publish time of the message, for the delivery lag metric
+
+        Returns:
+            False if the socket is closed and the subscriber has left the bus
+        """
+        # Если будет чаще чем нужно отписывать, можно использовать WebSocketState.DISCONNECTED
+        if self.websocket.client_state != WebSocketState.CONNECTED:
+            # Это надо делать на дисконнекте. Но там не все данные есть, поэтому пока тут
+            self.queue.clear()
+            await self.unsubscribe()
+            return False
+
+        logger.debug("Get message from bus %s: %s", self.bus_id, data)
+        # Messages were validated and serialized by Bus.publish, so they go to the socket as is
+        if settings.bus_validate_messages:
+            try:
+                WSMessage.model_validate_json(data)
+            except ValidationError as ex:
+                logger.error("Invalid message from bus %s: %s. Ex: %s", self.bus_id, data, ex)
+                return True
+        try:
+            if self.codec is not None and self.codec.binary:
+                message = decode_message(data)
+                if message is None:
+                    logger.error("Cannot transcode message from bus %s: %s", self.bus_id, data)
+                    return True
+                await self.codec.send(self.websocket, message)
+            else:
+                await self.websocket.send_text(data.decode("utf-8"))
+        except Exception as ex:
+            logger.exception("Failed to send message to websocket: %s. Ex: %s", data, ex)
+            return True
+        if published_at is not None:
+            self.bus.metrics.delivery_lag.observe(time.time() - published_at)
+        return True
 
     async def unsubscribe(self) -> None:
         """
-        Unsubscribes from the pubsub channel and cancels the listening task.
-        
+        Removes the subscriber from the bus.
+
         This method handles the cleanup of resources when a subscriber disconnects.
         """
         # TODO: Remove connection from WS manager as well
         logger.warning("Unsubscribe: %s", self.bus_id)
-        await self.pubsub_subscriber.unsubscribe(self.bus_id)
-        logger.warning("Killing task: %s", self.task)
-        if self.task and not self.task.cancelled():
+        if self._flush_handle:
+            self._flush_handle.cancel()
+        await self.bus.unsubscribe(self)
+        if self.task and self.task is not asyncio.current_task():
             self.task.cancel()
-        else:
-            self.task = None
+
+
+class CommandAcker:
+    """
+    Moves the command stream offset of a recipient past the commands queued to its socket.
+
+    Used as the control handler of the recipient's subscriber: live commands carry
+    their stream entry ID (see ``Bus.send_command``). Until ``start`` is called, while
+    the stored commands are being sent, the IDs are only remembered, and queued live
+    commands that were among the stored ones are dropped on start. The offset
+    never moves back and acks are written one at a time.
+
+    Args:
+        bus: The bus
+        bus_id: The channel identifier of the recipient
+    """
+
+    def __init__(self, bus: "Bus", bus_id: str) -> None:
+        self.bus: Bus = bus
+        self.bus_id: str = bus_id
+        self.acked: str | None = None
+        self.latest: str | None = None
+        self.started: bool = False
+        self.task: asyncio.Task | None = None
+        self.subscriber: BusSubscriber | None = None
+
+    def on_message(self, subscriber: "BusSubscriber", message: dict[str, Any]) -> None:
+        """ Remember the entry ID of a live command and ack it when started """
+        self.subscriber = subscriber
+        entry_id = message.get("stream_entry")
+        if not isinstance(entry_id, str):
+            return
+        if self.latest is None or stream_entry_key(entry_id) > stream_entry_key(self.latest):
+            self.latest = entry_id
+        if self.started and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._ack())
+
+    async def start(self, acked: str | None) -> None:
+        """
+        Ack live commands queued while the stored ones were sent.
+
+        Args:
+            acked: The last stored entry ID already acked, None if nothing was stored
+        """
+        self.acked = acked
+        self.started = True
+        if acked is not None and self.subscriber is not None:
+            self.subscriber.queue = deque(
+                (published_at, data) for published_at, data in self.subscriber.queue
+                if not self._is_acked(decode_message(data))
+            )
+        await self._ack()
+
+    def _is_acked(self, message: dict[str, Any] | None) -> bool:
+        entry_id = message.get("stream_entry") if message else None
+        return isinstance(entry_id, str) and stream_entry_key(entry_id) <= stream_entry_key(self.acked)
+
+    async def _ack(self) -> None:
+        while self.latest is not None and (
+            self.acked is None or stream_entry_key(self.latest) > stream_entry_key(self.acked)
+        ):
+            entry_id = self.latest
+            await self.bus.ack_commands(self.bus_id, entry_id)
+            self.acked = entry_id
 
 
 class Bus:
     """
     Message bus for handling communication between system components.
-    
+
     This class provides methods for publishing messages to channels and
-    subscribing to receive messages from channels using Redis pub/sub.
+    subscribing to receive messages from channels using the configured broker.
+
+    The bus keeps a routing table from ``bus_id`` to local subscribers. The pubsub
+    channel is subscribed with the first local subscriber and unsubscribed with the last one.
     """
-    pubsub_client: RedisPubSubManager = RedisPubSubManager()
-    pubsub_connected: bool = False
 
-    def __init__(self) -> None:
-        """Initialize a new Bus instance."""
-        pass
+    def __init__(self, pubsub_client: BaseBroker | None = None) -> None:
+        """
+        Initialize a new Bus instance.
+
+        Args:
+            pubsub_client: Broker backend, by default the one selected in settings
+        """
+        self.pubsub_client: BaseBroker = pubsub_client or get_broker()
+        self.pubsub_connected: bool = False
+        self.subscribers: dict[str, set[BusSubscriber]] = {}
+        self.handlers: dict[str, list[Callable[[dict[str, Any]], None]]] = {}
+        self.reader_task: asyncio.Task | None = None
+        self._subscribe_lock: asyncio.Lock = asyncio.Lock()
+        self.dropped_messages: int = 0
+        self.slow_disconnects: int = 0
+        self.metrics: BusMetrics = BusMetrics()
 
     async def connect(self) -> None:
         """
-        Connect to the Redis pub/sub system.
-        
-        This method ensures we only connect once to the Redis server.
+        Connect to the pub/sub broker.
+
+        This method ensures we only connect once to the broker.
         """
         if not self.pubsub_connected:
             await self.pubsub_client.connect()
             self.pubsub_connected = True
 
-    async def pubsub_data_reader(self, subscriber: BusSubscriber) -> None:
-        """
-        Reads and broadcasts messages received from Redis PubSub.
+    def _ensure_reader(self) -> None:
+        """ Start the pubsub reader task if it is not running """
+        if self.reader_task is None or self.reader_task.done():
+            self.reader_task = asyncio.create_task(self.pubsub_data_reader())
+            logger.info("Pubsub reader started with task: %s", self.reader_task)
 
-        This method continuously polls for new messages from Redis and forwards
-        them to the appropriate WebSocket connection.
+    async def pubsub_data_reader(self) -> None:
+        """
+        Reads messages received from the broker and routes them to subscribers.
 
-        Args:
-            subscriber: The subscriber object containing connection information
+        One reader serves all subscribers of the worker. Each message is queued
+        only to the subscribers of its channel, their writers send it.
         """
-        logger.debug("Starting pubsub subscriber")
-        while True:
-            # Если будет чаще чем нужно отписывать, можно использовать WebSocketState.DISCONNECTED
-            if subscriber.websocket.client_state != WebSocketState.CONNECTED:
-                # Это надо делать на дисконнекте. Но там не все данные есть, поэтому пока тут
-                await subscriber.unsubscribe()
-
-            redis_message = await subscriber.pubsub_subscriber.get_message(ignore_subscribe_messages=True)
-            if redis_message is not None:
-                logger.debug("State: %s", subscriber.websocket.application_state.value)
-                logger.debug("Get message from redis: %s", redis_message)
-                data = json.loads(redis_message['data'].decode('utf-8'))
-                logger.debug("Get data from redis: %s", data)
-                ws_message = WSMessage(**data)
-                logger.debug(">>Application stats: %s", subscriber.websocket.application_state.value)
-                try:
-                    await subscriber.websocket.send_json(ws_message.model_dump(exclude_none=True))
-                except Exception as ex:
-                    logger.exception("Failed to send message to websocket: %s. Ex: %s", ws_message, ex)
-            else:
-                await asyncio.sleep(0.1)
+        logger.debug("Starting pubsub reader")
+        async for bus_id, data in self.pubsub_client.listen():
+            self.metrics.mark_received(bus_id)
+            subscribers = self.subscribers.get(bus_id)
+            handlers = self.handlers.get(bus_id)
+            if not subscribers and not handlers:
+                logger.debug("No subscribers for bus %s", bus_id)
+                continue
+            published_at, data = unpack_message(data)
+            if handlers:
+                message = decode_message(data)
+                if message:
+                    for handler in handlers:
+                        try:
+                            handler(message)
+                        except Exception as ex:  # pylint: disable=broad-exception-caught
+                            logger.exception("Handler %s failed on bus %s: %s", handler, bus_id, ex)
+            if not subscribers:
+                continue
+            # Copy: a slow subscriber can be disconnected while we are routing
+            for subscriber in tuple(subscribers):
+                subscriber.put(bus_id, data, published_at)
 
-    async def publish(self, bus_id: str, message: WSMessage) -> None:
+    async def publish(self, bus_id: str, message: WSMessage) -> int:
         """
         Publish a message to the specified bus channel.
-        
+
         Args:
             bus_id: The channel identifier to publish to
             message: The WebSocket message to publish
+
+        Returns:
+            Number of workers listening to the channel
         """
         redis_message = message.model_dump_json(exclude_none=True)
-        await self.pubsub_client.publish(bus_id, redis_message)
+        started = time.perf_counter()
+        receivers = await self.pubsub_client.publish(bus_id, pack_message(redis_message))
+        self.metrics.publish_latency.observe(time.perf_counter() - started)
+        self.metrics.mark_published(bus_id)
+        return receivers
+
+    async def publish_many(self, bus_ids: Iterable[str], message: WSMessage) -> None:
+        """
+        Publish one message to several bus channels.
+
+        The message is serialized once and sent to all channels in one broker round trip.
+
+        Args:
+            bus_ids: The channel identifiers to publish to
+            message: The WebSocket message to publish
+        """
+        bus_ids = list(bus_ids)
+        redis_message = message.model_dump_json(exclude_none=True)
+        started = time.perf_counter()
+        await self.pubsub_client.publish_many(bus_ids, pack_message(redis_message))
+        self.metrics.publish_latency.observe(time.perf_counter() - started)
+        for bus_id in bus_ids:
+            self.metrics.mark_published(bus_id)
+
+    async def send_command(self, bus_id: str, message: WSMessage) -> int:
+        """
+        Send a command that must survive the recipient being offline.
+
+        The command is stored in the ``<bus_id>-commands`` stream and published live
+        with its entry ID in ``stream_entry``. The stream offset is not moved here:
+        the worker of the recipient acks the commands it queued to the socket
+        (see ``CommandAcker``), the rest waits until ``pending_commands`` is called.
+
+        Args:
+            bus_id: The channel identifier of the recipient
+            message: The WebSocket message to send
+
+        Returns:
+            Number of workers the command was published to live, 0 if the recipient is offline
+        """
+        stream = f"{bus_id}-commands"
+        redis_message = message.model_dump_json(exclude_none=True)
+        started = time.perf_counter()
+        entry_id = await self.pubsub_client.stream_add(stream, redis_message, maxlen=settings.bus_commands_maxlen)
+        live_message = f'{redis_message[:-1]},"stream_entry":"{entry_id}"}}'
+        receivers = await self.pubsub_client.publish(bus_id, pack_message(live_message))
+        self.metrics.publish_latency.observe(time.perf_counter() - started)
+        self.metrics.mark_published(bus_id)
+        logger.debug("Command %s to %s stored as %s, live receivers: %s", message.action, bus_id, entry_id, receivers)
+        return receivers
+
+    async def pending_commands(self, bus_id: str) -> tuple[list[WSMessage], str | None]:
+        """
+        Get commands stored while the recipient was offline.
+
+        Commands older than ``settings.bus_commands_ttl`` seconds are skipped.
+        Call ``ack_commands`` with the returned entry ID after they are delivered.
+
+        Args:
+            bus_id: The channel identifier of the recipient
 
-    async def subscribe(self, websocket: WebSocket, bus_id: str) -> BusSubscriber:
+        Returns:
+            Pending commands in stream order and the last entry ID (None if nothing is pending)
+        """
+        stream = f"{bus_id}-commands"
+        offset = await self.pubsub_client.get_stream_offset(stream)
+        entries = await self.pubsub_client.stream_range(stream, offset)
+        if not entries:
+            return [], None
+
+        expired_before = (time.time() - settings.bus_commands_ttl) * 1000
+        commands = [
+            WSMessage.model_validate_json(message)
+            for entry_id, message in entries
+            if stream_entry_key(entry_id)[0] >= expired_before
+        ]
+        return commands, entries[-1][0]
+
+    async def ack_commands(self, bus_id: str, entry_id: str) -> None:
+        """
+        Mark commands up to the entry ID as delivered.
+
+        Args:
+            bus_id: The channel identifier of the recipient
+            entry_id: The last delivered entry ID
+        """
+        await self.pubsub_client.set_stream_offset(f"{bus_id}-commands", entry_id)
+
+    async def acquire_leases(self, keys: list[str], ttl: int) -> list[bool]:
+        """
+        Take leases shared by all workers in one broker round trip, e.g. to do jobs in one worker only.
+
+        Args:
+            keys: Lease names
+            ttl: Seconds until the leases expire
+
+        Returns:
+            For each key, True if the lease is taken by this call
+        """
+        return await self.pubsub_client.acquire_leases(keys, ttl)
+
+    async def subscribe(
+        self,
+        websocket: WebSocket,
+        bus_id: str,
+        topics: Iterable[str] = (),
+        conflation_ms: int = 0,
+        control_handler: Callable[[BusSubscriber, dict[str, Any]], None] | None = None,
+        codec: JSONCodec | None = None,
+        start_writer: bool = True,
+    ) -> BusSubscriber:
         """
-        Subscribe a WebSocket connection to a bus channel.
-        
-        This method creates a new subscription to the specified channel and
-        starts a background task to listen for messages.
-        
+        Subscribe a WebSocket connection to a bus channel and optional topics.
+
+        This method adds the connection to the routing table and makes sure
+        the channels are subscribed and the reader is running.
+        Without ``start_writer`` messages are queued until ``BusSubscriber.start``
+        is called, e.g. to send stored commands before the live ones.
+
         Args:
             websocket: The WebSocket connection to send messages to
             bus_id: The channel identifier to subscribe to
-            
+            topics: Other channels to listen to with the same connection
+            conflation_ms: Conflation window for lamp and sensor updates, 0 to disable
+            control_handler: Handler of messages of the own channel, see BusSubscriber
+            codec: Wire encoding of the socket, JSON by default
+            start_writer: Start sending queued messages to the socket at once
+
         Returns:
             A BusSubscriber object representing the subscription
         """
-        pubsub_subscriber = await self.pubsub_client.subscribe(bus_id)
-        subscriber = BusSubscriber(websocket, bus_id, pubsub_subscriber)
-        task = asyncio.create_task(self.pubsub_data_reader(subscriber))
-        subscriber.task = task
-        logger.info("Pubsub for client %s connected with task: %s", bus_id, task)
+        subscriber = BusSubscriber(
+            self, websocket, bus_id, conflation_ms=conflation_ms, control_handler=control_handler, codec=codec,
+        )
+        await self.add_topics(subscriber, {bus_id, *topics})
+        if start_writer:
+            subscriber.start()
+        self._ensure_reader()
+        logger.info("Client %s subscribed to bus with topics: %s", bus_id, subscriber.topics)
         return subscriber
 
+    async def add_topics(self, subscriber: BusSubscriber, topics: Iterable[str]) -> None:
+        """
+        Route messages of more channels to the subscriber.
+
+        A channel is subscribed in the broker with its first local subscriber.
+
+        Args:
+            subscriber: The subscriber
+            topics: Channel identifiers to add
+        """
+        async with self._subscribe_lock:
+            for topic in topics:
+                subscribers = self.subscribers.setdefault(topic, set())
+                if not subscribers and topic not in self.handlers:
+                    await self.pubsub_client.subscribe(topic)
+                subscribers.add(subscriber)
+                subscriber.topics.add(topic)
+
+    async def remove_topics(self, subscriber: BusSubscriber, topics: Iterable[str]) -> None:
+        """
+        Stop routing messages of the channels to the subscriber.
+
+        A channel is unsubscribed in the broker when its last local subscriber leaves.
+
+        Args:
+            subscriber: The subscriber
+            topics: Channel identifiers to remove
+        """
+        async with self._subscribe_lock:
+            for topic in tuple(topics):
+                subscriber.topics.discard(topic)
+                subscribers = self.subscribers.get(topic)
+                if subscribers is None or subscriber not in subscribers:
+                    continue
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[topic]
+                    if topic not in self.handlers:
+                        await self.pubsub_client.unsubscribe(topic)
+
+    async def add_handler(self, bus_id: str, handler: Callable[[dict[str, Any]], None]) -> None:
+        """
+        Call a handler with every message of a channel.
+
+        Handlers are called by the reader before the message is queued to subscribers,
+        so they must be quick and must not wait: start a task for slow work.
+
+        Args:
+            bus_id: The channel identifier to listen to
+            handler: Called with the decoded message
+        """
+        async with self._subscribe_lock:
+            if not self.subscribers.get(bus_id) and bus_id not in self.handlers:
+                await self.pubsub_client.subscribe(bus_id)
+            self.handlers.setdefault(bus_id, []).append(handler)
+        self._ensure_reader()
+        logger.info("Handler %s added for bus %s", handler, bus_id)
+
+    async def unsubscribe(self, subscriber: BusSubscriber) -> None:
+        """
+        Remove a subscriber from the routing table.
+
+        Args:
+            subscriber: The subscriber to remove
+        """
+        await self.remove_topics(subscriber, set(subscriber.topics))
+        logger.info("Client %s unsubscribed from bus", subscriber.bus_id)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Returns subscriber and outbound queue counters for monitoring.
+
+        Returns:
+            Counters, see ``schemas.BusStatus``
+        """
+        all_subscribers = {subscriber for subscribers in self.subscribers.values() for subscriber in subscribers}
+        depths = [len(subscriber.queue) for subscriber in all_subscribers]
+        return {
+            "channels": len(self.subscribers),
+            "subscribers": len(depths),
+            "queued_messages": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "dropped_messages": self.dropped_messages,
+            "slow_disconnects": self.slow_disconnects,
+        }
+
+
+_bus: Bus | None = None
+
 
 async def get_bus() -> Bus:
     """
-    Factory function to get a connected Bus instance.
-    
+    Factory function to get the connected Bus instance of this worker.
+
     This function is designed to be used with FastAPI's dependency injection system.
-    
+
     Returns:
         A connected Bus instance
     """
-    bus = Bus()
-    await bus.connect()
-    return bus
+    global _bus  # pylint: disable=global-statement
+    if _bus is None:
+        _bus = Bus()
+    await _bus.connect()
+    return _bus
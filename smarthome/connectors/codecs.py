@@ -0,0 +1,156 @@
+"""
+WebSocket wire encodings for nodes.
+
+Nodes choose the encoding when connecting to ``/ws/nodes``: the ``msgpack``
+subprotocol or the ``encoding=msgpack`` query parameter. JSON text frames are
+the default and the fallback.
+
+A MessagePack frame is an array ``[request_id, action_code, data]`` (``data`` may
+be omitted), the action codes are listed in ``ACTION_CODES``. Commands inside a
+``commands`` frame are packed the same way.
+"""
+import json
+from typing import Any
+
+import msgpack
+from fastapi import WebSocket
+
+from smarthome.schemas.ws import WSActions
+
+MSGPACK = "msgpack"
+
+# Codes are a part of the nodes firmware protocol: never reuse or renumber them
+ACTION_CODES: dict[WSActions, int] = {
+    WSActions.get_data: 1,
+    WSActions.connect: 2,
+    WSActions.disconnect: 3,
+    WSActions.current_values: 4,
+    WSActions.send_lamps_state_to_nodes: 5,
+    WSActions.set_lamp_state: 6,
+    WSActions.lamp_changed: 7,
+    WSActions.updated_lamp: 8,
+    WSActions.sensor_changed: 9,
+    WSActions.updated_sensor: 10,
+    WSActions.updated_node: 11,
+    WSActions.updated_access: 12,
+    WSActions.restart: 13,
+    WSActions.restart_node: 14,
+    WSActions.commands: 15,
+    WSActions.sensors_changed: 16,
+    WSActions.command_ack: 17,
+    WSActions.set_lamps_state: 18,
+}
+CODE_ACTIONS: dict[int, WSActions] = {code: action for action, code in ACTION_CODES.items()}
+
+
+class JSONCodec:
+    """ JSON text frames """
+    name = "json"
+    binary = False
+
+    def encode(self, message: dict[str, Any]) -> str:
+        """
+        Serialize a message for the socket.
+
+        Args:
+            message: WSMessage as a dict
+
+        Returns:
+            Text frame
+        """
+        return json.dumps(message)
+
+    def decode(self, frame: str | bytes) -> dict[str, Any]:
+        """
+        Parse a frame from the socket.
+
+        Args:
+            frame: Text frame
+
+        Returns:
+            WSMessage as a dict
+
+        Raises:
+            ValueError: The frame can't be decoded
+        """
+        return json.loads(frame)
+
+    async def send(self, websocket: WebSocket, message: dict[str, Any]) -> None:
+        """ Send a message to the socket """
+        await websocket.send_text(self.encode(message))
+
+    async def receive(self, websocket: WebSocket) -> dict[str, Any]:
+        """
+        Receive a message from the socket.
+
+        Raises:
+            ValueError: The frame can't be decoded or is binary
+        """
+        try:
+            frame = await websocket.receive_text()
+        except KeyError as ex:
+            raise ValueError("Binary frame on a JSON socket") from ex
+        return self.decode(frame)
+
+
+class MsgPackCodec(JSONCodec):
+    """ MessagePack binary frames with integer action codes """
+    name = MSGPACK
+    binary = True
+
+    def encode(self, message: dict[str, Any]) -> bytes:
+        return msgpack.packb(self._pack(message))
+
+    def decode(self, frame: str | bytes) -> dict[str, Any]:
+        try:
+            return self._unpack(msgpack.unpackb(frame))
+        except TypeError as ex:
+            # Unhashable map keys or action codes, frames of the wrong type
+            raise ValueError(f"Wrong msgpack frame: {ex}") from ex
+
+    async def send(self, websocket: WebSocket, message: dict[str, Any]) -> None:
+        await websocket.send_bytes(self.encode(message))
+
+    async def receive(self, websocket: WebSocket) -> dict[str, Any]:
+        try:
+            frame = await websocket.receive_bytes()
+        except KeyError as ex:
+            raise ValueError("Text frame on a msgpack socket") from ex
+        return self.decode(frame)
+
+    def _pack(self, message: dict[str, Any]) -> list[Any]:
+        action = WSActions(message["action"])
+        data = message.get("data")
+        if action == WSActions.commands and data:
+            data = {**data, "commands": [self._pack(command) for command in data.get("commands", [])]}
+        if data is None:
+            return [message["request_id"], ACTION_CODES[action]]
+        return [message["request_id"], ACTION_CODES[action], data]
+
+    def _unpack(self, frame: list[Any]) -> dict[str, Any]:
+        if not isinstance(frame, list) or len(frame) not in (2, 3):
+            raise ValueError(f"Wrong msgpack frame: {frame!r}")
+        action = CODE_ACTIONS.get(frame[1])
+        if action is None:
+            raise ValueError(f"Unknown action code: {frame[1]!r}")
+        message = {"request_id": str(frame[0]), "action": action.value}
+        if len(frame) == 3 and frame[2] is not None:
+            message["data"] = frame[2]
+        return message
+
+
+def negotiate_codec(websocket: WebSocket) -> tuple[JSONCodec, str | None]:
+    """
+    Choose the encoding requested by the node.
+
+    Args:
+        websocket: Not accepted yet WebSocket connection
+
+    Returns:
+        The codec and the subprotocol to accept the connection with
+    """
+    if MSGPACK in websocket.scope.get("subprotocols", []):
+        return MsgPackCodec(), MSGPACK
+    if websocket.query_params.get("encoding") == MSGPACK:
+        return MsgPackCodec(), None
+    return JSONCodec(), None
@@ -0,0 +1,183 @@
+"""
+Write-behind buffer for sensor history.
+
+Sensor readings are stored in ``node_sensors_history`` in batches: actions put
+rows into the buffer and return, a background task writes them with one
+multi-row INSERT every ``history_flush_interval_ms`` or as soon as
+``history_flush_rows`` rows are collected. When ``history_buffer_max_rows``
+rows are waiting (the database is slow or down), writers wait for the next
+flush. The rest is written on application shutdown (see ``main.lifespan``).
+
+A batch rejected for its data (e.g. a row of a sensor deleted meanwhile) is split
+in halves until the bad rows are found, they are dropped and counted. A batch
+that fails for other reasons is put back, after ``history_flush_max_failures``
+failed flushes in a row it is dropped as well, so writers never wait forever.
+"""
+import asyncio
+from typing import Any, Iterable
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError
+
+from smarthome import models
+from smarthome.connectors.database import AsyncSessionLocal
+from smarthome.logger import logger
+from smarthome.settings import settings
+
+
+class HistoryBuffer:
+    """
+    Buffer of ``NodeSensorHistory`` rows with a background writer.
+
+    Args:
+        flush_rows: Write as soon as this many rows are collected
+        flush_interval_ms: Write at least this often if there are rows
+        max_rows: Writers wait when this many rows are not written yet
+        max_failures: Drop the buffered rows after this many failed flushes in a row
+    """
+
+    def __init__(
+        self,
+        flush_rows: int = settings.history_flush_rows,
+        flush_interval_ms: int = settings.history_flush_interval_ms,
+        max_rows: int = settings.history_buffer_max_rows,
+        max_failures: int = settings.history_flush_max_failures,
+    ) -> None:
+        self.flush_rows: int = flush_rows
+        self.flush_interval: float = flush_interval_ms / 1000
+        self.max_rows: int = max_rows
+        self.max_failures: int = max_failures
+        self.rows: list[dict[str, Any]] = []
+        self.task: asyncio.Task | None = None
+        self.written: int = 0
+        self.failed_flushes: int = 0
+        self.failures_in_row: int = 0
+        self.dropped_rows: int = 0
+        self._flush_requested: asyncio.Event = asyncio.Event()
+        self._has_space: asyncio.Event = asyncio.Event()
+        self._has_space.set()
+        self._flush_lock: asyncio.Lock = asyncio.Lock()
+
+    async def add(self, sensor_id: int, changed: Any, value: float | None) -> None:
+        """
+        Queue a history row.
+
+        Args:
+            sensor_id: NodeSensor primary key
+            changed: Time of the reading
+            value: Sensor value
+        """
+        await self.add_many([{"sensor_id": sensor_id, "changed": changed, "value": value}])
+
+    async def add_many(self, rows: Iterable[dict[str, Any]]) -> None:
+        """
+        Queue history rows, waits while the buffer is full.
+
+        Args:
+            rows: Dicts with ``sensor_id``, ``changed`` and ``value``
+        """
+        self._ensure_writer()
+        for row in rows:
+            while len(self.rows) >= self.max_rows:
+                logger.warning("Sensor history buffer is full (%s rows), waiting for flush", len(self.rows))
+                self._has_space.clear()
+                self._flush_requested.set()
+                await self._has_space.wait()
+            self.rows.append(row)
+        if len(self.rows) >= self.flush_rows:
+            self._flush_requested.set()
+
+    def _ensure_writer(self) -> None:
+        """ Start the writer task with the first row """
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.writer())
+
+    async def writer(self) -> None:
+        """ Flush the buffer by time or by size """
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Write all buffered rows in one INSERT.
+
+        Rows are put back if the write fails and are tried again with the next flush,
+        see the module docstring for the rows that are dropped.
+        """
+        async with self._flush_lock:
+            if not self.rows:
+                return
+            rows, self.rows = self.rows, []
+            try:
+                unwritten = await self._write_batches(rows)
+            finally:
+                if len(self.rows) < self.max_rows:
+                    self._has_space.set()
+            if not unwritten:
+                self.failures_in_row = 0
+                return
+            self.failed_flushes += 1
+            self.failures_in_row += 1
+            if self.failures_in_row >= self.max_failures:
+                logger.error("Sensor history dropped after %s failed flushes: %s rows",
+                             self.failures_in_row, len(unwritten))
+                self.dropped_rows += len(unwritten)
+                self.failures_in_row = 0
+                return
+            self.rows[:0] = unwritten
+
+    async def _write_batches(self, rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """
+        Write rows, splitting a batch rejected for its data until the bad rows are found.
+
+        Returns:
+            Rows not written because of an error that is not about the data
+        """
+        # The next batch to write is the last one
+        batches = [rows]
+        while batches:
+            batch = batches.pop()
+            try:
+                await self._write(batch)
+            except (DataError, IntegrityError) as ex:
+                if len(batch) > 1:
+                    middle = len(batch) // 2
+                    batches += [batch[middle:], batch[:middle]]
+                    continue
+                self.dropped_rows += 1
+                logger.error("Sensor history row dropped: %s. %s", batch[0], ex)
+                continue
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                logger.exception("Failed to write %s sensor history rows: %s", len(batch), ex)
+                return batch + [row for rest in reversed(batches) for row in rest]
+            self.written += len(batch)
+            logger.debug("Sensor history flushed: %s rows", len(batch))
+        return []
+
+    @staticmethod
+    async def _write(rows: list[dict[str, Any]]) -> None:
+        """ Multi-row INSERT in its own session """
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(models.NodeSensorHistory), rows)
+            await db.commit()
+
+    async def stop(self) -> None:
+        """ Stop the writer and write the rest """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+        if self.rows:
+            logger.error("Sensor history lost on shutdown: %s rows", len(self.rows))
+
+
+history_buffer = HistoryBuffer()
@@ -22,14 +22,15 @@ class WSConnectionManager:
         """Initialize a new WebSocket connection manager with empty connections list."""
         self.active_connections: list[WebSocket] = []
 
-    async def connect(self, websocket: WebSocket) -> None:
+    async def connect(self, websocket: WebSocket, subprotocol: str | None = None) -> None:
         """
         Accept a new WebSocket connection and add it to active connections.
         
         Args:
             websocket: The WebSocket connection to accept and manage
+            subprotocol: The subprotocol selected for the connection, if any
         """
-        await websocket.accept()
+        await websocket.accept(subprotocol=subprotocol)
         self.active_connections.append(websocket)
 
     def disconnect(self, websocket: WebSocket) -> None:
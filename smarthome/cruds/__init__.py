@@ -1,13 +1,13 @@
 """
 CRUD package
 """
-from .nodes import get_nodes, get_node_by_token
+from .nodes import get_nodes, get_node_by_token, add_user_node, delete_user_node
 from .users import get_user_by_email, get_user_by_token
 from .sensor_history import get_aggregated_sensor_history_data
 from .tokens import get_token_by_token, get_token_by_user_id, create_token
 
 __all__ = [
-    "get_nodes", "get_node_by_token",
+    "get_nodes", "get_node_by_token", "add_user_node", "delete_user_node",
     "get_user_by_email", "get_user_by_token",
     "get_aggregated_sensor_history_data",
     "get_token_by_token", "get_token_by_user_id", "create_token",
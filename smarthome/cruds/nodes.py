@@ -1,17 +1,94 @@
 """
 Node CRUD
 """
-from sqlalchemy.orm import Session
+from typing import Sequence
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from smarthome import models
+from smarthome.caches import ACCESS_CHANGES_BUS_ID, access_index
+from smarthome.connectors.bus import Bus
+from smarthome.logger import logger
+from smarthome.schemas.ws import WSActions, WSMessage, new_request_id
 
 
-def get_nodes(db: Session, skip: int = 0, limit: int = 100):
+async def get_nodes(db: AsyncSession, skip: int = 0, limit: int = 100) -> Sequence[models.Node]:
     """ Get node list """
-    return db.query(models.Node).offset(skip).limit(limit).all()
+    return (await db.scalars(select(models.Node).offset(skip).limit(limit))).all()
+
+
+async def publish_access_changed(bus: Bus, user_id: int, node_id: int, granted: bool) -> None:
+    """
+    Tell the user's websockets and the access indexes of all workers that access
+    to a node was granted or revoked.
+
+    The websocket endpoint subscribes to or unsubscribes from the node events topic.
+
+    Args:
+        bus: Bus instance for message publishing
+        user_id: User whose access changed
+        node_id: The node
+        granted: True if access was granted, False if revoked
+    """
+    ws_message = WSMessage(
+        request_id=new_request_id(),
+        action=WSActions.updated_access,
+        data={"user_id": user_id, "node_id": node_id, "granted": granted},
+    )
+    logger.info("Access of user %s to node %s changed: %s", user_id, node_id, granted)
+    await bus.publish_many([ACCESS_CHANGES_BUS_ID, models.user_bus_id(user_id)], ws_message)
+
+
+async def add_user_node(db: AsyncSession, bus: Bus, user_id: int, node_id: int) -> models.UserNode:
+    """ Grant the user access to the node """
+    db_user_node = models.UserNode(user_id=user_id, node_id=node_id)
+    db.add(db_user_node)
+    await db.commit()
+    access_index.grant(user_id, node_id)
+    await publish_access_changed(bus, user_id, node_id, True)
+    return db_user_node
+
+
+async def delete_user_node(db: AsyncSession, bus: Bus, user_id: int, node_id: int) -> bool:
+    """ Revoke the user's access to the node """
+    result = await db.execute(
+        delete(models.UserNode).where(
+            models.UserNode.user_id == user_id,
+            models.UserNode.node_id == node_id,
+        )
+    )
+    await db.commit()
+    access_index.revoke(user_id, node_id)
+    await publish_access_changed(bus, user_id, node_id, False)
+    return bool(result.rowcount)
+
+
+async def set_desired_lamps(db: AsyncSession, node_id: int, lamps: dict[int, int]) -> None:
+    """ Remember commanded lamp values by node lamp id, one UPDATE per distinct value """
+    by_value: dict[int, list[int]] = {}
+    for node_lamp_id, value in lamps.items():
+        by_value.setdefault(value, []).append(node_lamp_id)
+    for value, node_lamp_ids in by_value.items():
+        await db.execute(
+            update(models.NodeLamp)
+            .where(models.NodeLamp.node_id == node_id, models.NodeLamp.node_lamp_id.in_(node_lamp_ids))
+            .values(desired_value=value)
+        )
+    await db.commit()
+
+
+async def get_desired_lamps(db: AsyncSession, node_id: int) -> dict[int, int]:
+    """ Desired lamp values of the node by node lamp id """
+    db_lamps = await db.execute(
+        select(models.NodeLamp.node_lamp_id, models.NodeLamp.desired_value)
+        .where(models.NodeLamp.node_id == node_id, models.NodeLamp.desired_value.is_not(None))
+    )
+    return dict(db_lamps.tuples().all())
 
 
-async def get_node_by_token(db: Session, token: str):
+async def get_node_by_token(db: AsyncSession, token: str) -> models.Node | None:
     """ Get node by token """
-    result = db.query(models.Node).join(models.NodeToken).filter(models.NodeToken.token == token).first()
-    return result
+    return await db.scalar(
+        select(models.Node).join(models.NodeToken).where(models.NodeToken.token == token)
+    )
@@ -6,14 +6,14 @@ This module provides functions for retrieving and manipulating sensor history da
 from datetime import datetime
 from typing import Any, Literal, Sequence
 
-from sqlalchemy import func
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from smarthome import models
 
 
-def get_aggregated_sensor_history_data(
-    db: Session,
+async def get_aggregated_sensor_history_data(
+    db: AsyncSession,
     sensor_id: int,
     start_date: datetime,
     end_date: datetime,
@@ -49,13 +49,13 @@ def get_aggregated_sensor_history_data(
 
     # Build query
     query = (
-        db.query(
+        select(
             group_field.label("period"),
             func.max(models.NodeSensorHistory.value).label("max_value"),
             func.min(models.NodeSensorHistory.value).label("min_value"),
             func.avg(models.NodeSensorHistory.value).label("avg_value"),
         )
-        .filter(
+        .where(
             models.NodeSensorHistory.changed.between(start_date, end_date),
             models.NodeSensorHistory.sensor_id == sensor_id,
         )
@@ -63,4 +63,4 @@ def get_aggregated_sensor_history_data(
         .order_by(group_field)
     )
 
-    return query.all()
+    return (await db.execute(query)).all()
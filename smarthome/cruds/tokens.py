@@ -1,23 +1,24 @@
 """ Token CRUD """
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from smarthome import models
 
 
-def get_token_by_token(db: Session, token: str) -> models.UserToken:
+async def get_token_by_token(db: AsyncSession, token: str) -> models.UserToken | None:
     """ Get token """
-    return db.query(models.UserToken).filter(models.UserToken.token == token).first()
+    return await db.scalar(select(models.UserToken).where(models.UserToken.token == token))
 
 
-def get_token_by_user_id(db: Session, user_id: int) -> models.UserToken:
+async def get_token_by_user_id(db: AsyncSession, user_id: int) -> models.UserToken | None:
     """ Get token """
-    return db.query(models.UserToken).filter(models.UserToken.user_id == user_id).first()
+    return await db.scalar(select(models.UserToken).where(models.UserToken.user_id == user_id))
 
 
-def create_token(db: Session, user_id: int, token: str):
+async def create_token(db: AsyncSession, user_id: int, token: str) -> models.UserToken:
     """ Create new token """
     db_token = models.UserToken(user_id=user_id, token=token)
     db.add(db_token)
-    db.commit()
-    db.refresh(db_token)
+    await db.commit()
+    await db.refresh(db_token)
     return db_token
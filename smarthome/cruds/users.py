@@ -1,17 +1,19 @@
 """
 User CRUD
 """
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from smarthome import models
 
 
-def get_user_by_email(db: Session, email: str):
+async def get_user_by_email(db: AsyncSession, email: str) -> models.User | None:
     """ Get user by email """
-    return db.query(models.User).filter(models.User.email == email).first()
+    return await db.scalar(select(models.User).where(models.User.email == email))
 
 
-async def get_user_by_token(db: Session, token: str):
+async def get_user_by_token(db: AsyncSession, token: str) -> models.User | None:
     """ Get user by token """
-    result = db.query(models.User).join(models.UserToken).filter(models.UserToken.token == token).first()
-    return result
+    return await db.scalar(
+        select(models.User).join(models.UserToken).where(models.UserToken.token == token)
+    )
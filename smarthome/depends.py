@@ -1,7 +1,11 @@
 """
 Dependencies
 """
-from smarthome.connectors.database import Base, engine, SessionLocal
+from typing import AsyncIterator
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from smarthome.connectors.database import Base, engine, SessionLocal, AsyncSessionLocal
 
 
 def get_db():
@@ -14,3 +18,9 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    """ Create async db connection, tables are created on startup (see ``main.lifespan``) """
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,9 +1,18 @@
 """
 Main
 """
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI
 
+from smarthome.actions.scheduler import scheduler
+from smarthome.caches import access_index
+from smarthome.connectors.bus import get_bus
+from smarthome.connectors.database import Base, async_engine
+from smarthome.connectors.history_buffer import history_buffer
+from smarthome.settings import settings
+
 # Browser routers
 from smarthome.routers.browser.front import router as browser_front_router
 from smarthome.routers.browser.apis.auth import router as browser_apis_me_router
@@ -15,14 +24,35 @@ from smarthome.routers.nodes.ws.endpoints import router as nodes_ws_router
 
 # Other routers
 from smarthome.routers.system.healthcheck import router as system_healthcheck_router
+from smarthome.routers.system.metrics import router as system_metrics_router
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """
+    Create tables, listen to access changes and start the scheduler on startup,
+    write buffered sensor history on shutdown
+    """
+    # TODO: move to right place (alembic)
+    async with async_engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    await access_index.start(await get_bus())
+    if settings.scheduler_enabled:
+        await scheduler.start(await get_bus())
+    yield
+    await scheduler.stop()
+    await history_buffer.stop()
+    await async_engine.dispose()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.include_router(browser_front_router)
 app.include_router(browser_apis_me_router, prefix="/api/auth")
 app.include_router(browser_apis_nodes_router, prefix="/api/nodes")
 app.include_router(browser_ws_router)
 app.include_router(nodes_ws_router)
 app.include_router(system_healthcheck_router)
+app.include_router(system_metrics_router)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+"""
+Metrics primitives.
+
+In-process counters for the hot paths (bus, actions). They are cheap to update
+and are read by the ``/metrics`` endpoint, each worker reports its own numbers.
+"""
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Sequence
+
+# Upper bounds in seconds: 0.1 ms .. 10 s
+DEFAULT_BUCKETS: tuple[float, ...] = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets.
+
+    Quantiles are estimated by the upper bound of the bucket they fall into.
+
+    Args:
+        buckets: Sorted upper bounds of the buckets, values above the last one go to +Inf
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets: tuple[float, ...] = tuple(buckets)
+        self.counts: list[int] = [0] * (len(self.buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+
+    def observe(self, value: float) -> None:
+        """ Add a value """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        """
+        Estimate a quantile.
+
+        Args:
+            q: Quantile from 0 to 1
+
+        Returns:
+            Upper bound of the bucket with the quantile (inf for the last one), None if empty
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def snapshot(self) -> dict[str, float | int | None]:
+        """ Count, sum, average and p50/p95/p99 """
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class RateMeter:
+    """
+    Counts events and their rate per second over a sliding window.
+
+    Args:
+        window: Window length in seconds
+    """
+
+    def __init__(self, window: int = 60) -> None:
+        self.window: int = window
+        self.total: int = 0
+        self._seconds: deque[list[int]] = deque()
+
+    def mark(self, count: int = 1) -> None:
+        """ Register events """
+        now = int(time.monotonic())
+        self.total += count
+        if self._seconds and self._seconds[-1][0] == now:
+            self._seconds[-1][1] += count
+        else:
+            self._seconds.append([now, count])
+        self._expire(now)
+
+    def rate(self) -> float:
+        """ Events per second over the window """
+        self._expire(int(time.monotonic()))
+        return sum(count for _, count in self._seconds) / self.window
+
+    def _expire(self, now: int) -> None:
+        while self._seconds and self._seconds[0][0] <= now - self.window:
+            self._seconds.popleft()
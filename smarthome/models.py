@@ -3,15 +3,12 @@ Models
 """
 import datetime
 from sqlalchemy import (
-    Boolean, Column, DateTime, event, Float, ForeignKey, Integer,
-    orm, PrimaryKeyConstraint, String, UniqueConstraint,
+    Boolean, Column, DateTime, Float, ForeignKey, Integer,
+    PrimaryKeyConstraint, String, UniqueConstraint,
 )
 from sqlalchemy.orm import relationship
 
-from smarthome.connectors.database import Base, SessionLocal
-from smarthome.logger import logger
-
-session = orm.scoped_session(SessionLocal)
+from smarthome.connectors.database import Base
 
 
 class UserToken(Base):
@@ -79,7 +76,7 @@ class User(Base):
     @property
     def bus_id(self):
         # TODO пока так разделяю в редисе ключи пользователя и ноды
-        return f"user-{self.id}"
+        return user_bus_id(self.id)
 
 
 class Node(Base):
@@ -105,7 +102,27 @@ class Node(Base):
     @property
     def bus_id(self):
         # TODO пока так разделяю в редисе ключи пользователя и ноды
-        return f"node-{self.id}"
+        return node_bus_id(self.id)
+
+    @property
+    def events_bus_id(self):
+        """ Topic of node events, all users of the node listen to it """
+        return node_events_bus_id(self.id)
+
+
+def user_bus_id(user_id: int) -> str:
+    """ Channel of the user by user id """
+    return f"user-{user_id}"
+
+
+def node_bus_id(node_id: int) -> str:
+    """ Channel of node commands by node id """
+    return f"node-{node_id}"
+
+
+def node_events_bus_id(node_id: int) -> str:
+    """ Topic of node events by node id """
+    return f"node-{node_id}-events"
 
 
 class NodeLamp(Base):
@@ -117,6 +134,8 @@ class NodeLamp(Base):
     updated = Column(DateTime, default=datetime.datetime.now(datetime.timezone.utc))
     name = Column(String, index=True)
     value = Column(Integer)
+    # Value last commanded by a user, rule or schedule, pushed to the node when it connects
+    desired_value = Column(Integer, nullable=True)
     node_id = Column(Integer, ForeignKey("nodes.id"), index=True)
     node = relationship("Node", back_populates="lamps")
     node_lamp_id = Column(Integer)
@@ -141,6 +160,13 @@ class NodeSensor(Base):
     node_id = Column(Integer, ForeignKey("nodes.id"), index=True)
     node = relationship("Node", back_populates="sensors")
     node_sensor_id = Column(Integer)
+    # Ingest filter, see caches.SensorFilter. None disables the rule
+    deadband_abs = Column(Float, nullable=True)  # Ignore changes up to this value
+    deadband_rel = Column(Float, nullable=True)  # Ignore changes up to this part of the last value (0.01 = 1%)
+    min_interval = Column(Integer, nullable=True)  # Seconds, ignore readings coming more often
+    heartbeat_interval = Column(Integer, nullable=True)  # Seconds, accept a reading at least this often
+    # Virtual sensor computed from other sensors, see actions.derived. The node does not send it
+    formula = Column(String, nullable=True)
 
     history = relationship("NodeSensorHistory", back_populates="sensor")
 
@@ -153,7 +179,11 @@ class NodeSensor(Base):
 
 
 class NodeSensorHistory(Base):
-    """ Node sensor history db model """
+    """
+    Node sensor history db model.
+
+    Rows are written in batches by ``connectors.history_buffer``.
+    """
     __tablename__ = "node_sensors_history"
 
     id = Column(Integer, primary_key=True)
@@ -166,19 +196,50 @@ class NodeSensorHistory(Base):
         return f"<{self.id} [{self.sensor_id}] {self.changed}: {self.value}>"
 
 
-@event.listens_for(NodeSensor, "after_update")
-def add_history(mapper, connection, target):
+class Rule(Base):
     """
-    Add history by updating sensor
+    Automation rule: set a lamp when a sensor crosses a threshold, see ``actions.rules``.
+
+    The rule turns on when the value is above (``>``) or below (``<``) the threshold
+    and turns off when it comes back past the threshold by more than the hysteresis.
     """
-    logger.debug("Node sensor history event %s, %s, %s.", target.id, target.updated, target.value)
-    new_history = NodeSensorHistory(
-        sensor_id=target.id,
-        changed=target.updated,
-        value=target.value,
-    )
-    session.add(new_history)
-    session.commit()
+    __tablename__ = "rules"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    is_active = Column(Boolean, default=True)
+    sensor_id = Column(Integer, ForeignKey("node_sensors.id"), index=True)
+    operator = Column(String, default=">")  # ">" or "<"
+    threshold = Column(Float)
+    hysteresis = Column(Float, default=0)
+    lamp_id = Column(Integer, ForeignKey("node_lamps.id"))
+    value_on = Column(Integer, default=1)  # Lamp value when the rule turns on
+    value_off = Column(Integer, nullable=True)  # Lamp value when the rule turns off, None keeps the lamp
+    cooldown = Column(Integer, default=0)  # Seconds, min time between two commands of the rule
+
+    def __repr__(self):
+        return f"<{self.id} {self.name}: [{self.sensor_id}] {self.operator} {self.threshold} -> [{self.lamp_id}]>"
+
+
+class Schedule(Base):
+    """
+    Lamp schedule: set a lamp every day at a time or at sunrise/sunset, see ``actions.scheduler``.
+
+    One of ``time_of_day`` and ``sun_event`` is set.
+    """
+    __tablename__ = "schedules"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    is_active = Column(Boolean, default=True)
+    lamp_id = Column(Integer, ForeignKey("node_lamps.id"), index=True)
+    value = Column(Integer)
+    time_of_day = Column(String, nullable=True)  # "HH:MM" in settings.scheduler_timezone
+    sun_event = Column(String, nullable=True)  # "sunrise" or "sunset" at settings.scheduler_latitude/longitude
+    offset_minutes = Column(Integer, default=0)  # Shift of the time, e.g. -30 for half an hour before sunset
+
+    def __repr__(self):
+        return f"<{self.id} {self.name}: {self.time_of_day or self.sun_event} -> [{self.lamp_id}] {self.value}>"
 
 
 """
@@ -5,20 +5,20 @@ from typing import Annotated
 import uuid
 
 from fastapi import APIRouter, Cookie, Depends, HTTPException, Response
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from smarthome import cruds, models, schemas
 from smarthome.auth import get_current_user
-from smarthome.depends import get_db
+from smarthome.depends import get_async_db
 from smarthome.logger import logger
 
 router = APIRouter()
 
 
 @router.get("/token", response_model=schemas.Token)
-def get_token(
+async def get_token(
         user: Annotated[models.User, Depends(get_current_user)],
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ) -> schemas.Token:
     """
     Generate token for websocket connection.
@@ -31,7 +31,7 @@ def get_token(
         Token object for the authenticated user
     """
     logger.debug("Get token for user: %s", user)
-    return cruds.get_token_by_user_id(db, user_id=user.id)
+    return await cruds.get_token_by_user_id(db, user_id=user.id)
 
 
 @router.post("/login", response_model=schemas.Status)
@@ -39,7 +39,7 @@ async def login(
         login_data: schemas.UserCreate,
         response: Response,
         session: Annotated[str | None, Cookie()] = None,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ) -> schemas.Status:
     """
     Authenticate user and set session cookie.
@@ -58,7 +58,7 @@ async def login(
     """
     if session:
         logger.debug("Find session: %s", session)
-        db_token = cruds.get_token_by_token(db, token=session)
+        db_token = await cruds.get_token_by_token(db, token=session)
 
         if db_token:
             logger.debug("Find token: %s", db_token)
@@ -66,18 +66,18 @@ async def login(
 
         logger.debug("Session deleted")
 
-    db_user = cruds.get_user_by_email(db, email=login_data.email)
+    db_user = await cruds.get_user_by_email(db, email=login_data.email)
     logger.debug("Find db_user: %s by email %s", db_user, login_data.email)
     if not db_user:
         logger.debug("No found db_user: %s", login_data.email)
         raise HTTPException(status_code=403, detail="Wrong email or password")
 
-    db_token = cruds.get_token_by_user_id(db=db, user_id=db_user.id)
+    db_token = await cruds.get_token_by_user_id(db=db, user_id=db_user.id)
     logger.debug("Find token: %s", db_token)
 
     if not db_token:
         token = uuid.uuid4().hex
-        db_token = cruds.create_token(db=db, user_id=db_user.id, token=token)
+        db_token = await cruds.create_token(db=db, user_id=db_user.id, token=token)
         logger.debug("Token %s generated: %s", token, db_token)
 
     response.set_cookie(
@@ -96,7 +96,7 @@ async def login(
 async def logout(
         response: Response,
         session: Annotated[str | None, Cookie()] = None,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ) -> schemas.Status:
     """
     Log out user by deleting session token and cookie.
@@ -111,10 +111,10 @@ async def logout(
     """
     if session:
         logger.debug("Find session: %s", session)
-        db_token = cruds.get_token_by_token(db, token=session)
+        db_token = await cruds.get_token_by_token(db, token=session)
         if db_token:
-            db.delete(db_token)
-            db.commit()
+            await db.delete(db_token)
+            await db.commit()
 
         response.delete_cookie("session")
 
@@ -7,12 +7,14 @@ including retrieving node information, lamp states, sensor data, and sensor hist
 import datetime
 from typing import Annotated, Literal, TypedDict
 from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from smarthome import models, schemas
 from smarthome.auth import get_current_user
+from smarthome.caches import access_index
 from smarthome.cruds import get_aggregated_sensor_history_data
-from smarthome.depends import get_db
+from smarthome.depends import get_async_db
 from smarthome.settings import settings
 from smarthome.logger import logger
 
@@ -21,27 +23,49 @@ router = APIRouter(
 )
 
 
+async def check_node_access(db: AsyncSession, user: models.User, node_id: int) -> None:
+    """
+    Check that the node exists and belongs to the user.
+
+    Args:
+        db: Database session.
+        user: The authenticated user.
+        node_id: The ID of the node.
+
+    Raises:
+        HTTPException: If the node is not found or doesn't belong to the user.
+    """
+    if not await access_index.has_access(db, user.id, node_id):
+        raise HTTPException(status_code=404, detail="Node not found")
+
+
 @router.get("/", response_model=schemas.Nodes)
-def get_nodes(
+async def get_nodes(
         user: Annotated[models.User, Depends(get_current_user)],
+        db: AsyncSession = Depends(get_async_db),
 ) -> dict[str, list[models.Node]]:
     """
     Get all nodes associated with the authenticated user.
     
     Args:
         user: The authenticated user from the dependency.
+        db: Database session.
         
     Returns:
         A dictionary containing the list of nodes.
     """
-    db_nodes = user.nodes
+    node_ids = await access_index.user_node_ids(db, user.id)
+    db_nodes = (
+        await db.scalars(select(models.Node).where(models.Node.id.in_(node_ids)).order_by(models.Node.id))
+    ).all()
     return {"nodes": db_nodes}
 
 
 @router.get("/{node_id}", response_model=schemas.Node)
-def get_node(
+async def get_node(
         node_id: int,
         user: Annotated[models.User, Depends(get_current_user)],
+        db: AsyncSession = Depends(get_async_db),
 ) -> models.Node:
     """
     Get a specific node by its ID.
@@ -49,6 +73,7 @@ def get_node(
     Args:
         node_id: The ID of the node to retrieve.
         user: The authenticated user from the dependency.
+        db: Database session.
         
     Returns:
         The requested node.
@@ -56,18 +81,20 @@ def get_node(
     Raises:
         HTTPException: If the node is not found or doesn't belong to the user.
     """
-    # TODO: Replace with a more efficient database query
-    db_nodes = [item for item in user.nodes if item.id == node_id]
-    if not db_nodes:
+    await check_node_access(db, user, node_id)
+    db_node = await db.get(models.Node, node_id)
+    if not db_node:
+        # The access index may still list a deleted node
         raise HTTPException(status_code=404, detail="Node not found")
 
-    return db_nodes[0]
+    return db_node
 
 
 @router.get("/{node_id}/lamps", response_model=schemas.NodeLamps)
-def get_node_lamps(
+async def get_node_lamps(
         node_id: int,
         user: Annotated[models.User, Depends(get_current_user)],
+        db: AsyncSession = Depends(get_async_db),
 ) -> dict[str, list[models.NodeLamp]]:
     """
     Get all lamps associated with a specific node.
@@ -75,6 +102,7 @@ def get_node_lamps(
     Args:
         node_id: The ID of the node to retrieve lamps from.
         user: The authenticated user from the dependency.
+        db: Database session.
         
     Returns:
         A dictionary containing the list of lamps.
@@ -82,21 +110,17 @@ def get_node_lamps(
     Raises:
         HTTPException: If the node is not found or doesn't belong to the user.
     """
-    # TODO: Replace with a more efficient database query
-    db_nodes = [item for item in user.nodes if item.id == node_id]
-    if not db_nodes:
-        raise HTTPException(status_code=404, detail="Node not found")
-
-    db_node = db_nodes[0]
-    db_lamps = db_node.lamps
+    await check_node_access(db, user, node_id)
+    db_lamps = (await db.scalars(select(models.NodeLamp).where(models.NodeLamp.node_id == node_id))).all()
 
     return {"data": db_lamps}
 
 
 @router.get("/{node_id}/sensors", response_model=schemas.NodeSensors)
-def get_node_sensors(
+async def get_node_sensors(
         node_id: int,
         user: Annotated[models.User, Depends(get_current_user)],
+        db: AsyncSession = Depends(get_async_db),
 ) -> dict[str, list[models.NodeSensor]]:
     """
     Get all sensors associated with a specific node.
@@ -104,6 +128,7 @@ def get_node_sensors(
     Args:
         node_id: The ID of the node to retrieve sensors from.
         user: The authenticated user from the dependency.
+        db: Database session.
         
     Returns:
         A dictionary containing the list of sensors.
@@ -111,22 +136,18 @@ def get_node_sensors(
     Raises:
         HTTPException: If the node is not found or doesn't belong to the user.
     """
-    # TODO: Replace with a more efficient database query
-    db_nodes = [item for item in user.nodes if item.id == node_id]
-    if not db_nodes:
-        raise HTTPException(status_code=404, detail="Node not found")
-
-    db_node = db_nodes[0]
-    db_sensors = db_node.sensors
+    await check_node_access(db, user, node_id)
+    db_sensors = (await db.scalars(select(models.NodeSensor).where(models.NodeSensor.node_id == node_id))).all()
 
     return {"data": db_sensors}
 
 
 @router.get("/{node_id}/sensors/{sensor_id}", response_model=schemas.NodeSensor)
-def get_node_sensor(
+async def get_node_sensor(
         node_id: int,
         sensor_id: int,
         user: Annotated[models.User, Depends(get_current_user)],
+        db: AsyncSession = Depends(get_async_db),
 ) -> models.NodeSensor:
     """
     Get a specific sensor by its ID from a specific node.
@@ -135,6 +156,7 @@ def get_node_sensor(
         node_id: The ID of the node.
         sensor_id: The ID of the sensor to retrieve.
         user: The authenticated user from the dependency.
+        db: Database session.
         
     Returns:
         The requested sensor.
@@ -142,18 +164,17 @@ def get_node_sensor(
     Raises:
         HTTPException: If the node or sensor is not found.
     """
-    # TODO: Replace with a more efficient database query
-    db_nodes = [item for item in user.nodes if item.id == node_id]
-    if not db_nodes:
-        raise HTTPException(status_code=404, detail="Node not found")
-
-    db_node = db_nodes[0]
-
-    db_sensors = [item for item in db_node.sensors if item.id == sensor_id]
-    if not db_sensors:
+    await check_node_access(db, user, node_id)
+    db_sensor = await db.scalar(
+        select(models.NodeSensor).where(
+            models.NodeSensor.id == sensor_id,
+            models.NodeSensor.node_id == node_id,
+        )
+    )
+    if not db_sensor:
         raise HTTPException(status_code=404, detail="Sensor not found")
 
-    return db_sensors[0]
+    return db_sensor
 
 
 class HistoryResponseItem(TypedDict):
@@ -173,11 +194,11 @@ class HistoryResponse(TypedDict):
 
 
 @router.get("/{node_id}/sensors/{sensor_id}/history", response_model=schemas.NodeSensorAggregateHistoryList)
-def get_node_sensor_history(
+async def get_node_sensor_history(
         node_id: int,
         sensor_id: int,
         user: Annotated[models.User, Depends(get_current_user)],
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         start_date: datetime.datetime | None = Query(
             None,
             description="Дата и время начала в формате YYYY-MM-DDTHH:MM:SS",
@@ -209,25 +230,22 @@ def get_node_sensor_history(
     Raises:
         HTTPException: If the node or sensor is not found.
     """
-    # TODO: Replace with a more efficient database query
-    db_nodes = [item for item in user.nodes if item.id == node_id]
-    if not db_nodes:
-        raise HTTPException(status_code=404, detail="Node not found")
-
-    db_node = db_nodes[0]
-
-    db_sensors = [item for item in db_node.sensors if item.id == sensor_id]
-    if not db_sensors:
+    await check_node_access(db, user, node_id)
+    db_sensor = await db.scalar(
+        select(models.NodeSensor).where(
+            models.NodeSensor.id == sensor_id,
+            models.NodeSensor.node_id == node_id,
+        )
+    )
+    if not db_sensor:
         raise HTTPException(status_code=404, detail="Sensor not found")
 
-    db_sensor = db_sensors[0]
-
     if not start_date:
         start_date = datetime.datetime.now() - datetime.timedelta(hours=24)
     if not end_date:
         end_date = datetime.datetime.now() + datetime.timedelta(hours=1)
 
-    sensor_history = get_aggregated_sensor_history_data(db, db_sensor.id, start_date, end_date, group_by=group_by)
+    sensor_history = await get_aggregated_sensor_history_data(db, db_sensor.id, start_date, end_date, group_by=group_by)
     logger.debug("Raw history: %s", sensor_history)
     history_response: list[HistoryResponseItem] = [
         {
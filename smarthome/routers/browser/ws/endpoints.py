@@ -7,15 +7,19 @@ See: https://fastapi.tiangolo.com/advanced/websockets/
 import asyncio
 from typing import Annotated, Any
 from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from smarthome import models
 from smarthome.actions.all_actions import ActionResolver, get_action_resolver
 from smarthome.auth import get_current_user_for_ws
+from smarthome.caches import access_index
 from smarthome.connectors.ws import WSConnectionManager
-from smarthome.connectors.bus import Bus, get_bus
+from smarthome.connectors.bus import Bus, BusSubscriber, get_bus
+from smarthome.depends import get_async_db
 from smarthome.logger import logger
 from smarthome.settings import settings
-from smarthome.schemas.ws import WSMessage
+from smarthome.schemas.ws import WSActions, WSMessage
 
 router = APIRouter(
     prefix=settings.main_url
@@ -25,18 +29,38 @@ router = APIRouter(
 manager: WSConnectionManager = WSConnectionManager()
 
 
+def on_user_control_message(subscriber: BusSubscriber, message: dict[str, Any]) -> None:
+    """
+    Follow access changes of the user: listen to the events of granted nodes only.
+
+    Args:
+        subscriber: The user's bus subscriber
+        message: A message from the user's own channel
+    """
+    if message.get("action") != WSActions.updated_access:
+        return
+    # The access index is updated from the access-changes channel, see AccessIndex
+    topic = models.node_events_bus_id(message["data"]["node_id"])
+    if message["data"]["granted"]:
+        asyncio.create_task(subscriber.bus.add_topics(subscriber, [topic]))
+    else:
+        asyncio.create_task(subscriber.bus.remove_topics(subscriber, [topic]))
+
+
 @router.websocket("/ws")
 async def websocket_user_endpoint(
         websocket: WebSocket,
         user: Annotated[models.User, Depends(get_current_user_for_ws)],
         bus: Annotated[Bus, Depends(get_bus)],
         action_resolver: Annotated[ActionResolver, Depends(get_action_resolver)],
+        db: Annotated[AsyncSession, Depends(get_async_db)],
 ) -> None:
     """
     WebSocket endpoint for browser clients.
     
     When a user connects, they start receiving messages from all their active nodes
-    and all changes related to those nodes. The user subscribes to the bus, not the node.
+    and all changes related to those nodes. The user subscribes to its own bus channel
+    and to the event topics of its nodes; the topics follow access changes.
     Messages from nodes are processed and, if necessary, sent to the appropriate users.
     
     Args:
@@ -44,10 +68,17 @@ async def websocket_user_endpoint(
         user: The authenticated user making the connection
         bus: The message bus for communication
         action_resolver: The resolver for processing WebSocket actions
+        db: Database session
     """
     logger.debug("Application state: %s", websocket.application_state)
     await manager.connect(websocket)
-    subscriber = await bus.subscribe(websocket, user.bus_id)
+    subscriber = await bus.subscribe(
+        websocket,
+        user.bus_id,
+        topics=[models.node_events_bus_id(node_id) for node_id in await access_index.user_node_ids(db, user.id)],
+        conflation_ms=settings.ws_user_conflation_ms,
+        control_handler=on_user_control_message,
+    )
 
     try:
         while True:
@@ -67,7 +98,11 @@ async def websocket_user_endpoint(
                 logger.debug("Get message from websocket: %s", message)
                 # Example message format: {"request_id": "1", "action": "restart_node", "data": {"id": 1}}
                 # try:
-                ws_message: WSMessage = WSMessage(**message)
+                try:
+                    ws_message: WSMessage = WSMessage(**message)
+                except ValidationError as ex:
+                    logger.warning("Wrong message from user %s: %s", user.id, ex)
+                    continue
                 logger.debug("Get ws_message from websocket: %s", ws_message)
                 await action_resolver.process(user, ws_message)
                 # except Exception:
@@ -5,17 +5,22 @@ https://fastapi.tiangolo.com/advanced/websockets/
 import asyncio
 from typing import Annotated
 from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect
-from sqlalchemy.orm import Session
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from smarthome import models
 from smarthome.auth import get_current_node_for_ws
+from smarthome.caches import device_addresses
 from smarthome.actions.all_actions import ActionResolver, get_action_resolver
+from smarthome.actions.commands import ack_window
+from smarthome.connectors.codecs import JSONCodec, negotiate_codec
 from smarthome.connectors.ws import WSConnectionManager
-from smarthome.connectors.bus import Bus, get_bus
-from smarthome.depends import get_db
+from smarthome.connectors.bus import Bus, CommandAcker, get_bus
+from smarthome.cruds.nodes import get_desired_lamps
+from smarthome.depends import get_async_db
 from smarthome.logger import logger
 from smarthome.settings import settings
-from smarthome.schemas.ws import WSMessage
+from smarthome.schemas.ws import WSActions, WSMessage, new_request_id
 
 router = APIRouter(
     prefix=settings.main_url
@@ -25,39 +30,134 @@ router = APIRouter(
 manager = WSConnectionManager()
 
 
+def collapse_commands(commands: list[WSMessage]) -> list[WSMessage]:
+    """
+    Drop lamp commands superseded by a later command for the same lamp.
+
+    Superseded lamps are removed from ``set_lamps_state`` commands, a command
+    without lamps left is dropped. Other commands are kept, the order is preserved.
+
+    Args:
+        commands: Commands in the order they were sent
+
+    Returns:
+        Commands without superseded ones
+    """
+    result = []
+    seen_lamps = set()
+    for command in reversed(commands):
+        if command.action == WSActions.set_lamp_state and command.data:
+            if command.data.get("id") in seen_lamps:
+                continue
+            seen_lamps.add(command.data.get("id"))
+        elif command.action == WSActions.set_lamps_state and command.data:
+            lamps = [lamp for lamp in command.data.get("lamps", []) if lamp.get("id") not in seen_lamps]
+            if not lamps:
+                continue
+            seen_lamps.update(lamp.get("id") for lamp in lamps)
+            if len(lamps) < len(command.data["lamps"]):
+                command = command.model_copy(update={"data": {**command.data, "lamps": lamps}})
+        result.append(command)
+    result.reverse()
+    return result
+
+
+async def send_pending_commands(
+        websocket: WebSocket, node: models.Node, bus: Bus, db: AsyncSession, codec: JSONCodec | None = None,
+) -> str | None:
+    """
+    Send commands stored while the node was offline and the desired lamp state in one frame.
+
+    The desired state of all lamps goes last as one ``set_lamps_state``, so stored
+    commands for the same lamps are dropped and a rebooted node gets every lamp back
+    with one message. Later changes come as usual commands with the changed lamps only.
+
+    Args:
+        websocket: The node WebSocket connection
+        node: The connected node
+        bus: The message bus
+        db: Database session
+        codec: Wire encoding of the node, JSON by default
+
+    Returns:
+        The last acked entry ID of the command stream, None if nothing was stored
+    """
+    commands, last_entry_id = await bus.pending_commands(node.bus_id)
+    desired_lamps = await get_desired_lamps(db, node.id) if settings.nodes_push_desired_state else {}
+    if desired_lamps:
+        commands.append(WSMessage(
+            request_id=new_request_id(),
+            action=WSActions.set_lamps_state,
+            data={"lamps": [{"id": node_lamp_id, "value": value} for node_lamp_id, value in desired_lamps.items()]},
+        ))
+
+    if settings.bus_commands_collapse or desired_lamps:
+        commands = collapse_commands(commands)
+    if commands:
+        ws_message = WSMessage(
+            request_id=new_request_id(),
+            action=WSActions.commands,
+            data={"commands": [command.model_dump(exclude_none=True) for command in commands]},
+        )
+        logger.info("Send %s pending commands to node %s, desired lamps: %s",
+                    len(commands), node.id, len(desired_lamps))
+        await (codec or JSONCodec()).send(websocket, ws_message.model_dump(mode="json", exclude_none=True))
+    if last_entry_id is not None:
+        await bus.ack_commands(node.bus_id, last_entry_id)
+    return last_entry_id
+
+
 @router.websocket("/ws/nodes")
 async def websocket_node_endpoint(
         websocket: WebSocket,
         node: Annotated[models.Node, Depends(get_current_node_for_ws)],
         bus: Annotated[Bus, Depends(get_bus)],
         action_resolver: Annotated[ActionResolver, Depends(get_action_resolver)],
-        db: Annotated[Session, Depends(get_db)],
+        db: Annotated[AsyncSession, Depends(get_async_db)],
 ):
     """
     Nodes ws endpoint.
     Нода слушает свой канал. Если что-то меняется - данные отправляются ноде.
-    При этом все, что с нодой происходит, получают все пользователи ноды.
+    При этом все, что с нодой происходит, публикуется один раз в топик событий ноды,
+    его слушают все пользователи ноды.
+    Нода может выбрать бинарный формат MessagePack, см. smarthome.connectors.codecs.
     """
-    await manager.connect(websocket)
-    subscriber = await bus.subscribe(websocket, node.bus_id)
-    node.is_online = True
-    db.commit()
+    codec, subprotocol = negotiate_codec(websocket)
+    await manager.connect(websocket, subprotocol=subprotocol)
+    # Lamps and sensors could be changed by another worker while the node was offline
+    await device_addresses.load(db, node.id)
+    # Live commands wait in the queue until the stored ones are sent, so an older command never comes last.
+    # The offset of the command stream is moved only past commands queued to this socket
+    command_acker = CommandAcker(bus, node.bus_id)
 
-    users = node.users
+    def on_command(subscriber, message):
+        # Answers of the node are passed to the sender of the command, see actions.commands
+        ack_window.opened(node.id)
+        command_acker.on_message(subscriber, message)
 
-    for user in users:
-        ws_message = WSMessage(
-            request_id="1",
-            action="updated_node",
-            data={"id": node.id, "is_online": node.is_online},
-        )
-        await bus.publish(user.bus_id, ws_message)
+    subscriber = await bus.subscribe(
+        websocket, node.bus_id, codec=codec, control_handler=on_command, start_writer=False,
+    )
+    await command_acker.start(await send_pending_commands(websocket, node, bus, db, codec))
+    subscriber.start()
+    node.is_online = True
+    await db.commit()
+
+    ws_message = WSMessage(
+        request_id=new_request_id(),
+        action="updated_node",
+        data={"id": node.id, "is_online": node.is_online},
+    )
+    await bus.publish(node.events_bus_id, ws_message)
 
     try:
         while True:
             try:
-                message = await websocket.receive_json()
+                message = await codec.receive(websocket)
                 logger.debug("Get data from websocket: %s", message)
+            except ValueError as ex:
+                logger.warning("Wrong %s message from node %s: %s", codec.name, node.id, ex)
+                continue
             except RuntimeError as ex:
             #     logger.exception("Wrong message from node %s: %s", node, ex)
             #     await asyncio.sleep(0.5)
@@ -69,12 +169,16 @@ async def websocket_node_endpoint(
 
             if message is not None:
                 logger.debug("Get data from websocket: %s", message)
-                ws_message = WSMessage(**message)
+                try:
+                    ws_message = WSMessage(**message)
+                except ValidationError as ex:
+                    logger.warning("Wrong message from node %s: %s", node.id, ex)
+                    continue
                 logger.debug("Get data from websocket: %s", ws_message)
                 # Переводим ноду в онлайн - она прислала сообщение
                 if not node.is_online:
                     node.is_online = True
-                    db.commit()
+                    await db.commit()
                     logger.error("Node %s was not online in db but send message: %s", node, ws_message)
                 await action_resolver.process(node, ws_message)
             else:
@@ -83,16 +187,15 @@ async def websocket_node_endpoint(
     except WebSocketDisconnect:
         # TODO перенести возможно в общий метод отписки
         node.is_online = False
-        db.commit()
+        await db.commit()
         manager.disconnect(websocket)
         await subscriber.unsubscribe()
 
-        for user in users:
-            ws_message = WSMessage(
-                request_id="1",
-                action="updated_node",
-                data={"id": node.id, "is_online": node.is_online},
-            )
-            await bus.publish(user.bus_id, ws_message)
+        ws_message = WSMessage(
+            request_id=new_request_id(),
+            action="updated_node",
+            data={"id": node.id, "is_online": node.is_online},
+        )
+        await bus.publish(node.events_bus_id, ws_message)
 
         logger.warning(f"Node {node.id} disconnected")
@@ -1,9 +1,12 @@
 """
 Healthcheck endpoints
 """
-from fastapi import APIRouter
+from typing import Annotated
+from fastapi import APIRouter, Depends
+
+from smarthome.connectors.bus import Bus, get_bus
 from smarthome.settings import settings
-from smarthome.schemas import Status
+from smarthome.schemas import BrokerStatus, BusStatus, Status
 
 router = APIRouter(
     prefix=settings.main_url
@@ -14,3 +17,15 @@ router = APIRouter(
 async def status():
     """ Status endpoint """
     return Status()
+
+
+@router.get("/status/broker", response_model=BrokerStatus)
+async def broker_status(bus: Annotated[Bus, Depends(get_bus)]):
+    """ Bus broker connection pool usage and reconnect counters """
+    return BrokerStatus(**bus.pubsub_client.stats())
+
+
+@router.get("/status/bus", response_model=BusStatus)
+async def bus_status(bus: Annotated[Bus, Depends(get_bus)]):
+    """ Bus subscribers, outbound queue depths and dropped messages of this worker """
+    return BusStatus(**bus.stats())
@@ -0,0 +1,34 @@
+"""
+Metrics endpoints
+"""
+from typing import Annotated
+from fastapi import APIRouter, Depends
+
+from smarthome.actions.commands import command_metrics
+from smarthome.actions.middlewares import action_metrics
+from smarthome.connectors.bus import Bus, get_bus
+from smarthome.settings import settings
+from smarthome.schemas import Metrics
+
+router = APIRouter(
+    prefix=settings.main_url
+)
+
+
+@router.get("/metrics", response_model=Metrics)
+async def metrics(bus: Annotated[Bus, Depends(get_bus)]):
+    """
+    Hot path metrics of this worker: bus publish latency, delivery lag and channel throughput,
+    processing time of actions, round trip of commands by node
+    """
+    stats = bus.stats()
+    return Metrics(
+        bus={
+            **bus.metrics.snapshot(),
+            "subscribers": stats["subscribers"],
+            "dropped_messages": stats["dropped_messages"],
+            "slow_disconnects": stats["slow_disconnects"],
+        },
+        actions=action_metrics.snapshot(),
+        commands=command_metrics.snapshot(),
+    )
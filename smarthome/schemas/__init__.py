@@ -1,14 +1,16 @@
 """
 Schemas package
 """
-from .healthcheck import Status
+from .healthcheck import BrokerStatus, BusStatus, Status
+from .metrics import ActionStats, BusMetrics, ChannelThroughput, CommandStats, HistogramSnapshot, Metrics
 from .nodes import Node, Nodes, NodeSensorAggregateHistoryList, NodeLamps, NodeSensor, NodeSensors
 from .tokens import Token
 from .users import User, UserCreate
 
 __all__ = [
     "Node", "Nodes", "NodeSensorAggregateHistoryList", "NodeLamps", "NodeSensor", "NodeSensors",
-    "Status",
+    "BrokerStatus", "BusStatus", "Status",
+    "ActionStats", "BusMetrics", "ChannelThroughput", "CommandStats", "HistogramSnapshot", "Metrics",
     "Token",
     "User", "UserCreate",
 ]
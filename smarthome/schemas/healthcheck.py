@@ -4,3 +4,25 @@ from pydantic import BaseModel
 class Status(BaseModel):
     """ Status result """
     status: str = "ok"
+
+
+class BrokerStatus(BaseModel):
+    """ Bus broker connection usage """
+    backend: str
+    channels: int
+    reconnects: int
+    pool_max_connections: int | None = None
+    pool_created_connections: int | None = None
+    pool_in_use_connections: int | None = None
+    pool_available_connections: int | None = None
+    shards: int | None = None
+
+
+class BusStatus(BaseModel):
+    """ Bus subscribers and outbound queues of this worker """
+    channels: int
+    subscribers: int
+    queued_messages: int
+    max_queue_depth: int
+    dropped_messages: int
+    slow_disconnects: int
@@ -0,0 +1,50 @@
+from pydantic import BaseModel
+
+
+class HistogramSnapshot(BaseModel):
+    """ Histogram of durations in seconds, quantiles are bucket upper bounds """
+    count: int
+    sum: float
+    avg: float | None = None
+    p50: float | None = None
+    p95: float | None = None
+    p99: float | None = None
+
+
+class ChannelThroughput(BaseModel):
+    """ Messages of a channel pattern, rates are over the last minute """
+    published_total: int
+    published_per_second: float
+    received_total: int
+    received_per_second: float
+
+
+class BusMetrics(BaseModel):
+    """ Bus hot path metrics of this worker """
+    publish_latency: HistogramSnapshot
+    delivery_lag: HistogramSnapshot
+    channels: dict[str, ChannelThroughput]
+    subscribers: int
+    dropped_messages: int
+    slow_disconnects: int
+
+
+class ActionStats(BaseModel):
+    """ Processing time and errors of an action """
+    latency: HistogramSnapshot
+    errors: int
+
+
+class CommandStats(BaseModel):
+    """ Round trip of acked commands to a node, retries, commands given up and left for the offline node """
+    latency: HistogramSnapshot
+    retries: int
+    timeouts: int
+    queued: int = 0
+
+
+class Metrics(BaseModel):
+    """ Metrics result """
+    bus: BusMetrics
+    actions: dict[str, ActionStats] = {}
+    commands: dict[str, CommandStats] = {}
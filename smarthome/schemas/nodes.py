@@ -53,8 +53,13 @@ class NodeSensor(BaseModel):
     """ Read node sensor schema """
     id: int
     name: str
-    value: float
+    value: float | None
     updated: datetime | None
+    deadband_abs: float | None = None
+    deadband_rel: float | None = None
+    min_interval: int | None = None
+    heartbeat_interval: int | None = None
+    formula: str | None = None
 
     class ConfigDict:
         """ Config """
@@ -1,6 +1,7 @@
 """
 Websocket messages schemas
 """
+import uuid
 from enum import Enum
 from pydantic import BaseModel
 
@@ -13,13 +14,18 @@ class WSActions(str, Enum):
     current_values = "updated_values"  # Текущие значения
     send_lamps_state_to_nodes = "send_lamps_state_to_nodes"  # Отпарвка нового состояния ламп на ноды
     set_lamp_state = "set_lamp_state"  # Установка состояния ламп в ноде
+    set_lamps_state = "set_lamps_state"  # Установка состояния нескольких ламп ноды одним сообщением
     lamp_changed = "lamp_changed"  # Получено новое состояния ламп от ноды
     updated_lamp = "updated_lamp"  # Сообщение юзеру об обновлении лампы
     sensor_changed = "sensor_changed"  # Получено новое состояние значений сенсоров
+    sensors_changed = "sensors_changed"  # Пачка значений сенсоров (и ламп) от ноды одним сообщением
     updated_sensor = "updated_sensor"  # Сообщение юзеру об обновлении сенсора
     updated_node = "updated_node"  # Сообщение юзеру об обновлении ноды
+    updated_access = "updated_access"  # Сообщение юзеру о выдаче или отзыве доступа к ноде
     restart = "restart"  # Перезагрузка ноды
     restart_node = "restart_node"  # Перезагрузка ноды, команда от клиента
+    commands = "commands"  # Пачка команд, накопленных пока нода была офлайн
+    command_ack = "command_ack"  # Подтверждение команды: от ноды серверу и от сервера юзеру
 
 
 class WSMessage(BaseModel):
@@ -27,3 +33,8 @@ class WSMessage(BaseModel):
     request_id: str  # Unique request identifier
     action: WSActions
     data: dict | None = None
+
+
+def new_request_id() -> str:
+    """ Unique request_id for a message created by the server """
+    return uuid.uuid4().hex
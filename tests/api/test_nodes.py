@@ -0,0 +1,97 @@
+import asyncio
+
+from sqlalchemy import delete
+from starlette.websockets import WebSocketState
+
+from smarthome import cruds, models
+from smarthome.routers.browser.ws.endpoints import on_user_control_message
+
+
+async def test_get_nodes_returns_only_user_nodes(client, db, async_db, bus, create_user_in_db, create_token_in_db):
+    db_user = create_user_in_db()
+    db_token = create_token_in_db(user_id=db_user.id)
+    own_node, other_node = models.Node(url="http://own"), models.Node(url="http://other")
+    db.add_all([own_node, other_node])
+    db.commit()
+    await cruds.add_user_node(async_db, bus, db_user.id, own_node.id)
+
+    result = client.get("/api/nodes/", params={"token": db_token.token})
+    assert result.status_code == 200
+    assert [node["id"] for node in result.json()["nodes"]] == [own_node.id]
+
+    result = client.get(f"/api/nodes/{other_node.id}", params={"token": db_token.token})
+    assert result.status_code == 404
+
+
+async def test_node_access_follows_revoke(client, db, async_db, bus, create_user_in_db, create_token_in_db):
+    db_user = create_user_in_db()
+    db_token = create_token_in_db(user_id=db_user.id)
+    node = models.Node(url="http://own")
+    db.add(node)
+    db.commit()
+    await cruds.add_user_node(async_db, bus, db_user.id, node.id)
+    assert client.get(f"/api/nodes/{node.id}/lamps", params={"token": db_token.token}).status_code == 200
+
+    await cruds.delete_user_node(async_db, bus, db_user.id, node.id)
+
+    assert client.get(f"/api/nodes/{node.id}/lamps", params={"token": db_token.token}).status_code == 404
+
+
+
+
+async def test_get_deleted_node_with_stale_access_index(client, db, async_db, bus, create_user_in_db,
+                                                        create_token_in_db):
+    db_user = create_user_in_db()
+    db_token = create_token_in_db(user_id=db_user.id)
+    node = models.Node(url="http://own")
+    db.add(node)
+    db.commit()
+    await cruds.add_user_node(async_db, bus, db_user.id, node.id)
+    assert client.get(f"/api/nodes/{node.id}", params={"token": db_token.token}).status_code == 200
+
+    # The access index still lists the node until its next reload
+    db.execute(delete(models.Node).where(models.Node.id == node.id))
+    db.commit()
+
+    assert client.get(f"/api/nodes/{node.id}", params={"token": db_token.token}).status_code == 404
+
+
+async def test_get_sensors_with_virtual_sensor_not_computed_yet(client, db, async_db, bus, create_user_in_db,
+                                                                create_token_in_db):
+    db_user = create_user_in_db()
+    db_token = create_token_in_db(user_id=db_user.id)
+    node = models.Node(url="http://own")
+    db.add(node)
+    db.commit()
+    db.add(models.NodeSensor(name="Dew point", node_id=node.id, formula="s1 + 1"))
+    db.commit()
+    await cruds.add_user_node(async_db, bus, db_user.id, node.id)
+
+    result = client.get(f"/api/nodes/{node.id}/sensors", params={"token": db_token.token})
+    assert result.status_code == 200
+    assert [sensor["value"] for sensor in result.json()["data"]] == [None]
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.client_state = WebSocketState.CONNECTED
+        self.sent = []
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+
+async def test_user_socket_follows_access_changes(db, async_db, bus, create_user_in_db):
+    db_user = create_user_in_db()
+    node = models.Node(url="http://own")
+    db.add(node)
+    db.commit()
+    subscriber = await bus.subscribe(FakeWebSocket(), db_user.bus_id, control_handler=on_user_control_message)
+
+    await cruds.add_user_node(async_db, bus, db_user.id, node.id)
+    await asyncio.sleep(0.01)
+    assert node.events_bus_id in subscriber.topics
+
+    await cruds.delete_user_node(async_db, bus, db_user.id, node.id)
+    await asyncio.sleep(0.01)
+    assert node.events_bus_id not in subscriber.topics
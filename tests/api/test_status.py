@@ -2,3 +2,22 @@ def test_status(client):
     result = client.get("/status")
     assert result.status_code == 200
     assert result.json() == {"status": "ok"}
+
+
+def test_broker_status(client):
+    result = client.get("/status/broker")
+    assert result.status_code == 200
+    assert result.json()["backend"] in ("redis", "memory")
+    assert result.json()["reconnects"] == 0
+
+
+def test_bus_status(client):
+    result = client.get("/status/bus")
+    assert result.status_code == 200
+    assert result.json()["dropped_messages"] == 0
+
+
+def test_metrics(client):
+    result = client.get("/metrics")
+    assert result.status_code == 200
+    assert set(result.json()["bus"]) >= {"publish_latency", "delivery_lag", "channels", "subscribers"}
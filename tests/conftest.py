@@ -4,9 +4,15 @@ from faker import Faker
 
 from smarthome.main import app
 from smarthome.settings import settings
-from smarthome.connectors.database import Base, engine
-from smarthome.depends import get_db
+from smarthome.connectors.database import Base, engine, async_engine
+from smarthome.depends import get_async_db, get_db
 from smarthome import models
+from smarthome.caches import access_index, device_addresses
+from smarthome.connectors.broker import InMemoryPubSubManager
+from smarthome.connectors.bus import Bus
+from smarthome.actions.commands import ack_window
+from smarthome.actions.derived import derived_sensors
+from smarthome.actions.rules import rule_engine
 
 fake = Faker()
 
@@ -23,6 +29,14 @@ def init_db():
     Base.metadata.create_all(engine)
     yield
     Base.metadata.drop_all(engine)
+    device_addresses.nodes.clear()
+    access_index.clear()
+    ack_window.nodes.clear()
+    rule_engine.by_sensor.clear()
+    rule_engine.clear()
+    derived_sensors.by_input.clear()
+    derived_sensors.values.clear()
+    derived_sensors.clear()
 
 
 @pytest.fixture
@@ -32,6 +46,36 @@ def db():
     return next(get_db())
 
 
+@pytest.fixture
+async def async_db():
+    async for db in get_async_db():
+        yield db
+    # Pooled connections belong to the event loop of the test
+    await async_engine.dispose()
+
+
+@pytest.fixture
+async def bus():
+    """ Connected bus of the test on the in-memory broker """
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    return bus
+
+
+class FakeTracker:
+    """ Command tracker that records commands instead of sending them """
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, bus, node_id, message, lamps=None, reply_to=None, reply_request_id=None):
+        self.sent.append((node_id, message, lamps, reply_request_id))
+
+
+@pytest.fixture
+def fake_tracker():
+    return FakeTracker()
+
+
 @pytest.fixture
 def create_user_in_db(db):
     def _create_user():
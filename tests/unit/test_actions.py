@@ -0,0 +1,172 @@
+import asyncio
+
+from smarthome import models
+from smarthome.actions.all_actions import ACTIONS, ActionResolver, BaseAction
+from smarthome.actions.commands import COMMAND_ACKS_BUS_ID, AckWindow
+from smarthome.actions.middlewares import (
+    ActionMetrics, ConcurrencyLimitMiddleware, ErrorIsolationMiddleware, TimingMiddleware, build_pipeline,
+)
+from smarthome.connectors.history_buffer import HistoryBuffer
+from smarthome.schemas.ws import WSActions, WSMessage
+
+
+class FakeAction:
+    action = WSActions.restart_node
+    max_concurrency = 2
+
+    def __init__(self, db=None):
+        self.db = db
+
+
+class FakeSession:
+    def __init__(self):
+        self.rollbacks = 0
+
+    async def rollback(self):
+        self.rollbacks += 1
+
+
+def test_actions_are_registered():
+    assert set(ACTIONS) >= {
+        WSActions.lamp_changed, WSActions.sensor_changed, WSActions.send_lamps_state_to_nodes, WSActions.restart_node,
+    }
+    assert all(issubclass(action_class, BaseAction) for action_class in ACTIONS.values())
+
+
+async def test_resolver_skips_unknown_action(async_db):
+    await ActionResolver(db=async_db, bus=None).process(None, WSMessage(request_id="1", action="updated_node"))
+
+
+async def test_pipeline_isolates_errors_and_records_timing():
+    metrics = ActionMetrics()
+
+    async def failing(action, data):
+        raise KeyError("id")
+
+    pipeline = build_pipeline([ErrorIsolationMiddleware(metrics), TimingMiddleware(metrics)], failing)
+    action = FakeAction(FakeSession())
+    await pipeline(action, {})
+
+    assert metrics.snapshot()["restart_node"]["errors"] == 1
+    assert metrics.snapshot()["restart_node"]["latency"]["count"] == 1
+    assert action.db.rollbacks == 1
+
+
+async def test_pipeline_limits_concurrency():
+    running = []
+    max_running = 0
+
+    async def handler(action, data):
+        nonlocal max_running
+        running.append(action)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.01)
+        running.remove(action)
+
+    pipeline = build_pipeline([ConcurrencyLimitMiddleware(default_limit=10)], handler)
+    await asyncio.gather(*(pipeline(FakeAction(), {}) for _ in range(5)))
+
+    assert max_running == 2
+
+
+class FakeBus:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, bus_id, message):
+        self.published.append((bus_id, message))
+
+
+async def test_sensors_changed_updates_all_readings_at_once(db, async_db, monkeypatch):
+    buffer = HistoryBuffer()
+    monkeypatch.setattr("smarthome.actions.all_actions.history_buffer", buffer)
+    node = models.Node(url="http://node")
+    db.add(node)
+    db.flush()
+    db.add_all([
+        models.NodeSensor(node_id=node.id, node_sensor_id=116, value=0),
+        models.NodeSensor(node_id=node.id, node_sensor_id=216, value=0),
+        models.NodeLamp(node_id=node.id, node_lamp_id=16, value=0),
+    ])
+    db.commit()
+    bus = FakeBus()
+    # A command was delivered to the node, the lamp state may answer it
+    ack_window = AckWindow()
+    ack_window.opened(node.id)
+    monkeypatch.setattr("smarthome.actions.all_actions.ack_window", ack_window)
+
+    await ACTIONS[WSActions.sensors_changed](client=node, bus=bus, db=async_db).process({
+        "sensors": [{"id": 116, "value": 21.5}, {"id": 216, "value": 40}, {"id": 999, "value": 1}],
+        "lamps": [{"id": 16, "value": 1}],
+    })
+
+    assert sorted(sensor.value for sensor in db.query(models.NodeSensor)) == [21.5, 40]
+    assert db.query(models.NodeLamp).one().value == 1
+    await buffer.stop()
+    assert db.query(models.NodeSensorHistory).count() == 2
+    assert len(bus.published) == 2
+    bus_id, message = bus.published[0]
+    assert bus_id == node.events_bus_id
+    assert message.action == WSActions.current_values
+    assert len(message.data["sensors"]) == 2
+    assert len(message.data["lamps"]) == 1
+    bus_id, message = bus.published[1]
+    assert bus_id == COMMAND_ACKS_BUS_ID
+    assert message.data["lamps"] == [{"id": 16, "value": 1}]
+
+
+async def test_send_lamps_state_sends_one_command_per_node(db, async_db, monkeypatch, fake_tracker):
+    tracker = fake_tracker
+    monkeypatch.setattr("smarthome.actions.all_actions.command_tracker", tracker)
+    user = models.User(email="a@b.c")
+    own_node, other_node = models.Node(url="http://own"), models.Node(url="http://other")
+    db.add_all([user, own_node, other_node])
+    db.flush()
+    db.add_all([
+        models.UserNode(user_id=user.id, node_id=own_node.id),
+        models.NodeLamp(node_id=own_node.id, node_lamp_id=16),
+        models.NodeLamp(node_id=own_node.id, node_lamp_id=17),
+        models.NodeLamp(node_id=other_node.id, node_lamp_id=16),
+    ])
+    db.commit()
+
+    await ACTIONS[WSActions.send_lamps_state_to_nodes](client=user, bus=None, db=async_db, request_id="r1").process({
+        "lamps": [{"id": 1, "value": 1}, {"id": 2, "value": 1}, {"id": 3, "value": 1}, {"id": 999, "value": 1}],
+    })
+
+    assert len(tracker.sent) == 1
+    node_id, message, lamps, reply_request_id = tracker.sent[0]
+    assert node_id == own_node.id
+    assert message.action == WSActions.set_lamps_state
+    assert message.data == {"lamps": [{"id": 16, "value": 1}, {"id": 17, "value": 1}]}
+    assert lamps == {16: 1, 17: 1}
+    assert reply_request_id == "r1"
+
+
+async def test_send_lamps_state_sends_only_changes(db, async_db, monkeypatch, fake_tracker):
+    tracker = fake_tracker
+    monkeypatch.setattr("smarthome.actions.all_actions.command_tracker", tracker)
+    user = models.User(email="a@b.c")
+    node = models.Node(url="http://node")
+    db.add_all([user, node])
+    db.flush()
+    db.add_all([
+        models.UserNode(user_id=user.id, node_id=node.id),
+        models.NodeLamp(node_id=node.id, node_lamp_id=16, value=1, desired_value=1),
+        models.NodeLamp(node_id=node.id, node_lamp_id=17, value=0, desired_value=0),
+    ])
+    db.commit()
+    bus = FakeBus()
+    action = ACTIONS[WSActions.send_lamps_state_to_nodes](client=user, bus=bus, db=async_db, request_id="r1")
+
+    await action.process({"lamps": [{"id": 1, "value": 1}, {"id": 2, "value": 1}]})
+    await action.process({"lamps": [{"id": 1, "value": 1}]})
+
+    assert len(tracker.sent) == 1
+    assert tracker.sent[0][2] == {17: 1}
+    db.expire_all()
+    assert [lamp.desired_value for lamp in db.query(models.NodeLamp).order_by(models.NodeLamp.id)] == [1, 1]
+    assert len(bus.published) == 1
+    bus_id, message = bus.published[0]
+    assert bus_id == user.bus_id
+    assert message.data == {"node_id": node.id, "status": "unchanged"}
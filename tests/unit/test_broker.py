@@ -0,0 +1,105 @@
+import asyncio
+from types import SimpleNamespace
+
+import redis.asyncio as aioredis
+from redis.asyncio.cluster import ClusterPipeline, RedisCluster
+
+from smarthome.connectors.broker import InMemoryPubSubManager, RedisClusterPubSubManager, ShardedPubSub
+
+
+async def test_sharded_pubsub_parses_shard_messages():
+    pubsub = ShardedPubSub(connection_pool=aioredis.ConnectionPool())
+
+    message = await pubsub.handle_message([b"smessage", b"node-1", b"data"])
+
+    assert message == {"type": "smessage", "pattern": None, "channel": b"node-1", "data": b"data"}
+
+
+async def test_sharded_pubsub_forgets_unsubscribed_channel():
+    pubsub = ShardedPubSub(connection_pool=aioredis.ConnectionPool())
+    pubsub.channels[b"node-1"] = None
+    pubsub.pending_unsubscribe_channels.add(b"node-1")
+
+    await pubsub.handle_message([b"sunsubscribe", b"node-1", 0])
+
+    assert not pubsub.channels
+
+
+async def test_in_memory_leases_are_taken_once():
+    broker = InMemoryPubSubManager()
+
+    assert await broker.acquire_leases(["a", "b"], ttl=60) == [True, True]
+    assert await broker.acquire_leases(["b", "c"], ttl=60) == [False, True]
+    assert await broker.acquire_leases([], ttl=60) == []
+
+
+async def test_cluster_manager_publishes_with_spublish(monkeypatch):
+    manager = RedisClusterPubSubManager()
+    # Not connected: the commands are recorded instead of being routed to the nodes
+    manager.cluster = RedisCluster(host="localhost", port=7000)
+    manager.cluster._initialize = False
+    commands = []
+
+    async def execute_command(*args, **kwargs):
+        commands.append(args)
+        return 1
+
+    async def execute(pipe, *args, **kwargs):
+        commands.extend(command.args for command in pipe._command_stack)
+        return [1] * len(pipe._command_stack)
+    monkeypatch.setattr(manager.cluster, "execute_command", execute_command)
+    monkeypatch.setattr(ClusterPipeline, "execute", execute)
+
+    assert await manager.publish("node-1", "data") == 1
+    await manager.publish_many(["user-1", "user-2"], "data")
+
+    assert commands == [
+        ("SPUBLISH", "node-1", "data"),
+        ("SPUBLISH", "user-1", "data"),
+        ("SPUBLISH", "user-2", "data"),
+    ]
+    await manager.cluster.aclose()
+
+
+class FakeShardPubSub:
+    """ Shard connection that replies to SUNSUBSCRIBE like Redis """
+    def __init__(self):
+        self.replies = asyncio.Queue()
+
+    async def ssubscribe(self, channel):
+        pass
+
+    async def sunsubscribe(self, channel):
+        self.replies.put_nowait({"type": "sunsubscribe", "channel": channel.encode(), "data": 0})
+
+    async def get_message(self, timeout):
+        try:
+            return await asyncio.wait_for(self.replies.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+async def test_cluster_manager_ignores_replies_to_own_sunsubscribe():
+    manager = RedisClusterPubSubManager()
+    manager.cluster = SimpleNamespace(get_node_from_key=lambda channel: SimpleNamespace(name="node-a"))
+    pubsub = FakeShardPubSub()
+    manager.shards["node-a"] = pubsub
+    resubscribed = []
+
+    async def resubscribe(failed=None):
+        resubscribed.append(failed)
+    manager._resubscribe = resubscribe
+
+    # A browser reload: the channel is subscribed again before the reply comes
+    await manager.subscribe("user-1")
+    await manager.unsubscribe("user-1")
+    await manager.subscribe("user-1")
+    await asyncio.sleep(0.01)
+    assert resubscribed == []
+    assert manager.pending_sunsubscribes == {}
+
+    # Not requested by us: the slot has moved
+    await pubsub.sunsubscribe("user-1")
+    await asyncio.sleep(0.01)
+    assert resubscribed == [pubsub]
+    manager.shard_readers["node-a"].cancel()
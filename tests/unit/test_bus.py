@@ -0,0 +1,221 @@
+import asyncio
+import json
+
+from starlette.websockets import WebSocketState
+
+from smarthome.connectors.broker import InMemoryPubSubManager
+from smarthome.connectors.bus import Bus, BusSubscriber, CommandAcker
+from smarthome.schemas.ws import WSMessage
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.client_state = WebSocketState.CONNECTED
+        self.sent = []
+
+    async def send_text(self, data):
+        self.sent.append(json.loads(data))
+
+
+async def test_bus_routes_message_to_channel_subscribers():
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    websocket1, websocket2 = FakeWebSocket(), FakeWebSocket()
+    await bus.subscribe(websocket1, "user-1")
+    await bus.subscribe(websocket2, "user-2")
+
+    await bus.publish("user-1", WSMessage(request_id="1", action="updated_node", data={"id": 1}))
+    await asyncio.sleep(0.01)
+
+    assert websocket1.sent == [{"request_id": "1", "action": "updated_node", "data": {"id": 1}}]
+    assert websocket2.sent == []
+
+
+async def test_bus_unsubscribes_channel_with_last_subscriber():
+    broker = InMemoryPubSubManager()
+    bus = Bus(broker)
+    await bus.connect()
+    subscriber1 = await bus.subscribe(FakeWebSocket(), "node-1")
+    subscriber2 = await bus.subscribe(FakeWebSocket(), "node-1")
+
+    await subscriber1.unsubscribe()
+    assert broker.channels == {"node-1"}
+
+    await subscriber2.unsubscribe()
+    assert broker.channels == set()
+    assert bus.subscribers == {}
+
+
+async def test_bus_keeps_commands_for_offline_recipient():
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    await bus.send_command("node-1", WSMessage(request_id="1", action="restart"))
+
+    commands, last_entry_id = await bus.pending_commands("node-1")
+    assert [command.action for command in commands] == ["restart"]
+
+    await bus.ack_commands("node-1", last_entry_id)
+    assert await bus.pending_commands("node-1") == ([], None)
+
+
+async def test_bus_acks_commands_delivered_live():
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    websocket = FakeWebSocket()
+    command_acker = CommandAcker(bus, "node-1")
+    subscriber = await bus.subscribe(
+        websocket, "node-1", control_handler=command_acker.on_message, start_writer=False,
+    )
+    await command_acker.start(None)
+    subscriber.start()
+
+    await bus.send_command("node-1", WSMessage(request_id="1", action="restart"))
+    await asyncio.sleep(0.01)
+
+    assert [message["request_id"] for message in websocket.sent] == ["1"]
+    assert await bus.pending_commands("node-1") == ([], None)
+
+
+async def test_bus_live_command_keeps_older_stored_commands():
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    await bus.send_command("node-1", WSMessage(request_id="1", action="restart"))
+    # A subscriber that does not ack, e.g. a stale one on another worker
+    await bus.subscribe(FakeWebSocket(), "node-1")
+    websocket = FakeWebSocket()
+    command_acker = CommandAcker(bus, "node-1")
+    subscriber = await bus.subscribe(
+        websocket, "node-1", control_handler=command_acker.on_message, start_writer=False,
+    )
+
+    await bus.send_command("node-1", WSMessage(request_id="2", action="restart"))
+    await asyncio.sleep(0.01)
+    commands, last_entry_id = await bus.pending_commands("node-1")
+    assert [command.request_id for command in commands] == ["1", "2"]
+
+    await bus.ack_commands("node-1", last_entry_id)
+    await command_acker.start(last_entry_id)
+    subscriber.start()
+    await bus.send_command("node-1", WSMessage(request_id="3", action="restart"))
+    await asyncio.sleep(0.01)
+
+    # "2" was sent with the stored commands and is not sent again
+    assert [message["request_id"] for message in websocket.sent] == ["3"]
+    assert await bus.pending_commands("node-1") == ([], None)
+
+
+async def test_bus_publish_many():
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    websockets = [FakeWebSocket() for _ in range(3)]
+    for user_id, websocket in enumerate(websockets):
+        await bus.subscribe(websocket, f"user-{user_id}")
+
+    await bus.publish_many(["user-0", "user-2"], WSMessage(request_id="1", action="updated_node", data={"id": 1}))
+    await asyncio.sleep(0.01)
+
+    assert [len(websocket.sent) for websocket in websockets] == [1, 0, 1]
+
+
+def _updated_sensor(sensor_id, value):
+    return WSMessage(request_id="1", action="updated_sensor", data={"id": sensor_id, "value": value})
+
+
+async def test_bus_subscriber_writer_stops_on_closed_socket():
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    websocket = FakeWebSocket()
+    subscriber = await bus.subscribe(websocket, "user-1")
+    websocket.client_state = WebSocketState.DISCONNECTED
+
+    await bus.publish("user-1", _updated_sensor(1, 1))
+    await asyncio.sleep(0.01)
+
+    assert subscriber.task.done()
+    assert bus.subscribers == {}
+
+
+async def test_bus_subscriber_drops_oldest_message():
+    bus = Bus(InMemoryPubSubManager())
+    subscriber = BusSubscriber(bus, FakeWebSocket(), "user-1", queue_size=2, overflow_policy="drop_oldest")
+    for value in range(3):
+        subscriber.put("user-1", _updated_sensor(1, value).model_dump_json().encode())
+
+    assert [json.loads(data)["data"]["value"] for _, data in subscriber.queue] == [1, 2]
+    assert bus.stats()["dropped_messages"] == 1
+
+
+async def test_bus_subscriber_coalesces_messages_about_same_object():
+    bus = Bus(InMemoryPubSubManager())
+    subscriber = BusSubscriber(bus, FakeWebSocket(), "user-1", queue_size=2, overflow_policy="coalesce")
+    subscriber.put("user-1", _updated_sensor(1, 1).model_dump_json().encode())
+    subscriber.put("user-1", _updated_sensor(2, 1).model_dump_json().encode())
+    subscriber.put("user-1", _updated_sensor(1, 2).model_dump_json().encode())
+
+    assert [json.loads(data)["data"] for _, data in subscriber.queue] == [{"id": 1, "value": 2}, {"id": 2, "value": 1}]
+
+
+async def test_bus_subscriber_conflates_updates_into_one_frame():
+    bus = Bus(InMemoryPubSubManager())
+    websocket = FakeWebSocket()
+    subscriber = BusSubscriber(bus, websocket, "user-1", conflation_ms=10)
+    subscriber.start()
+    for value in range(5):
+        subscriber.put("user-1", _updated_sensor(1, value).model_dump_json().encode())
+    subscriber.put("user-1", _updated_sensor(2, 7).model_dump_json().encode())
+    await asyncio.sleep(0.05)
+
+    assert len(websocket.sent) == 1
+    assert websocket.sent[0]["action"] == "updated_values"
+    assert websocket.sent[0]["data"] == {"sensors": [{"id": 1, "value": 4}, {"id": 2, "value": 7}]}
+
+
+async def test_bus_follows_node_access_changes():
+    from smarthome.routers.browser.ws.endpoints import on_user_control_message
+
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    websocket = FakeWebSocket()
+    subscriber = await bus.subscribe(
+        websocket, "user-1", topics=["node-1-events"], control_handler=on_user_control_message,
+    )
+    await bus.publish("user-1", WSMessage(request_id="1", action="updated_access", data={"user_id": 1, "node_id": 2, "granted": True}))
+    await asyncio.sleep(0.01)
+    assert subscriber.topics == {"user-1", "node-1-events", "node-2-events"}
+
+    await bus.publish("node-2-events", WSMessage(request_id="1", action="updated_node", data={"id": 2}))
+    await asyncio.sleep(0.01)
+    assert websocket.sent[-1] == {"request_id": "1", "action": "updated_node", "data": {"id": 2}}
+
+
+async def test_bus_metrics():
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    await bus.subscribe(FakeWebSocket(), "node-1-events")
+
+    await bus.publish("node-1-events", WSMessage(request_id="1", action="updated_node", data={"id": 1}))
+    await asyncio.sleep(0.01)
+
+    metrics = bus.metrics.snapshot()
+    assert metrics["publish_latency"]["count"] == 1
+    assert metrics["delivery_lag"]["count"] == 1
+    assert metrics["channels"]["node-*-events"]["published_total"] == 1
+    assert metrics["channels"]["node-*-events"]["received_total"] == 1
+
+
+async def test_bus_transcodes_messages_for_binary_subscribers():
+    from smarthome.connectors.codecs import MsgPackCodec
+
+    class FakeBinaryWebSocket(FakeWebSocket):
+        async def send_bytes(self, data):
+            self.sent.append(MsgPackCodec().decode(data))
+
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    websocket = FakeBinaryWebSocket()
+    await bus.subscribe(websocket, "node-1", codec=MsgPackCodec())
+
+    await bus.publish("node-1", WSMessage(request_id="1", action="restart"))
+    await asyncio.sleep(0.01)
+
+    assert websocket.sent == [{"request_id": "1", "action": "restart"}]
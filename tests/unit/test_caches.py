@@ -0,0 +1,73 @@
+import asyncio
+
+from smarthome import cruds, models
+from smarthome.caches import AccessIndex, DeviceAddressCache, SensorFilter, device_addresses
+
+
+async def test_device_address_cache_loads_node_addresses(db, async_db):
+    node = models.Node(url="http://node")
+    db.add(node)
+    db.flush()
+    db.add_all([
+        models.NodeSensor(node_id=node.id, node_sensor_id=116),
+        models.NodeLamp(node_id=node.id, node_lamp_id=16),
+    ])
+    db.commit()
+
+    addresses = await DeviceAddressCache().get(async_db, node.id)
+
+    assert list(addresses.sensors) == [116]
+    assert list(addresses.lamps) == [16]
+
+
+async def test_device_address_cache_is_invalidated_by_new_devices(db, async_db):
+    node = models.Node(url="http://node")
+    db.add(node)
+    db.commit()
+    assert (await device_addresses.load(async_db, node.id)).sensors == {}
+
+    db.add(models.NodeSensor(node_id=node.id, node_sensor_id=116))
+    db.commit()
+
+    assert node.id not in device_addresses.nodes
+    assert list((await device_addresses.get(async_db, node.id)).sensors) == [116]
+
+
+async def test_access_index_answers_both_directions(db, async_db):
+    db.add_all([models.User(email="a@b.c"), models.Node(url="http://node")])
+    db.commit()
+    db.add(models.UserNode(user_id=1, node_id=1))
+    db.commit()
+    index = AccessIndex()
+
+    assert await index.has_access(async_db, 1, 1)
+    assert not await index.has_access(async_db, 1, 2)
+    assert await index.node_user_ids(async_db, 1) == {1}
+
+    index.revoke(1, 1)
+    assert await index.user_node_ids(async_db, 1) == set()
+
+
+async def test_access_index_follows_changes_of_other_workers(db, async_db, bus):
+    db.add_all([models.User(email="a@b.c"), models.Node(url="http://node")])
+    db.commit()
+    await cruds.add_user_node(async_db, bus, 1, 1)
+    # The index of another worker, loaded before the revoke
+    index = AccessIndex()
+    await index.start(bus)
+    assert await index.has_access(async_db, 1, 1)
+
+    await cruds.delete_user_node(async_db, bus, 1, 1)
+    await asyncio.sleep(0.01)
+
+    assert not await index.has_access(async_db, 1, 1)
+
+
+def test_sensor_filter_min_interval_and_heartbeat():
+    sensor_filter = SensorFilter(min_interval=10, heartbeat_interval=60, deadband_rel=0.1)
+
+    assert sensor_filter.accept(100, now=0)
+    assert not sensor_filter.accept(200, now=5)  # Too soon
+    assert sensor_filter.accept(200, now=15)
+    assert not sensor_filter.accept(210, now=30)  # Within 10% deadband
+    assert sensor_filter.accept(210, now=80)  # Heartbeat
@@ -0,0 +1,46 @@
+import msgpack
+import pytest
+from starlette.websockets import WebSocket, WebSocketState
+
+from smarthome.connectors.codecs import ACTION_CODES, JSONCodec, MsgPackCodec
+from smarthome.schemas.ws import WSActions
+
+
+def test_all_actions_have_codes():
+    assert set(ACTION_CODES) == set(WSActions)
+    assert len(set(ACTION_CODES.values())) == len(ACTION_CODES)
+
+
+def test_msgpack_round_trip():
+    codec = MsgPackCodec()
+    message = {"request_id": "1", "action": "sensor_changed", "data": {"sensors": [{"id": 1, "value": 21.5}]}}
+
+    frame = codec.encode(message)
+
+    assert msgpack.unpackb(frame) == ["1", ACTION_CODES[WSActions.sensor_changed], message["data"]]
+    assert codec.decode(frame) == message
+    assert len(frame) < len(JSONCodec().encode(message))
+
+
+def test_msgpack_packs_nested_commands():
+    codec = MsgPackCodec()
+    message = {"request_id": "1", "action": "commands", "data": {"commands": [{"request_id": "2", "action": "restart"}]}}
+
+    assert msgpack.unpackb(codec.encode(message))[2] == {"commands": [["2", ACTION_CODES[WSActions.restart]]]}
+
+
+async def test_msgpack_malformed_frames_are_value_errors():
+    codec = MsgPackCodec()
+
+    async def receive():
+        return {"type": "websocket.receive", "text": "{}"}
+
+    websocket = WebSocket({"type": "websocket"}, receive=receive, send=None)
+    websocket.client_state = websocket.application_state = WebSocketState.CONNECTED
+    frames = [b"\xc1", msgpack.packb(["1", [7]]), msgpack.packb({"a": 1}), msgpack.packb(["1", 999])]
+
+    for frame in frames:
+        with pytest.raises(ValueError):
+            codec.decode(frame)
+    with pytest.raises(ValueError):
+        await codec.receive(websocket)
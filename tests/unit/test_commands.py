@@ -0,0 +1,99 @@
+import asyncio
+
+from smarthome.actions.commands import AckWindow, CommandMetrics, CommandTracker, publish_command_ack
+from smarthome.connectors.broker import InMemoryPubSubManager
+from smarthome.connectors.bus import Bus
+from smarthome.schemas.ws import WSMessage, new_request_id
+from tests.unit.test_bus import FakeWebSocket
+
+
+async def _connected_user():
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    websocket = FakeWebSocket()
+    await bus.subscribe(websocket, "user-1")
+    # Online node that never answers
+    await bus.subscribe(FakeWebSocket(), "node-1")
+    return bus, websocket
+
+
+def _lamp_command(value):
+    return WSMessage(request_id=new_request_id(), action="set_lamp_state", data={"id": 16, "value": value})
+
+
+async def test_command_acked_by_request_id():
+    bus, websocket = await _connected_user()
+    metrics = CommandMetrics()
+    tracker = CommandTracker(metrics=metrics)
+    command = _lamp_command(1)
+
+    await tracker.send(bus, 1, command, lamps={16: 1}, reply_to="user-1", reply_request_id="browser-1")
+    await publish_command_ack(bus, 1, command.request_id)
+    await asyncio.sleep(0.05)
+
+    assert tracker.pending == {}
+    assert websocket.sent[-1]["request_id"] == "browser-1"
+    assert websocket.sent[-1]["data"]["command_id"] == command.request_id
+    assert websocket.sent[-1]["data"]["status"] == "ok"
+    assert metrics.snapshot()["1"]["latency"]["count"] == 1
+
+
+async def test_command_acked_by_lamp_state():
+    bus, _ = await _connected_user()
+    tracker = CommandTracker(metrics=CommandMetrics())
+    command = _lamp_command(1)
+
+    await tracker.send(bus, 1, command, lamps={16: 1})
+    await publish_command_ack(bus, 1, "1", [{"id": 16, "value": 0}])
+    await asyncio.sleep(0.01)
+    assert command.request_id in tracker.pending
+
+    await publish_command_ack(bus, 1, "1", [{"id": 16, "value": 1}])
+    await asyncio.sleep(0.01)
+    assert tracker.pending == {}
+
+
+async def test_command_retried_then_timed_out():
+    bus, websocket = await _connected_user()
+    metrics = CommandMetrics()
+    tracker = CommandTracker(timeout_ms=10, max_retries=1, metrics=metrics)
+
+    await tracker.send(bus, 1, _lamp_command(1), lamps={16: 1}, reply_to="user-1", reply_request_id="browser-1")
+    await asyncio.sleep(0.1)
+
+    # Retries are live only, the stream keeps one copy for a reconnect
+    commands, _ = await bus.pending_commands("node-1")
+    assert len(commands) == 1
+    assert tracker.pending == {}
+    assert websocket.sent[-1]["data"]["status"] == "timeout"
+    assert metrics.snapshot()["1"]["retries"] == 1
+    assert metrics.snapshot()["1"]["timeouts"] == 1
+
+
+async def test_command_to_offline_node_is_queued():
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    websocket = FakeWebSocket()
+    await bus.subscribe(websocket, "user-1")
+    metrics = CommandMetrics()
+    tracker = CommandTracker(timeout_ms=10, metrics=metrics)
+
+    await tracker.send(bus, 1, _lamp_command(1), lamps={16: 1}, reply_to="user-1", reply_request_id="browser-1")
+    await asyncio.sleep(0.05)
+
+    assert tracker.pending == {}
+    assert websocket.sent[-1]["data"]["status"] == "queued"
+    assert len((await bus.pending_commands("node-1"))[0]) == 1
+    assert metrics.snapshot()["1"]["queued"] == 1
+    assert metrics.snapshot()["1"]["retries"] == 0
+
+
+async def test_ack_window_closes():
+    window = AckWindow(seconds=0.01)
+    assert not window.is_open(1)
+
+    window.opened(1)
+    assert window.is_open(1)
+
+    await asyncio.sleep(0.02)
+    assert not window.is_open(1)
@@ -0,0 +1,88 @@
+import datetime
+
+import pytest
+
+from smarthome import models
+from smarthome.actions.all_actions import ACTIONS
+from smarthome.actions.derived import DerivedSensor, DerivedSensorEngine, FormulaError
+from smarthome.connectors.history_buffer import HistoryBuffer
+from smarthome.schemas.ws import WSActions
+from tests.unit.test_actions import FakeBus
+
+
+@pytest.mark.parametrize("formula", ["s1 +", "__import__('os')", "s1.real", "avg(s1, s2)", "[s1]", "s1 if s2 else 0"])
+def test_formula_rejects_everything_except_arithmetic(formula):
+    with pytest.raises(FormulaError):
+        DerivedSensor.compile(3, 1, formula)
+
+
+def test_formula_skips_missing_and_broken_values():
+    sensor = DerivedSensor.compile(3, 1, "s1 / s2")
+
+    assert sensor.evaluate({1: 1}) is None
+    assert sensor.evaluate({1: 1, 2: 0}) is None
+    assert sensor.evaluate({1: 1, 2: 4}) == 0.25
+
+
+async def test_virtual_sensors_are_stored_and_sent(db, async_db, monkeypatch):
+    buffer = HistoryBuffer()
+    monkeypatch.setattr("smarthome.actions.all_actions.history_buffer", buffer)
+    nodes = [models.Node(url="http://node1"), models.Node(url="http://node2")]
+    db.add_all(nodes)
+    db.flush()
+    temperature = models.NodeSensor(node_id=nodes[0].id, node_sensor_id=1, value=20)
+    humidity = models.NodeSensor(node_id=nodes[0].id, node_sensor_id=2, value=40)
+    db.add_all([temperature, humidity])
+    db.flush()
+    dew_point = models.NodeSensor(
+        node_id=nodes[0].id, name="Dew point", formula=f"round(dew_point(s{temperature.id}, s{humidity.id}), 1)",
+    )
+    db.add(dew_point)
+    db.flush()
+    # Uses another virtual sensor, lives on another node
+    average = models.NodeSensor(node_id=nodes[1].id, name="Dew point average", formula=f"avg(s{dew_point.id}, 2)")
+    db.add(average)
+    db.commit()
+    bus = FakeBus()
+
+    for value in (50, 60):
+        await ACTIONS[WSActions.sensors_changed](client=nodes[0], bus=bus, db=async_db).process({
+            "sensors": [{"id": 2, "value": value}],
+        })
+
+    db.expire_all()
+    assert db.get(models.NodeSensor, dew_point.id).value == 12.0
+    assert db.get(models.NodeSensor, average.id).value == pytest.approx((9.3 + 12.0) / 2)
+    await buffer.stop()
+    assert db.query(models.NodeSensorHistory).count() == 6
+    assert len(bus.published) == 4
+    bus_id, message = bus.published[2]
+    assert bus_id == nodes[0].events_bus_id
+    assert [sensor["id"] for sensor in message.data["sensors"]] == [humidity.id, dew_point.id]
+    bus_id, message = bus.published[3]
+    assert bus_id == nodes[1].events_bus_id
+    assert message.data["sensors"][0]["id"] == average.id
+    assert isinstance(message.data["sensors"][0]["updated"], datetime.datetime)
+
+
+async def test_virtual_sensor_inputs_of_other_workers_are_refreshed(db, async_db):
+    node = models.Node(url="http://node")
+    db.add(node)
+    db.flush()
+    inputs = [models.NodeSensor(node_id=node.id, node_sensor_id=1, value=1),
+              models.NodeSensor(node_id=node.id, node_sensor_id=2, value=10)]
+    db.add_all(inputs)
+    db.flush()
+    total = models.NodeSensor(node_id=node.id, formula=f"s{inputs[0].id} + s{inputs[1].id}")
+    db.add(total)
+    db.commit()
+    engine = DerivedSensorEngine()
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    assert (await engine.process(async_db, [(inputs[0].id, 3)], now))[0][1]["value"] == 13
+    # The second input is reported to another worker
+    inputs[1].value = 100
+    db.commit()
+    await engine.load(async_db)
+
+    assert (await engine.process(async_db, [(inputs[0].id, 4)], now))[0][1]["value"] == 104
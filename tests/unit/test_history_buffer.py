@@ -0,0 +1,77 @@
+import asyncio
+import datetime
+
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from smarthome import models
+from smarthome.connectors.history_buffer import HistoryBuffer
+
+
+def _row(value):
+    return {"sensor_id": 1, "changed": datetime.datetime.now(datetime.timezone.utc), "value": value}
+
+
+async def test_history_buffer_flushes_by_size(db):
+    buffer = HistoryBuffer(flush_rows=3, flush_interval_ms=60_000)
+
+    await buffer.add_many([_row(value) for value in range(3)])
+    await asyncio.sleep(0.1)
+
+    assert db.query(models.NodeSensorHistory).count() == 3
+    assert buffer.rows == []
+    await buffer.stop()
+
+
+async def test_history_buffer_flushes_on_stop(db):
+    buffer = HistoryBuffer(flush_rows=100, flush_interval_ms=60_000)
+
+    await buffer.add_many([_row(1)])
+    assert db.query(models.NodeSensorHistory).count() == 0
+
+    await buffer.stop()
+    assert db.query(models.NodeSensorHistory).count() == 1
+
+
+async def test_history_buffer_waits_when_full(db):
+    buffer = HistoryBuffer(flush_rows=100, flush_interval_ms=60_000, max_rows=2)
+
+    await asyncio.wait_for(buffer.add_many([_row(value) for value in range(5)]), timeout=1)
+    await buffer.stop()
+
+    assert db.query(models.NodeSensorHistory).count() == 5
+
+
+async def test_history_buffer_drops_bad_rows(db):
+    buffer = HistoryBuffer(flush_rows=100, flush_interval_ms=60_000)
+    write = buffer._write
+
+    async def write_known_sensors(rows):
+        if any(row["sensor_id"] == 2 for row in rows):
+            raise IntegrityError("INSERT", rows, Exception("FOREIGN KEY constraint failed"))
+        await write(rows)
+    buffer._write = write_known_sensors
+
+    await buffer.add_many([_row(1), {**_row(2), "sensor_id": 2}, _row(3), _row(4)])
+    await buffer.flush()
+
+    assert db.query(models.NodeSensorHistory).count() == 3
+    assert buffer.rows == []
+    assert buffer.dropped_rows == 1
+    await buffer.stop()
+
+
+async def test_history_buffer_drops_rows_after_failed_flushes():
+    buffer = HistoryBuffer(flush_rows=100, flush_interval_ms=60_000, max_failures=2)
+
+    async def write_nothing(rows):
+        raise OperationalError("INSERT", rows, Exception("database is locked"))
+    buffer._write = write_nothing
+
+    await buffer.add_many([_row(1), _row(2)])
+    await buffer.flush()
+    assert len(buffer.rows) == 2
+
+    await buffer.flush()
+    assert buffer.rows == []
+    assert buffer.dropped_rows == 2
+    await buffer.stop()
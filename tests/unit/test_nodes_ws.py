@@ -0,0 +1,78 @@
+from smarthome import models
+from smarthome.connectors.broker import InMemoryPubSubManager
+from smarthome.connectors.bus import Bus
+from smarthome.routers.nodes.ws.endpoints import collapse_commands, send_pending_commands
+from smarthome.schemas.ws import WSMessage
+from tests.unit.test_bus import FakeWebSocket
+
+
+def test_collapse_commands_keeps_last_lamp_state():
+    commands = [
+        WSMessage(request_id="1", action="set_lamp_state", data={"id": 16, "value": 1}),
+        WSMessage(request_id="2", action="set_lamp_state", data={"id": 17, "value": 1}),
+        WSMessage(request_id="3", action="restart"),
+        WSMessage(request_id="4", action="set_lamp_state", data={"id": 16, "value": 0}),
+    ]
+
+    assert [command.request_id for command in collapse_commands(commands)] == ["2", "3", "4"]
+
+
+def _lamp(lamp_id, value):
+    return {"id": lamp_id, "value": value}
+
+
+def test_collapse_commands_removes_superseded_lamps_from_batches():
+    commands = [
+        WSMessage(request_id="1", action="set_lamps_state", data={"lamps": [_lamp(16, 1), _lamp(17, 1)]}),
+        WSMessage(request_id="2", action="set_lamps_state", data={"lamps": [_lamp(16, 0)]}),
+        WSMessage(request_id="3", action="set_lamp_state", data={"id": 17, "value": 0}),
+    ]
+
+    result = collapse_commands(commands)
+
+    assert [command.request_id for command in result] == ["2", "3"]
+    assert commands[0].data["lamps"] == [_lamp(16, 1), _lamp(17, 1)]
+
+
+def test_collapse_commands_keeps_remaining_lamps_of_batch():
+    commands = [
+        WSMessage(request_id="1", action="set_lamps_state", data={"lamps": [_lamp(16, 1), _lamp(17, 1)]}),
+        WSMessage(request_id="2", action="set_lamp_state", data={"id": 16, "value": 0}),
+    ]
+
+    result = collapse_commands(commands)
+
+    assert [command.request_id for command in result] == ["1", "2"]
+    assert result[0].data["lamps"] == [_lamp(17, 1)]
+
+
+async def test_send_pending_commands_pushes_desired_state(db, async_db):
+    node = models.Node(url="http://node")
+    db.add(node)
+    db.flush()
+    db.add_all([
+        models.NodeLamp(node_id=node.id, node_lamp_id=16, desired_value=1),
+        models.NodeLamp(node_id=node.id, node_lamp_id=17),
+    ])
+    db.commit()
+    bus = Bus(InMemoryPubSubManager())
+    await bus.connect()
+    await bus.send_command(node.bus_id, WSMessage(
+        request_id="1", action="set_lamps_state", data={"lamps": [_lamp(16, 0), _lamp(17, 1)]},
+    ))
+    await bus.send_command(node.bus_id, WSMessage(request_id="2", action="restart"))
+    websocket = FakeWebSocket()
+
+    await send_pending_commands(websocket, node, bus, async_db)
+
+    assert len(websocket.sent) == 1
+    commands = websocket.sent[0]["data"]["commands"]
+    assert [command["data"] for command in commands if command["action"] == "set_lamps_state"] == [
+        {"lamps": [_lamp(17, 1)]}, {"lamps": [_lamp(16, 1)]},
+    ]
+    assert [command["action"] for command in commands] == ["set_lamps_state", "restart", "set_lamps_state"]
+    assert await bus.pending_commands(node.bus_id) == ([], None)
+
+    # Without stored commands the node still gets its lamps back
+    await send_pending_commands(websocket, node, bus, async_db)
+    assert websocket.sent[1]["data"]["commands"][0]["data"] == {"lamps": [_lamp(16, 1)]}
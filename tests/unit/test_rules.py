@@ -0,0 +1,47 @@
+from smarthome import models
+from smarthome.actions.rules import RuleEngine, RuleState
+from smarthome.schemas.ws import WSActions
+
+
+def test_rule_below_threshold_with_cooldown():
+    rule = RuleState(1, 1, "<", 10, 2, 1, 16, value_on=1, value_off=0, cooldown=60)
+
+    assert rule.evaluate(13, now=0) is None  # The first reading only sets the state
+    assert rule.evaluate(9, now=1) == 1
+    assert rule.evaluate(13, now=10) is None  # Cooldown
+    assert rule.evaluate(13, now=61) == 0
+    assert rule.evaluate("broken", now=200) is None
+
+
+async def test_rule_engine_sends_commands_of_fired_rules(db, async_db, monkeypatch, fake_tracker):
+    tracker = fake_tracker
+    monkeypatch.setattr("smarthome.actions.rules.command_tracker", tracker)
+    node = models.Node(url="http://node")
+    db.add(node)
+    db.flush()
+    sensor = models.NodeSensor(node_id=node.id, node_sensor_id=26)
+    lamp = models.NodeLamp(node_id=node.id, node_lamp_id=16)
+    db.add_all([sensor, lamp])
+    db.flush()
+    db.add_all([
+        models.Rule(sensor_id=sensor.id, threshold=1000, hysteresis=100, lamp_id=lamp.id, value_off=0),
+        models.Rule(sensor_id=sensor.id, threshold=1000, lamp_id=lamp.id, is_active=False),
+    ])
+    db.commit()
+    engine = RuleEngine()
+
+    await engine.process(async_db, None, [(sensor.id, 800)])
+    assert tracker.sent == []
+    await engine.process(async_db, None, [(sensor.id, 1200), (sensor.id + 1, 1200)])
+    await engine.process(async_db, None, [(sensor.id, 1100)])
+
+    assert len(tracker.sent) == 1
+    node_id, message, lamps, _ = tracker.sent[0]
+    assert node_id == node.id
+    assert message.action == WSActions.set_lamps_state
+    assert lamps == {16: 1}
+
+    # States survive a reload
+    await engine.load(async_db)
+    await engine.process(async_db, None, [(sensor.id, 1100)])
+    assert len(tracker.sent) == 1
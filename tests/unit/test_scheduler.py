@@ -0,0 +1,67 @@
+import datetime
+from zoneinfo import ZoneInfo
+
+from smarthome import models
+from smarthome.actions.scheduler import ScheduleEntry, Scheduler, sun_time
+from smarthome.connectors.broker import InMemoryPubSubManager
+from smarthome.connectors.bus import Bus
+from smarthome.schemas.ws import WSActions
+
+
+def test_next_fire_of_time_of_day():
+    entry = ScheduleEntry(1, 1, 16, 1, time_of_day=datetime.time(7, 30), offset_minutes=-10)
+    timezone = ZoneInfo("Europe/Moscow")
+    after = datetime.datetime(2024, 6, 21, 4, 0, tzinfo=datetime.timezone.utc)  # 07:00 in Moscow
+
+    assert entry.next_fire(after, timezone, 55.75, 37.62) == datetime.datetime(
+        2024, 6, 21, 4, 20, tzinfo=datetime.timezone.utc)
+    assert entry.next_fire(after + datetime.timedelta(hours=1), timezone, 55.75, 37.62) == datetime.datetime(
+        2024, 6, 22, 4, 20, tzinfo=datetime.timezone.utc)
+
+
+def test_next_fire_of_sun_event():
+    entry = ScheduleEntry(1, 1, 16, 1, sun_event="sunrise")
+    after = datetime.datetime(2024, 6, 21, 12, 0, tzinfo=datetime.timezone.utc)
+    sunrise = sun_time(datetime.date(2024, 6, 22), 55.75, 37.62, "sunrise")
+
+    assert entry.next_fire(after, ZoneInfo("UTC"), 55.75, 37.62) == sunrise
+    # Polar day
+    assert entry.next_fire(after, ZoneInfo("UTC"), 80.0, 0.0) is None
+
+
+async def test_scheduler_fires_due_schedules_once(db, async_db, monkeypatch, fake_tracker):
+    tracker = fake_tracker
+    monkeypatch.setattr("smarthome.actions.scheduler.command_tracker", tracker)
+    node = models.Node(url="http://node")
+    db.add(node)
+    db.flush()
+    lamps = [models.NodeLamp(node_id=node.id, node_lamp_id=node_lamp_id) for node_lamp_id in (16, 17)]
+    db.add_all(lamps)
+    db.flush()
+    db.add_all([
+        models.Schedule(lamp_id=lamps[0].id, value=1, time_of_day="07:00"),
+        models.Schedule(lamp_id=lamps[1].id, value=0, time_of_day="07:00"),
+        models.Schedule(lamp_id=lamps[1].id, value=1, time_of_day="08:00"),
+        models.Schedule(lamp_id=lamps[0].id, value=0, time_of_day="07:00", is_active=False),
+        models.Schedule(lamp_id=lamps[0].id, value=0, time_of_day="broken"),
+    ])
+    db.commit()
+    bus = Bus(InMemoryPubSubManager())
+    start = datetime.datetime(2024, 6, 21, 6, 0, tzinfo=datetime.timezone.utc).timestamp()
+    workers = [Scheduler(timezone="UTC"), Scheduler(timezone="UTC")]
+    for worker in workers:
+        worker.bus, worker.checked_until = bus, start
+        await worker.load(async_db)
+        assert len(worker.entries) == 3
+
+    # Both workers see the fire, only one takes the lease
+    for worker in workers:
+        await worker.fire_due(start + 3600)
+
+    assert len(tracker.sent) == 1
+    node_id, message, sent_lamps, _ = tracker.sent[0]
+    assert node_id == node.id
+    assert message.action == WSActions.set_lamps_state
+    assert sent_lamps == {16: 1, 17: 0}
+    # The next fires are tomorrow and at 08:00
+    assert sorted(fire_at - start for fire_at, _ in workers[0].heap) == [2 * 3600, 25 * 3600, 25 * 3600]
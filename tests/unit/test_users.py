@@ -1,8 +1,8 @@
 from smarthome import cruds
 
 
-async def test_get_user_by_token(client, db, create_user_in_db, create_token_in_db):
+async def test_get_user_by_token(client, async_db, create_user_in_db, create_token_in_db):
     db_user = create_user_in_db()
     db_token = create_token_in_db(user_id=db_user.id)
-    user = await cruds.get_user_by_token(db=db, token=db_token.token)
+    user = await cruds.get_user_by_token(db=async_db, token=db_token.token)
     assert user.id == db_user.id